@@ -0,0 +1,26 @@
+#!/usr/bin/python
+"""
+Convert an ensemble stored as a dill pickle to an ensemble archive
+
+All code released under GPLv2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a .pkl ensemble '
+                                     'to an archive directory')
+    parser.add_argument('ensemble_file', help='the stored ensemble (.pkl)')
+    parser.add_argument('archive_dir', help='the archive directory to write')
+    args = parser.parse_args()
+
+    from toupee import archive
+
+    members, ensemble = archive.load_ensemble(args.ensemble_file)
+    print(("Converting {0} members to {1}".format(len(members),
+        args.archive_dir)))
+    archive.save_ensemble(args.archive_dir, members, ensemble,
+                          ensemble.params)
@@ -16,7 +16,15 @@ import argparse
 import os
 import re
 import dill
-from toupee.common import accuracy
+import copy
+from toupee.common import accuracy, labels, quantize_members, \
+    inference_batch_size
+from toupee.timing import timer
+from toupee.autotune import autotune, use_threads
+from toupee.budget import BudgetScheduler
+from toupee.archive import EnsembleArchive, MemberStore, is_pickle
+from toupee.results import results_sink
+from toupee.scoring import IntermediateScorer
 
 from pymongo import MongoClient
 import numpy as np
@@ -24,6 +32,7 @@ import datetime
 import subprocess
 import h5py
 import time
+import random
 
 
 
@@ -85,43 +94,94 @@ def load_data_files(args, params):
     
     
     
-def get_scorer(classification):
+def quantize_ensemble(params, members, ensemble, validfile):
+    '''
+    Stores the member weights at params.weights_precision, and reports the
+    validation accuracy lost with respect to full precision
+    '''
     
-    scorer = []
-    scorer_name = []
-    if classification:
-        scorer.append(accuracy)
-        scorer_name.append('accuracy')
-    else:
-        #TODO: these use the old non-generator files
-        scorer.append(euclidian_distance)
-        scorer_name.append('euclidian distance')
-        
-        scorer.append(relative_distance)
-        scorer_name.append('relative distance')
+    quantized_members = quantize_members(members, params.weights_precision)
+    if quantized_members is members:
+        return members, ensemble
+    
+    quantized_ensemble = copy.copy(ensemble)
+    quantized_ensemble.members = quantized_members
+    
+    full_bytes = sum(sum(w.nbytes for w in m[1]) for m in members)
+    quantized_bytes = sum(m[1].nbytes for m in quantized_members)
+    full_accuracy = accuracy(ensemble, validfile,
+        inference_batch_size(params))
+    quantized_accuracy = accuracy(quantized_ensemble, validfile,
+        inference_batch_size(params))
+    params.quantization_report = {
+        'weights_precision': params.weights_precision,
+        'full_precision_valid_accuracy': full_accuracy,
+        'quantized_valid_accuracy': quantized_accuracy,
+        'valid_accuracy_delta': quantized_accuracy - full_accuracy,
+        'weights_bytes': quantized_bytes,
+        'full_precision_weights_bytes': full_bytes,
+    }
+    print(("\nWeights stored as {0}: {1:.1f}MB instead of {2:.1f}MB, "
+        "valid accuracy {3} (full precision: {4}, delta: {5})".format(
+            params.weights_precision, quantized_bytes / 2.**20,
+            full_bytes / 2.**20, quantized_accuracy, full_accuracy,
+            quantized_accuracy - full_accuracy)))
+    return quantized_members, quantized_ensemble
+    
+    
+def ensemble_location(args, params):
+    
+    if args.dump_to is None:
+        return None
+    
+    if args.sweeping_architectures:
+        ensemble_name = 'ensemble_' + str(params.ensemble_id)
+        if is_pickle(args.dump_to):
+            ensemble_name += '.pkl'
         
-    return (scorer, scorer_name)
+        if not os.path.exists(os.path.join(params.dataset, 'ensembles/')):
+            os.makedirs(os.path.join(params.dataset, 'ensembles/'))
         
+        return os.path.join(params.dataset, 'ensembles/' , ensemble_name)
+    return os.path.join(params.dataset, args.dump_to)
 
-def store_ensemble(args, params, members, ensemble):
+
+def archive_member(archive, params, members, ensemble, score):
+    '''
+    Adds the latest member to the archive, so that it always holds a
+    complete ensemble
+    '''
+    
+    number = len(members) - 1
+    m_yaml, m_weights = quantize_members(members[number:],
+        params.weights_precision)[0]
+    member_timings = timer.summary()['members'].get(str(number), {})
+    archive.write_member(number, m_yaml, m_weights,
+        metadata = {'intermediate_score': score, 'timings': member_timings})
+    archive.set_aggregator(ensemble, params)
+
+
+def store_ensemble(args, params, members, ensemble, validfile, archive = None):
 
     if args.dump_to is not None:
+        members_to_dump, ensemble_to_dump = quantize_ensemble(params, members,
+            ensemble, validfile)
         
-        
-        if args.sweeping_architectures:
-            ensemble_name = 'ensemble_' + str(params.ensemble_id) + '.pkl'
-            
-            if not os.path.exists(os.path.join(params.dataset, 'ensembles/')):
-                os.makedirs(os.path.join(params.dataset, 'ensembles/'))
-            
-            ensemble_location = os.path.join(params.dataset, 'ensembles/' , ensemble_name)
+        location = ensemble_location(args, params)
+        if archive is not None:
+            #the members are already there
+            print("\nEnsemble stored in {0}\n".format(location))
+            archive.set_aggregator(ensemble, params)
         else:
-            ensemble_location = os.path.join(params.dataset, args.dump_to)
-        
-        print("\nStoring the ensemble to {0}\n".format(ensemble_location))
-        
-        dill.dump({'members': members, 'ensemble': ensemble},
-                open(ensemble_location,"wb"))
+            print("\nStoring the ensemble to {0}\n".format(location))
+            
+            #the pickle holds every member, even if some were spilled
+            if isinstance(members_to_dump, MemberStore):
+                members_to_dump = list(members_to_dump)
+                ensemble_to_dump = copy.copy(ensemble_to_dump)
+                ensemble_to_dump.members = members_to_dump
+            dill.dump({'members': members_to_dump, 'ensemble': ensemble_to_dump},
+                    open(location,"wb"))
                 
     if args.dump_shapes_to is not None:
         if args.dump_shapes_to == '':
@@ -135,49 +195,277 @@ def store_ensemble(args, params, members, ensemble):
         
     
     
-def run_ensemble(args, params):
+def run_name(args, params):
+    '''
+    The experiment and the seed of the run, which name its checkpoint and
+    its members' snapshots
+    '''
+    
+    experiment = os.path.splitext(os.path.basename(args.params_file))[0]
+    return '{0}-seed{1}'.format(experiment, params.random_seed)
+
+
+def checkpoint_location(args, params):
+    '''
+    Where the state of the run is saved: --checkpoint-to, or by default a
+    file named after the experiment and its seed, so that experiments on
+    the same dataset don't share it
+    '''
+    
+    if args.no_checkpoint:
+        return None
+    if args.checkpoint_to is not None:
+        return os.path.join(params.dataset, args.checkpoint_to)
+    return os.path.join(params.dataset, run_name(args, params) +
+                        '.checkpoint')
+
+
+def spill_location(params, location):
+    '''
+    Where a MemberStore spills the members: next to the checkpoint (in
+    member_spill_dir, if given), so that a resumed run finds them, or a
+    temporary directory without a checkpoint
+    '''
+    
+    if location is None:
+        return None
+    name = os.path.basename(location) + '.members'
+    if params.member_spill_dir is not None:
+        return os.path.join(params.member_spill_dir, name)
+    return location + '.members'
+
+
+def load_checkpoint(location, args, params):
+    '''
+    The state saved by a run of the same experiment file with the same seed
+    '''
+    
+    with open(location, "rb") as f:
+        state = dill.load(f)
+    params_file = os.path.abspath(args.params_file)
+    if state['params_file'] != params_file or \
+            state['random_seed'] != params.random_seed:
+        raise ValueError("{0} is the checkpoint of {1} with seed {2}, not "
+            "of {3} with seed {4}".format(location, state['params_file'],
+                state['random_seed'], params_file, params.random_seed))
+    return state
+
+
+def save_checkpoint(location, state):
+    '''
+    Atomically replaces the checkpoint of the run
+    '''
+    
+    with timer.phase('checkpoint'):
+        tmp_location = location + '.tmp'
+        with open(tmp_location, "wb") as f:
+            dill.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_location, location)
 
+
+def method_state(method):
+    '''
+    The ensemble method without the parameters (which point back to it) and
+    the evaluations of the last member
+    '''
+    
+    state = copy.copy(method)
+    state.params = None
+    state.last_evaluations = None
+    return state
+
+
+def run_ensemble(args, params, sink = None):
+
+    timer.reset()
+    
     #Checks for h5/npz data, and returns the files if successful
-    trainfile, validfile, testfile = load_data_files(args, params)
+    with timer.phase('dataset_open'):
+        trainfile, validfile, testfile = load_data_files(args, params)
+    
+    #picks the fastest eval batch size and thread count (if needed)
+    if params.autotune is not None:
+        with timer.phase('autotune'):
+            autotune(params, [trainfile, validfile, testfile])
+    elif params.threads is not None:
+        use_threads(params.threads)
     
     #gets the train size
-    train_size = trainfile['y'].shape[0]
+    train_size = len(labels(trainfile))
     
     #initializes the ensemble method for the h5 file
     method = params.method
     method.prepare(params, train_size)
     
-    #selects the appropriate intermediate score: classification - accuracy; regression - euclidian_distance
-    scorer, scorer_name = get_scorer(params.classification)
-    members = []
+    #scores the ensemble on params.intermediate_scoring as it grows
+    if params.classification:
+        scorer = IntermediateScorer(params, [trainfile, validfile, testfile])
+    else:
+        print("WARNING: the intermediate scores need a classification "
+              "problem, no scores will be computed")
+        scorer = None
     intermediate_scores = []
+    scored_members = []
     final_score = None
-    for i in range(0,params.ensemble_size):
-        print(('\n\ntraining member {0}'.format(i)))
-        m = method.create_member([trainfile, validfile, testfile])
+    
+    scheduler = None
+    stopped = False
+    
+    #the members are added to the archive as they are trained, so a
+    # checkpoint only needs to refer to them (unless they are quantized)
+    location = checkpoint_location(args, params)
+    resuming = args.resume and location is not None and \
+        os.path.exists(location)
+    archive = None
+    location_to_dump = ensemble_location(args, params)
+    if location_to_dump is not None and not is_pickle(location_to_dump):
+        archive = EnsembleArchive(location_to_dump,
+            'a' if resuming else 'w')
+    members_in_archive = archive is not None and \
+        params.weights_precision == 'float32'
+    
+    #a resumed store keeps its spilled members, and members already in the
+    # archive are spilled by reference to it
+    if resuming and not members_in_archive:
+        members = None
+    elif params.member_memory_budget is not None:
+        members = MemberStore(params.member_memory_budget * 2**20,
+            spill_location(params, location), params.member_spill_dir,
+            archive if members_in_archive else None)
+    else:
+        members = []
+    
+    #continues from the last completed member, if asked to
+    if resuming:
+        state = load_checkpoint(location, args, params)
+        method = state['method']
+        method.params = params
+        params.method = method
+        #an interrupted member may have been stored already
+        if archive is not None:
+            archive.truncate(state['n_members'])
+        if members_in_archive:
+            for i in range(state['n_members']):
+                members.append(archive.member(i))
+        else:
+            members = state['members']
+        intermediate_scores = state['intermediate_scores']
+        scored_members = state['scored_members']
+        final_score = state['final_score']
+        scorer = state['scorer']
+        scheduler = state['scheduler']
+        stopped = state['stopped']
+        numpy.random.set_state(state['numpy_rng'])
+        random.setstate(state['python_rng'])
+        print(("\nResuming from {0}: {1} members done".format(location,
+            len(members))))
+    #the interrupted member continues from its snapshot (see checkpoint_dir)
+    params.snapshot_prefix = run_name(args, params)
+    if resuming:
+        params.resume_snapshot = len(members)
+    
+    #fits the members in params.budget, if any
+    if params.budget is not None:
+        if scheduler is None:
+            scheduler = BudgetScheduler(params)
+        if not stopped and not scheduler.next_member(params, len(members)):
+            stopped = True
+    
+    ensemble = None
+    first_member = params.ensemble_size if stopped else len(members)
+    member_start = time.time()
+    for m in method.create_members([trainfile, validfile, testfile],
+                                   params.ensemble_size, first_member):
         members.append(m[:2])
         ensemble = method.create_aggregator(params,members,None,None)
-        test_score = []
-        for j in range(len(scorer)):
-            test_score.append(scorer[j](ensemble,trainfile,params.batch_size))
-            print(('Intermediate test {0}: {1}'.format(scorer_name[j], test_score[j])))
+        score = None
+        if scorer is not None:
+            with timer.phase('ensemble_scoring'):
+                score = scorer.add_member(ensemble,
+                    getattr(method, 'last_evaluations', None),
+                    [trainfile, validfile, testfile],
+                    inference_batch_size(params))
         
-        intermediate_scores.append(test_score)
-        final_score = test_score
-        if len(m) > 2 and not m[2]: #the ensemble method told us to stop
+        if score is not None:
+            for name, value in zip(scorer.scorer_names, score):
+                print(('Intermediate {0} {1}: {2}'.format(scorer.name, name,
+                    value)))
+            intermediate_scores.append(score)
+            scored_members.append(len(members))
+            final_score = score
+            if sink is not None:
+                sink.record('ensemble', {'members': len(members),
+                    'intermediate_score': score})
+        if archive is not None:
+            archive_member(archive, params, members, ensemble, score)
+        if isinstance(members, MemberStore):
+            members.spill()
+            print(("Members in memory: {0:.1f}MB, {1} spilled to {2}".format(
+                members.resident_bytes / 2.**20, members.n_spilled,
+                members.spill_dir)))
+        #the ensemble method can tell us to stop
+        stopped = len(m) > 2 and not m[2]
+        if scheduler is not None and not stopped:
+            scheduler.member_done(len(members) - 1, time.time() - member_start)
+            stopped = len(members) < params.ensemble_size and \
+                not scheduler.next_member(params, len(members))
+        
+        if location is not None:
+            save_checkpoint(location, {
+                'params_file': os.path.abspath(args.params_file),
+                'random_seed': params.random_seed,
+                'n_members': len(members),
+                'members': None if members_in_archive else members,
+                'method': method_state(method),
+                'intermediate_scores': intermediate_scores,
+                'scored_members': scored_members,
+                'final_score': final_score,
+                'scorer': scorer,
+                'scheduler': scheduler,
+                'stopped': stopped,
+                'numpy_rng': numpy.random.get_state(),
+                'python_rng': random.getstate(),
+            })
+        if stopped:
             break
-            
+        member_start = time.time()
     
-    for j in range(len(scorer)): print(('Final test {0}: {1}'.format(scorer_name[j], test_score[j])))
+    if ensemble is None:
+        ensemble = method.create_aggregator(params,members,None,None)
+    if scorer is not None:
+        #the ensemble stopped between two scores
+        if scorer.needs_final_score():
+            with timer.phase('ensemble_scoring'):
+                final_score = scorer.score(ensemble,
+                    [trainfile, validfile, testfile],
+                    inference_batch_size(params))
+            intermediate_scores.append(final_score)
+            scored_members.append(len(members))
+        for name, value in zip(scorer.scorer_names, final_score):
+            print(('Final {0} {1}: {2}'.format(scorer.name, name, value)))
+        params.intermediate_scoring_report = {'set': scorer.name,
+            'scorers': scorer.scorer_names, 'members': scored_members}
+    timer.set_member(None)
+    if scheduler is not None:
+        scheduler.finish(params, len(members))
     
     #stores the ensemble (if needed)
-    store_ensemble(args, params, members, ensemble)
+    store_ensemble(args, params, members, ensemble, validfile, archive)
+    if location is not None and os.path.exists(location):
+        os.remove(location)
+    if isinstance(members, MemberStore):
+        members.close()
     
     #cleanup: closes the files
     trainfile.close()
     validfile.close()
     testfile.close()
     
+    print("\nTime spent in each phase:")
+    timer.print_summary()
+    
     return (intermediate_scores, final_score)
     
     
@@ -203,19 +491,34 @@ def store_results(args, params, intermediate_scores, final_score):
         #removes mongodb-buggy "params" entries
         params.method = ''
         
+        #the best of the first scorer (the ensemble may only be scored
+        # every few members)
+        best_score = None
+        best_member = None
+        if intermediate_scores:
+            report = params.intermediate_scoring_report
+            first_scores = np.array([s[0] for s in intermediate_scores])
+            if report['scorers'][0] in ('error', 'nll'):
+                best_index = np.argmin(first_scores).item()
+            else:
+                best_index = np.argmax(first_scores).item()   #without "item()", defaults to np.int64, which is not supported by mongodb
+            best_score = float(first_scores[best_index])
+            best_member = report['members'][best_index] - 1
+        
         this_file_dir = os.path.dirname(os.path.realpath(__file__))
         results = {
                     "params_file": args.params_file,
                     "params": params.__dict__,
                     "intermediate_test_scores" : intermediate_scores,
                     "final_test_score" : final_score,
-                    "best_score": np.max(intermediate_scores),
-                    "best_score_after_ensemble_#": np.argmax(intermediate_scores).item(),   #without "item()", defaults to np.int64, which is not supported by mongodb
+                    "best_score": best_score,
+                    "best_score_after_ensemble_#": best_member,
                     "date": datetime.datetime.utcnow(),
                     "code version": subprocess.check_output(["/usr/bin/git", 
                         "describe","--always"], cwd = this_file_dir).strip(),
                     "model_dir": args.model_dir,
                     "ensemble_ID": params.ensemble_id,
+                    "timings": timer.summary(),
                   }                
         
         #adds the dependency ID
@@ -265,12 +568,23 @@ if __name__ == '__main__':
                         help='mongodb table name for storing results')
     parser.add_argument('--results-dep', nargs='?',
                         help='mongodb table name for dependencies')
+    parser.add_argument('--results-file', nargs='?',
+                        help='file where the per-epoch and per-member results are appended (.jsonl, or .sqlite)')
     parser.add_argument('--device', nargs='?',
                         help='gpu/cpu device to use for training')
     parser.add_argument('--dump-shapes-to', type=str, nargs='?', default=None,
                         help='location where to save the shape of the ensemble members. Pass \'\' to use the same number as --seed')
-    parser.add_argument('--dump-to', type=str, nargs='?', default='ensemble.pkl',
-                        help='location where to save the ensemble')
+    parser.add_argument('--dump-to', type=str, nargs='?', default='ensemble',
+                        help='location where to save the ensemble: an archive directory, or a .pkl file for a dill pickle')
+    parser.add_argument('--weights-precision', nargs='?',
+                        choices=['float32', 'float16', 'int8'],
+                        help='precision of the member weights in the stored ensemble')
+    parser.add_argument('--checkpoint-to', type=str, default=None,
+                        help='location where to save the state of the run after each member (by default <experiment>-seed<seed>.checkpoint)')
+    parser.add_argument('--no-checkpoint', help="don't save the state of the run after each member",
+                        action='store_true')
+    parser.add_argument('--resume', help="continue the run from its checkpoint",
+                        action='store_true')
     parser.add_argument('--testfile', default='test.npz',
                         help='test set npz file name')
     parser.add_argument('--validfile', default='valid.npz',
@@ -283,7 +597,9 @@ if __name__ == '__main__':
                         action='store_true')
     parser.add_argument('--remove-tmp-files', help="remove the temporary model files at the end.",
                         action='store_true')
-    parser.add_argument('--sweeping-architectures', help="use while sweeping multiple architectures",
+    parser.add_argument('--threads', type=int, nargs='?',
+                        help='number of TensorFlow intra and inter-op threads')
+    parser.add_argument('--sweeping-architectures', help="use while sweeping multiple architectures (deprecated: use bin/sweep.py)",
                         action='store_true')
     parser.add_argument('--verbose', help="Verbosity level 0, 1 (default) or 2 as specified\
                      by Keras", type=int, default=1)
@@ -310,6 +626,8 @@ if __name__ == '__main__':
         (args.validfile, 'validfile'),
         (args.trainfile, 'trainfile'),
         (args.verbose, 'verbose'),
+        (args.weights_precision, 'weights_precision'),
+        (args.threads, 'threads'),
         (str(round(time.time())), 'ensemble_id')    #<-- unique ID for this ensemble
     ]
     
@@ -337,9 +655,32 @@ if __name__ == '__main__':
 
     for arg, param in arg_param_pairings:
         arg_params(arg,param)
-        
-    #Runs the ensemble training
-    intermediate_scores, final_score = run_ensemble(args, params)
+    #the members are seeded from it (see toupee.parallel.member_seed)
+    if params.random_seed is None:
+        params.random_seed = args.seed
+    if args.results_file is not None:
+        params.results_sink = {'path': args.results_file,
+            'backend': 'sqlite' if args.results_file[-7:] == '.sqlite'
+                else 'jsonl'}
+    
+    #streams the per-epoch and per-member results, if needed
+    from toupee.common import toupee_global_instance
+    sink = results_sink(params)
+    if sink is not None:
+        sink.install_hooks(toupee_global_instance)
+    
+    try:
+        #Runs the ensemble training
+        intermediate_scores, final_score = run_ensemble(args, params, sink)
+        if sink is not None:
+            sink.record('run', {'params_file': args.params_file,
+                'intermediate_test_scores': intermediate_scores,
+                'final_test_score': final_score,
+                'timings': timer.summary()})
+    finally:
+        #whatever happens, the records so far are written
+        if sink is not None:
+            sink.close()
     
     #Saves the results in the DB            
     store_results(args, params, intermediate_scores, final_score)
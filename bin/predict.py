@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""
+Predict a set of any size with a stored ensemble, a chunk at a time
+
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+All code released under GPLv2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+
+import argparse
+import time
+
+
+def predicted_classes(proba):
+    if proba.shape[-1] > 1:
+        return proba.argmax(axis=-1).astype('int32')
+    return (proba[:, 0] > 0.5).astype('int32')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict an input set with '
+        'a stored ensemble, streaming it in chunks')
+    parser.add_argument('ensemble_file', help='the stored ensemble (an '
+                        'archive directory or a .pkl file)')
+    parser.add_argument('input_file', help='the input set: a .npy file, or '
+                        'a .npz or .h5 file with an --input-key array')
+    parser.add_argument('output_file', help='where the predictions go: a '
+                        'memory-mapped .npy file or a .h5 file')
+    parser.add_argument('--input-key', default='x',
+                        help='name of the input array in .npz and .h5 files')
+    parser.add_argument('--output', default='probabilities',
+                        choices=['probabilities', 'labels'],
+                        help='write the combined probabilities or the '
+                        'predicted classes')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='rows read, predicted and written at a time')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue a partially written output')
+    parser.add_argument('--eval-batch-size', type=int, default=None,
+                        help='batch size of the member models (by default, '
+                        'the ensemble\'s eval_batch_size)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='number of TensorFlow intra and inter-op threads')
+    args = parser.parse_args()
+
+    from toupee import streaming
+    from toupee.serving import EnsemblePredictor
+    if args.threads is not None:
+        from toupee.autotune import use_threads
+        use_threads(args.threads)
+
+    input_set = streaming.open_input(args.input_file, args.input_key)
+    n_rows = len(input_set)
+    output = None
+    if args.resume:
+        output = streaming.resume_output(args.output_file, args.output,
+                                         n_rows)
+    start = 0
+    if output is not None:
+        start = output.rows_done
+        print(("\nResuming {0}: {1} of {2} rows done".format(
+            args.output_file, start, n_rows)))
+
+    print(("\nLoading {0}".format(args.ensemble_file)))
+    predictor = EnsemblePredictor(args.ensemble_file, args.eval_batch_size)
+
+    first_row = start
+    run_start = time.time()
+    while start < n_rows:
+        stop = min(start + args.chunk_size, n_rows)
+        proba = predictor(input_set.read(start, stop))
+        if args.output == 'labels':
+            values = predicted_classes(proba)
+        else:
+            values = proba.astype('float32')
+        if output is None:
+            output = streaming.create_output(args.output_file, args.output,
+                (n_rows,) + values.shape[1:], values.dtype)
+        output.write(start, values)
+        output.commit(stop)
+        start = stop
+        elapsed = time.time() - run_start
+        print(("{0}/{1} rows, {2:.0f} rows/s".format(stop, n_rows,
+            (stop - first_row) / max(elapsed, 1e-9))))
+
+    elapsed = time.time() - run_start
+    print(("\nPredicted {0} rows in {1:.1f}s ({2:.0f} rows/s), written to "
+           "{3}".format(n_rows - first_row, elapsed,
+               (n_rows - first_row) / max(elapsed, 1e-9), args.output_file)))
+    if output is not None:
+        output.close()
+    input_set.close()
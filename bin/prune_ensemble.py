@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""
+Prune a stored ensemble using the predictions of its members on the
+validation set
+
+All code released under GPLv2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+
+import argparse
+import os
+import h5py
+import numpy as np
+
+
+def load_valid_file(params, validfile):
+    if validfile[-4:] == '.npz':
+        return np.load(os.path.join(params.dataset, validfile))
+    elif validfile[-3:] == '.h5':
+        return h5py.File(os.path.join(params.dataset, validfile), 'r')
+    raise ValueError('.npz or .h5 files are required.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prune a stored ensemble')
+    parser.add_argument('params_file', help='the parameters file')
+    parser.add_argument('ensemble_file', help='the stored ensemble (an '
+                        'archive directory or a .pkl file)')
+    parser.add_argument('--dump-to', type=str, default='pruned_ensemble',
+                        help='location where to save the pruned ensemble: an '
+                        'archive directory, or a .pkl file for a dill pickle')
+    parser.add_argument('--strategy', default='forward',
+                        choices=['forward', 'backward', 'cost'],
+                        help='greedy forward selection, backward elimination'
+                        ' or cost-constrained forward selection')
+    parser.add_argument('--target-accuracy', type=float, default=None,
+                        help='validation accuracy the sub-ensemble must reach')
+    parser.add_argument('--latency-budget', type=float, default=None,
+                        help='maximum inference time of the sub-ensemble over'
+                        ' the validation set, in seconds')
+    parser.add_argument('--max-members', type=int, default=None,
+                        help='maximum number of members to keep')
+    parser.add_argument('--validfile', default='valid.npz',
+                        help='valid set npz/h5 file name')
+    args = parser.parse_args()
+
+    from toupee import config
+    from toupee import pruning
+    from toupee import common
+    from toupee import archive
+
+    params = config.load_parameters(args.params_file)
+    members, ensemble = archive.load_ensemble(args.ensemble_file)
+    validfile = load_valid_file(params, args.validfile)
+
+    print("\nPredicting the validation set with {0} members\n".format(
+        len(members)))
+    predictions, costs = pruning.member_predictions(members, validfile,
+            common.inference_batch_size(params))
+    y = common.labels(validfile)
+    validfile.close()
+
+    #combined as the aggregator's predict_proba does
+    wrapper = getattr(ensemble, 'wrapper', None)
+    if wrapper is not None:
+        predictions = np.asarray([wrapper(p) for p in predictions])
+    weights = pruning.ensemble_weights(ensemble, len(members))
+    all_members = list(range(len(members)))
+    full_accuracy = pruning.subset_accuracy(predictions, weights, y,
+            all_members)
+
+    target_accuracy = args.target_accuracy
+    if target_accuracy is None and args.strategy == 'forward':
+        target_accuracy = full_accuracy
+
+    if args.strategy == 'backward':
+        selected, history = pruning.backward_elimination(predictions,
+                weights, y, target_accuracy = args.target_accuracy,
+                max_members = args.max_members, costs = costs,
+                budget = args.latency_budget)
+    else:
+        if args.strategy == 'cost' and args.latency_budget is None:
+            raise ValueError('the cost strategy needs --latency-budget')
+        selected, history = pruning.forward_selection(predictions, weights,
+                y, target_accuracy = target_accuracy,
+                max_members = args.max_members, costs = costs,
+                budget = args.latency_budget)
+
+    pruned_accuracy = pruning.subset_accuracy(predictions, weights, y,
+            selected)
+    print("Full ensemble: {0} members, valid accuracy {1}, {2:.2f}s".format(
+        len(members), full_accuracy, costs.sum()))
+    print("Pruned ensemble: {0} members {1}, valid accuracy {2}, {3:.2f}s"
+        .format(len(selected), sorted(selected), pruned_accuracy,
+            costs[selected].sum()))
+
+    new_members, new_ensemble = pruning.prune(ensemble, members, selected)
+    print("\nStoring the pruned ensemble to {0}\n".format(args.dump_to))
+    archive.save_ensemble(args.dump_to, new_members, new_ensemble,
+            new_ensemble.params)
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+"""
+Serve the predictions of a stored ensemble over HTTP or a unix socket
+
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+All code released under GPLv2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a stored ensemble. '
+        'POST {"x": [rows]} to /predict, GET /stats for the throughput and '
+        'latency percentiles')
+    parser.add_argument('ensemble_file', help='the stored ensemble (an '
+                        'archive directory or a .pkl file)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on')
+    parser.add_argument('--unix-socket', default=None,
+                        help='listen on this unix socket instead of a port')
+    parser.add_argument('--max-batch-size', type=int, default=256,
+                        help='most rows predicted together')
+    parser.add_argument('--max-latency', type=float, default=10.,
+                        help='most milliseconds a request waits for others '
+                        'to join its batch')
+    parser.add_argument('--eval-batch-size', type=int, default=None,
+                        help='batch size of the member models (by default, '
+                        'the ensemble\'s eval_batch_size)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='number of TensorFlow intra and inter-op threads')
+    args = parser.parse_args()
+
+    from toupee import serving
+
+    def load_predictor():
+        if args.threads is not None:
+            from toupee.autotune import use_threads
+            use_threads(args.threads)
+        return serving.EnsemblePredictor(args.ensemble_file,
+                                         args.eval_batch_size)
+
+    print("\nLoading {0}".format(args.ensemble_file))
+    batcher = serving.MicroBatcher(load_predictor, args.max_batch_size,
+                                   args.max_latency / 1000.)
+    batcher.wait_ready()
+    if args.unix_socket is not None:
+        server = serving.unix_server(batcher, args.unix_socket)
+        print("Serving on {0}".format(args.unix_socket))
+    else:
+        server = serving.http_server(batcher, args.host, args.port)
+        print("Serving on http://{0}:{1}".format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        print("\nServed: {0}".format(batcher.stats.summary()))
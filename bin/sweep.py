@@ -0,0 +1,215 @@
+#!/usr/bin/python
+"""
+Run many ensemble experiments on the local machine, a few at a time
+
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+All code released under GPLv2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+
+def experiment_files(patterns):
+    '''
+    The experiment files given as files, directories (all their .yaml files)
+    or globs
+    '''
+
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.extend(sorted(glob.glob(os.path.join(pattern, '*.yaml'))))
+        else:
+            files.extend(sorted(glob.glob(pattern)))
+    return files
+
+
+def shared_dataset(dataset, set_files, shm_dir):
+    '''
+    Decompresses the .npz sets of a dataset once, into uncompressed .h5
+    files in shared memory, which all the jobs read through the same pages.
+    .h5 sets are used where they are. Returns the files and the directory
+    created for them (None if there is no new copy), which is removed again
+    if a set can't be decompressed.
+    '''
+
+    if all(f[-3:] == '.h5' for f in set_files):
+        return [os.path.join(dataset, f) for f in set_files], None
+
+    key = hashlib.sha1(os.path.abspath(dataset).encode('utf-8')).hexdigest()
+    shared_dir = os.path.join(shm_dir, 'toupee-sweep-' + key[:12])
+    created_dir = None
+    if not os.path.exists(shared_dir):
+        os.makedirs(shared_dir)
+        created_dir = shared_dir
+    shared_files = []
+    try:
+        for set_file in set_files:
+            source = os.path.join(dataset, set_file)
+            target = os.path.join(shared_dir,
+                                  os.path.splitext(set_file)[0] + '.h5')
+            if not os.path.exists(target):
+                print(("Decompressing {0} to {1}".format(source, target)))
+                with np.load(source) as data, \
+                        h5py.File(target + '.tmp', 'w') as f:
+                    for name in data.files:
+                        f.create_dataset(name, data = data[name])
+                os.replace(target + '.tmp', target)
+            shared_files.append(target)
+    except BaseException:
+        if created_dir is not None:
+            shutil.rmtree(created_dir, ignore_errors = True)
+        raise
+    return shared_files, created_dir
+
+
+def job_command(args, experiment, set_files, extra_args):
+    name = os.path.splitext(os.path.basename(experiment))[0]
+    command = [sys.executable, args.ensemble_script, experiment,
+               '--threads', str(args.threads_per_slot),
+               '--trainfile', set_files[0],
+               '--validfile', set_files[1],
+               '--testfile', set_files[2],
+               '--dump-to', os.path.join(args.output_dir, name),
+               '--checkpoint-to',
+                   os.path.join(args.output_dir, name + '.checkpoint')]
+    return name, command + extra_args
+
+
+def run_jobs(jobs, slots, output_dir):
+    '''
+    Runs the jobs (name, command) in at most slots processes at a time,
+    reporting each of them as it finishes
+    '''
+
+    pending = list(jobs)
+    running = {}
+    finished = []
+    sweep_start = time.time()
+    while pending or running:
+        while pending and len(running) < slots:
+            name, command = pending.pop(0)
+            log_file = open(os.path.join(output_dir, name + '.log'), 'w')
+            print(("[start] {0}".format(name)))
+            process = subprocess.Popen(command, stdout = log_file,
+                                       stderr = subprocess.STDOUT)
+            running[process] = (name, command, log_file, time.time())
+
+        time.sleep(1)
+        for process in list(running.keys()):
+            if process.poll() is None:
+                continue
+            name, command, log_file, start_time = running.pop(process)
+            log_file.close()
+            finished.append({'name': name,
+                             'command': command,
+                             'returncode': process.returncode,
+                             'seconds': time.time() - start_time})
+            print(("[{0}/{1}] {2}: {3} in {4:.0f}s ({5:.0f}s elapsed)".format(
+                len(finished), len(jobs), name,
+                'done' if process.returncode == 0 else
+                    'FAILED ({0})'.format(process.returncode),
+                finished[-1]['seconds'], time.time() - sweep_start)))
+    return finished
+
+
+def run_sweep(args, extra_args):
+    '''
+    Runs the experiments of args, each on the shared copy of its dataset,
+    and returns the finished jobs. The copies made for this sweep are
+    removed at the end, even if it fails, unless args.keep_shared is set.
+    '''
+
+    from toupee import config
+
+    set_files = [args.trainfile, args.validfile, args.testfile]
+    jobs = []
+    shared = {}
+    created_dirs = []
+    try:
+        for experiment in experiment_files(args.experiments):
+            dataset = config.load_parameters(experiment).dataset
+            if dataset not in shared:
+                shared[dataset], created_dir = shared_dataset(dataset,
+                    set_files, args.shm_dir)
+                if created_dir is not None:
+                    created_dirs.append(created_dir)
+            jobs.append(job_command(args, experiment, shared[dataset],
+                                    extra_args))
+
+        print(("\nRunning {0} experiments, {1} at a time with {2} threads "
+               "each\n".format(len(jobs), args.slots, args.threads_per_slot)))
+        return run_jobs(jobs, args.slots, args.output_dir)
+    finally:
+        #the copies would otherwise hold on to shared memory
+        if not args.keep_shared:
+            for created_dir in created_dirs:
+                shutil.rmtree(created_dir, ignore_errors = True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a sweep of ensemble '
+        'experiments. Arguments after -- are passed to bin/ensemble.py')
+    parser.add_argument('experiments', nargs='+',
+                        help='experiment files, directories or globs')
+    parser.add_argument('--slots', type=int, default=2,
+                        help='number of experiments running at the same time')
+    parser.add_argument('--threads-per-slot', type=int, default=None,
+                        help='TensorFlow threads of each experiment (by '
+                        'default, the cores divided by --slots)')
+    parser.add_argument('--output-dir', default='sweep',
+                        help='where the ensembles, logs and summary go')
+    parser.add_argument('--shm-dir', default=None,
+                        help='where the decompressed datasets are shared '
+                        '(by default /dev/shm, if available)')
+    parser.add_argument('--keep-shared', action='store_true',
+                        help='keep the decompressed datasets after the '
+                        'sweep, for the next one to reuse')
+    parser.add_argument('--testfile', default='test.npz',
+                        help='test set npz/h5 file name')
+    parser.add_argument('--validfile', default='valid.npz',
+                        help='valid set npz/h5 file name')
+    parser.add_argument('--trainfile', default='train.npz',
+                        help='training set npz/h5 file name')
+    argv = sys.argv[1:]
+    extra_args = []
+    if '--' in argv:
+        extra_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    args.ensemble_script = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'ensemble.py')
+
+    if args.threads_per_slot is None:
+        args.threads_per_slot = max(1, os.cpu_count() // args.slots)
+    if args.shm_dir is None:
+        args.shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') \
+            else tempfile.gettempdir()
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    args.output_dir = os.path.abspath(args.output_dir)
+
+    finished = run_sweep(args, extra_args)
+    summary_file = os.path.join(args.output_dir, 'sweep.json')
+    with open(summary_file, 'w') as f:
+        json.dump(finished, f, indent = 2)
+    failed = [job['name'] for job in finished if job['returncode'] != 0]
+    print(("\nSweep done, {0} failed {1}, summary in {2}".format(len(failed),
+        failed, summary_file)))
@@ -0,0 +1,56 @@
+import importlib.util
+import os
+import numpy
+import pytest
+from toupee import common
+
+class FixedModel:
+    """
+    A stand-in for a member's model, whose predictions are fixed: the input
+    rows are the indexes of the samples to predict
+    """
+
+    def __init__(self, proba):
+        self.proba = numpy.asarray(proba)
+        self.layers = [self]
+        self.output_shape = self.proba.shape
+
+    def predict_proba(self, X, batch_size = None):
+        if not isinstance(X, numpy.ndarray):
+            #a DataGenerator
+            X = numpy.concatenate([X[i] for i in range(len(X))])
+        return self.proba[X[:, 0].astype(int)].copy()
+
+    predict = predict_proba
+
+
+@pytest.fixture
+def fixed_members(monkeypatch):
+    """
+    Makes the members predict fixed outputs: called with the outputs of
+    each member, returns the members (named after their number) and the
+    inputs of the samples
+    """
+    def install(outputs):
+        models = dict(('member-{0}'.format(i), FixedModel(o))
+                      for i, o in enumerate(outputs))
+        monkeypatch.setattr(common, 'inference_model',
+                lambda m_yaml, m_weights: models[m_yaml])
+        members = [('member-{0}'.format(i), None)
+                   for i in range(len(outputs))]
+        X = numpy.arange(len(outputs[0]))[:, numpy.newaxis]
+        return members, X
+    return install
+
+
+@pytest.fixture
+def bin_script():
+    """Loads a script of bin/ as a module, called with its name"""
+    def load(name):
+        path = os.path.join(os.path.dirname(__file__), '..', 'bin',
+                            name + '.py')
+        spec = importlib.util.spec_from_file_location(name + '_script', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
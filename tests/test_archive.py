@@ -0,0 +1,114 @@
+import os
+import pickle
+import numpy
+from toupee import archive
+from toupee import common
+from toupee.ensemble_methods import AveragingRunner, SammeProba
+from toupee.parameters import Parameters
+
+class TestArchive:
+
+    def setup_method(self, method):
+        rng = numpy.random.RandomState(0)
+        self.weights = [rng.randn(3, 2).astype('float32'),
+                        numpy.zeros(2, dtype='float32')]
+
+    def test_members_round_trip(self, tmp_path):
+        location = str(tmp_path / 'ensemble')
+        stored = archive.EnsembleArchive(location, 'w')
+        stored.write_member(0, 'model: 0', self.weights,
+                metadata = {'score': 0.5})
+        stored.write_member(1, 'model: 1',
+                common.QuantizedWeights(self.weights, 'int8'))
+
+        loaded = archive.EnsembleArchive(location)
+        members = loaded.members
+        assert len(members) == 2
+        m_yaml, m_weights = members[0]
+        assert m_yaml == 'model: 0'
+        assert isinstance(m_weights[0], numpy.memmap)
+        numpy.testing.assert_array_equal(m_weights[0], self.weights[0])
+        m_yaml, m_weights = members[1]
+        assert isinstance(m_weights, common.QuantizedWeights)
+        dequantized = common.dequantize_weights(m_weights)
+        numpy.testing.assert_allclose(dequantized[0], self.weights[0],
+                atol = 0.05)
+        assert loaded.index['members'][0]['metadata'] == {'score': 0.5}
+
+    def test_resumed_archive_keeps_members(self, tmp_path):
+        location = str(tmp_path / 'ensemble')
+        archive.EnsembleArchive(location, 'w').write_member(0, 'model: 0',
+                self.weights)
+        resumed = archive.EnsembleArchive(location, 'a')
+        resumed.write_member(1, 'model: 1', self.weights)
+        assert len(archive.EnsembleArchive(location).members) == 2
+
+    def test_member_store_spills_oldest(self, tmp_path):
+        nbytes = sum(w.nbytes for w in self.weights)
+        store = archive.MemberStore(2 * nbytes, str(tmp_path / 'spill'))
+        for i in range(4):
+            store.append(('model: {0}'.format(i), self.weights))
+        assert len(store) == 4
+        assert store.n_spilled == 2
+        assert store.resident_bytes == 2 * nbytes
+        m_yaml, m_weights = store[0]
+        assert m_yaml == 'model: 0'
+        numpy.testing.assert_array_equal(m_weights[1], self.weights[1])
+        assert [m[0] for m in store[1:3]] == ['model: 1', 'model: 2']
+
+    def test_member_store_resumes_and_closes(self, tmp_path):
+        nbytes = sum(w.nbytes for w in self.weights)
+        spill_dir = str(tmp_path / 'run.checkpoint.members')
+        store = archive.MemberStore(nbytes, spill_dir)
+        for i in range(3):
+            store.append(('model: {0}'.format(i), self.weights))
+        resumed = pickle.loads(pickle.dumps(store))
+        assert resumed.n_spilled == 2
+        assert resumed[0][0] == 'model: 0'
+        numpy.testing.assert_array_equal(resumed[1][1][0], self.weights[0])
+        resumed.close()
+        assert not os.path.exists(spill_dir)
+
+    def test_member_store_spills_to_given_archive(self, tmp_path):
+        nbytes = sum(w.nbytes for w in self.weights)
+        location = str(tmp_path / 'ensemble')
+        stored = archive.EnsembleArchive(location, 'w')
+        store = archive.MemberStore(nbytes, str(tmp_path / 'spill'),
+                                    archive = stored)
+        for i in range(3):
+            store.append(('model: {0}'.format(i), self.weights))
+            #only members already in the archive are dropped
+            assert store.n_spilled == i
+            stored.write_member(i, 'model: {0}'.format(i), self.weights)
+            store.spill()
+            assert store.n_spilled == i
+        assert not os.path.exists(str(tmp_path / 'spill'))
+        assert store.resident_bytes == nbytes
+        assert store[1][0] == 'model: 1'
+        numpy.testing.assert_array_equal(store[0][1][0], self.weights[0])
+        store.close()
+        assert len(archive.EnsembleArchive(location).members) == 3
+
+    def test_wrapped_aggregator_round_trip(self, tmp_path, fixed_members):
+        members, X = fixed_members([[[0.2, 0.8], [0.6, 0.4]],
+                                    [[0.7, 0.3], [0.1, 0.9]]])
+        members = [(m_yaml, self.weights) for m_yaml, _ in members]
+        params = Parameters(batch_size = 2, eval_batch_size = None)
+        ensemble = AveragingRunner(members, params, SammeProba(2))
+        location = str(tmp_path / 'ensemble')
+        archive.save_ensemble(location, members, ensemble, params)
+        loaded_members, loaded = archive.load_ensemble(location)
+        numpy.testing.assert_allclose(loaded.predict_proba(X),
+                ensemble.predict_proba(X))
+
+    def test_truncate(self, tmp_path):
+        location = str(tmp_path / 'ensemble')
+        stored = archive.EnsembleArchive(location, 'w')
+        for i in range(3):
+            stored.write_member(i, 'model: {0}'.format(i), self.weights)
+        resumed = archive.EnsembleArchive(location, 'a')
+        resumed.truncate(1)
+        assert len(archive.EnsembleArchive(location).members) == 1
+        assert not os.path.exists(os.path.join(location, 'member-1'))
+        assert not os.path.exists(os.path.join(location, 'member-2.yaml'))
+        resumed.write_member(1, 'model: 1', self.weights)
@@ -0,0 +1,56 @@
+import keras
+import numpy
+from toupee import autotune, common
+from toupee.parameters import Parameters
+
+def small_model(params):
+    model = keras.models.Sequential()
+    model.add(keras.layers.Dense(2, activation = 'softmax',
+                                 input_shape = (4,)))
+    model.compile(optimizer = 'sgd', loss = params.cost_function)
+    return model
+
+class TestAutotune:
+
+    def setup_method(self, method):
+        self.params = Parameters(batch_size = 4,
+                                 cost_function = 'categorical_crossentropy',
+                                 autotune = {'threads': [1],
+                                             'eval_batch_sizes': [4, 8],
+                                             'steps': 2})
+
+    def data_files(self, n_samples):
+        rng = numpy.random.RandomState(0)
+        return [{'x': rng.randn(n_samples, 4).astype('float32'),
+                 'y': numpy.eye(2)[numpy.arange(n_samples) % 2]}
+                for _ in range(3)]
+
+    def test_samples_per_second(self):
+        batches = []
+        holder = common.DataGenerator(self.data_files(20)[0], 4, None,
+                                      hold_y = False)
+        assert autotune._samples_per_second(batches.append, holder, 10) > 0
+        #a warm-up batch, then the remaining four
+        assert len(batches) == 5
+        small = common.DataGenerator(self.data_files(4)[0], 4, None)
+        assert autotune._samples_per_second(batches.append, small, 10) \
+            is None
+
+    def test_chooses_settings(self, monkeypatch):
+        monkeypatch.setattr(autotune, '_compiled_model', small_model)
+        autotune.autotune(self.params, self.data_files(64))
+        assert self.params.threads == 1
+        assert self.params.batch_size == 4
+        assert self.params.eval_batch_size in (4, 8)
+        report = self.params.autotune_report
+        assert report['chosen']['eval_batch_size'] == \
+            self.params.eval_batch_size
+        assert sorted((s['mode'], s['batch_size'])
+                      for s in report['samples']) == \
+            [('inference', 4), ('inference', 8), ('training', 4)]
+
+    def test_too_small_keeps_defaults(self, monkeypatch):
+        monkeypatch.setattr(autotune, '_compiled_model', small_model)
+        autotune.autotune(self.params, self.data_files(4))
+        assert 'eval_batch_size' not in self.params.__dict__
+        assert self.params.batch_size == 4
@@ -0,0 +1,19 @@
+import pickle
+import time
+from toupee.budget import BudgetScheduler
+from toupee.parameters import Parameters
+
+class TestBudgetScheduler:
+
+    def test_resumed_clocks(self):
+        scheduler = BudgetScheduler(Parameters(
+                budget = {'wall_hours': 1., 'cpu_hours': 1.},
+                n_epochs = 10, ensemble_size = 3))
+        scheduler.wall_start -= 600.
+        scheduler.cpu_start -= 300.
+        resumed = pickle.loads(pickle.dumps(scheduler))
+        wall_used = time.time() - resumed.wall_start
+        cpu_used = time.process_time() - resumed.cpu_start
+        assert 600. <= wall_used < 660.
+        assert 300. <= cpu_used < 360.
+        assert resumed.remaining() < 0.95 * 3600. - 600.
@@ -0,0 +1,33 @@
+import argparse
+import os
+import pytest
+from toupee.parameters import Parameters
+
+class TestRunCheckpoint:
+
+    @pytest.fixture(autouse = True)
+    def load_ensemble(self, bin_script):
+        self.ensemble = bin_script('ensemble')
+
+    def args(self, params_file):
+        return argparse.Namespace(params_file = params_file,
+                                  no_checkpoint = False, checkpoint_to = None)
+
+    def test_resume_own_checkpoint_only(self, tmp_path):
+        params = Parameters(dataset = str(tmp_path), random_seed = 42)
+        args = self.args(str(tmp_path / 'bagging.yaml'))
+        location = self.ensemble.checkpoint_location(args, params)
+        assert location == str(tmp_path / 'bagging-seed42.checkpoint')
+        self.ensemble.save_checkpoint(location, {
+            'params_file': os.path.abspath(args.params_file),
+            'random_seed': 42, 'n_members': 3})
+        assert self.ensemble.load_checkpoint(location, args,
+                                             params)['n_members'] == 3
+
+        other_seed = Parameters(dataset = str(tmp_path), random_seed = 43)
+        assert self.ensemble.checkpoint_location(args, other_seed) != location
+        with pytest.raises(ValueError):
+            self.ensemble.load_checkpoint(location, args, other_seed)
+        with pytest.raises(ValueError):
+            self.ensemble.load_checkpoint(location,
+                self.args(str(tmp_path / 'adaboost.yaml')), params)
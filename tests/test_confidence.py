@@ -0,0 +1,27 @@
+import numpy
+from toupee import common
+
+class ConcatenatingClassifier:
+    """Predicts its inputs, reading them batch by batch"""
+
+    def predict_proba(self, holder):
+        return numpy.concatenate([holder[i] for i in range(len(holder))])
+
+class TestConfidence:
+
+    def setup_method(self, method):
+        rng = numpy.random.RandomState(0)
+        self.proba = rng.dirichlet(numpy.ones(3), 7).astype('float32')
+        self.y = numpy.asarray([2, 0, 1, 1, 2, 0, 2])
+        self.expected = [self.proba[i, c] for i, c in enumerate(self.y)]
+
+    def test_one_hot_labels(self):
+        data_file = {'x': self.proba, 'y': numpy.eye(3)[self.y]}
+        h = common.confidence(ConcatenatingClassifier(), data_file, 3)
+        numpy.testing.assert_allclose(h, self.expected)
+
+    def test_precomputed_labels(self):
+        #the labels given are used instead of those of the file
+        data_file = {'y': numpy.zeros((7, 3))}
+        h = common.true_class_proba(self.proba, data_file, self.y)
+        numpy.testing.assert_allclose(h, self.expected)
@@ -0,0 +1,35 @@
+import numpy
+from toupee import common
+
+class ConcatenatingClassifier:
+    """Predicts its inputs, reading them batch by batch"""
+
+    def predict_proba(self, holder):
+        return numpy.concatenate([holder[i] for i in range(len(holder))])
+
+class TestDataGeneratorStats:
+
+    def test_counts_evaluation_reads(self, tmp_path):
+        x = numpy.arange(40, dtype = 'float32').reshape((10, 4))
+        file_name = str(tmp_path / 'set.npz')
+        numpy.savez(file_name, x = x, y = numpy.eye(2)[numpy.arange(10) % 2])
+        stats = common.DataGeneratorStats()
+        with numpy.load(file_name) as set_file:
+            proba = common.get_probabilities(ConcatenatingClassifier(),
+                set_file, 4, stats = stats)
+            common.get_probabilities(ConcatenatingClassifier(), set_file, 4,
+                numpy.asarray([1, 5, 6]), stats = stats)
+        assert proba.tolist() == x.tolist()
+        summary = stats.summary()
+        assert summary['batches'] == 4
+        assert summary['rows'] == 13
+        assert summary['bytes_read'] == (10 + 6) * 16
+
+    def test_expands_integer_labels(self):
+        x = numpy.arange(10, dtype = 'float32')[:, numpy.newaxis]
+        y = numpy.asarray([0, 2, 1, 2, 0, 1, 1, 0, 2, 2], dtype = 'int32')
+        holder = common.DataGenerator({'x': x, 'y': y, 'n_classes': 3}, 4,
+                                      None)
+        assert holder.n_classes == 3
+        batch_y = numpy.concatenate([holder[i][1] for i in range(len(holder))])
+        assert batch_y.tolist() == numpy.eye(3)[y].tolist()
@@ -0,0 +1,107 @@
+import numpy
+from toupee import mlp
+from toupee.ensemble_methods import MajorityVotingRunner, WeightedAveragingRunner
+from toupee.ensemble_methods import Bagging
+from toupee.parameters import Parameters
+
+class TestMajorityVotingRunner:
+
+    def test_accumulate_matches_predict_proba(self, fixed_members):
+        # two confident wrong members against three barely right ones: the
+        # hard votes and the summed probabilities disagree on sample 0
+        outputs = [numpy.asarray([[0.05, 0.95], [0.9, 0.1]])] * 2 + \
+                  [numpy.asarray([[0.55, 0.45], [0.9, 0.1]])] * 3
+        members, X = fixed_members(outputs)
+        ensemble = MajorityVotingRunner(members,
+                Parameters(batch_size = 2, eval_batch_size = None))
+        running = None
+        for i, proba in enumerate(outputs):
+            running = ensemble.accumulate(running, proba, i)
+        assert running.argmax(axis=-1).tolist() == \
+            ensemble.predict_classes(X).tolist()
+        assert running.argmax(axis=-1).tolist() == [1, 0]
+
+class TestCascade:
+
+    def ensembles(self, fixed_members, outputs, weights):
+        members, X = fixed_members(outputs)
+        params = Parameters(batch_size = 2, eval_batch_size = None)
+        return (WeightedAveragingRunner(members, weights, params),
+                WeightedAveragingRunner(members, weights, params,
+                                        cascade = True), X)
+
+    def test_same_predictions(self, fixed_members):
+        # sample 0 exits after the first member (its margin of 3 can't be
+        # overturned by the remaining weight of 2), samples 1 to 3 have no
+        # margin and need every member
+        outputs = [[[0., 1.], [0.5, 0.5], [0.6, 0.4], [0.4, 0.6]],
+                   [[1., 0.], [0.9, 0.1], [0.2, 0.8], [0.5, 0.5]],
+                   [[1., 0.], [0.3, 0.7], [0.1, 0.9], [0.7, 0.3]]]
+        full, cascade, X = self.ensembles(fixed_members, outputs,
+                                          [3., 1., 1.])
+        assert cascade.predict(X).tolist() == full.predict(X).tolist()
+        proba = cascade.predict_proba(X)
+        assert cascade.mean_members_evaluated == 2.5
+        numpy.testing.assert_allclose(proba.sum(axis = 1), 1.)
+        numpy.testing.assert_allclose(proba[0], [0., 1.])
+        numpy.testing.assert_allclose(proba[1:], full.predict_proba(X)[1:])
+
+    def test_no_margin(self, fixed_members):
+        outputs = [[[0.5, 0.5], [0.4, 0.6]]] * 2 + [[[0.6, 0.4], [0.5, 0.5]]]
+        full, cascade, X = self.ensembles(fixed_members, outputs,
+                                          [1., 1., 0.5])
+        assert cascade.predict(X).tolist() == full.predict(X).tolist()
+        numpy.testing.assert_allclose(cascade.predict_proba(X),
+                                      full.predict_proba(X))
+        assert cascade.mean_members_evaluated == 3.
+
+class TrainedLayer:
+
+    def __init__(self, value):
+        self.value = value
+
+    def get_weights(self):
+        return [numpy.full(2, self.value)]
+
+class TrainedModel:
+
+    def __init__(self, value):
+        self.layers = [TrainedLayer(value)]
+
+class TestWarmStart:
+
+    def train(self, monkeypatch, warm_start, n_members):
+        calls = []
+        def sequential_model(dataset, params, member_number = None,
+                             model_weights = None, model_weights_file = None,
+                             return_evaluations = False):
+            calls.append((params, model_weights, model_weights_file))
+            return TrainedModel(member_number), None
+        monkeypatch.setattr(mlp, 'sequential_model', sequential_model)
+        self.params = Parameters(random_seed = 1, n_epochs = 10,
+                                 optimizer = {'config': {'lr': 0.1}},
+                                 warm_start = warm_start)
+        method = Bagging()
+        method.prepare(self.params, 10)
+        for i in range(n_members):
+            method.member_number = i
+            method.train_member(None)
+        return calls
+
+    def test_from_previous(self, monkeypatch):
+        calls = self.train(monkeypatch, {'n_epochs': 2, 'lr': 0.01}, 3)
+        #the first member starts from scratch, with the experiment's params
+        assert calls[0] == (self.params, None, None)
+        for i, (params, model_weights, _) in enumerate(calls[1:]):
+            assert model_weights[0][0].tolist() == [i, i]
+            assert params.n_epochs == 2
+            assert params.optimizer['config']['lr'] == 0.01
+        assert self.params.n_epochs == 10
+        assert self.params.optimizer['config']['lr'] == 0.1
+
+    def test_from_file(self, monkeypatch):
+        calls = self.train(monkeypatch, {'from': 'base.h5'}, 2)
+        for params, model_weights, model_weights_file in calls:
+            assert model_weights is None
+            assert model_weights_file == 'base.h5'
+            assert params.n_epochs == 10
@@ -0,0 +1,60 @@
+import keras
+import numpy
+import pytest
+from toupee import common
+
+class TestEvaluation:
+
+    def setup_method(self, method):
+        self.proba = numpy.asarray([[0.7, 0.2, 0.1],
+                                    [0.1, 0.8, 0.1],
+                                    [0.5, 0.25, 0.25],
+                                    [0.2, 0.2, 0.6]], dtype = 'float32')
+        self.labels = numpy.asarray([0, 1, 2, 2])
+
+    def test_single_pass(self):
+        evaluation = common.Evaluation(self.proba, None,
+            'categorical_crossentropy', self.labels)
+        assert evaluation.errors.tolist() == [0, 0, 1, 0]
+        assert evaluation.accuracy == 0.75
+        numpy.testing.assert_allclose(evaluation.confidence,
+            [0.7, 0.8, 0.25, 0.6], rtol = 1e-6)
+        expected_loss = -numpy.log([0.7, 0.8, 0.25, 0.6]).mean()
+        assert evaluation.loss == pytest.approx(expected_loss, rel = 1e-6)
+        assert evaluation.metrics() == [evaluation.loss, 0.75]
+
+    def test_penalty_and_extra_metrics(self):
+        evaluation = common.Evaluation(self.proba, None,
+            'categorical_crossentropy', self.labels, penalty = 0.5,
+            extra_metrics = ['categorical_accuracy'])
+        plain = common.Evaluation(self.proba, None,
+            'categorical_crossentropy', self.labels)
+        assert evaluation.loss == pytest.approx(plain.loss + 0.5)
+        loss, accuracy, categorical_accuracy = evaluation.metrics()
+        assert categorical_accuracy == pytest.approx(0.75)
+
+    def test_binary(self):
+        proba = numpy.asarray([[0.9], [0.4], [0.3]])
+        evaluation = common.Evaluation(proba, None, None, [1, 1, 0])
+        assert evaluation.errors.tolist() == [0, 1, 0]
+        numpy.testing.assert_allclose(evaluation.confidence, [0.9, 0.4, 0.7])
+        assert evaluation.loss is None
+
+    def test_matches_keras(self, tmp_path):
+        rng = numpy.random.RandomState(0)
+        x = rng.rand(30, 4).astype('float32')
+        y = numpy.eye(3)[rng.randint(0, 3, 30)].astype('float32')
+        file_name = str(tmp_path / 'set.npz')
+        numpy.savez(file_name, x = x, y = y)
+        model = keras.models.Sequential()
+        model.add(keras.layers.Dense(3, activation = 'softmax',
+            input_shape = (4,),
+            kernel_regularizer = keras.regularizers.l2(0.1)))
+        model.compile(optimizer = 'sgd', loss = 'categorical_crossentropy',
+                      metrics = ['accuracy', 'top_k_categorical_accuracy'])
+        with numpy.load(file_name) as set_file:
+            evaluation = common.evaluate(model, set_file, 8,
+                'categorical_crossentropy',
+                extra_metrics = ['top_k_categorical_accuracy'])
+        numpy.testing.assert_allclose(evaluation.metrics(),
+            model.evaluate(x, y, batch_size = 8, verbose = 0), rtol = 1e-5)
@@ -0,0 +1,42 @@
+import os
+import pytest
+from toupee import common
+
+class TestHooks:
+
+    def setup_method(self, method):
+        self.toupee = common.Toupee()
+        self.events = []
+        for event in common.hook_events:
+            self.toupee.add_hook(event,
+                lambda event, context: self.events.append((event, context)))
+
+    def test_member_lifecycle(self):
+        self.toupee.start_member(3)
+        callback = common.HooksCallback(self.toupee)
+        callback.on_epoch_begin(0)
+        callback.on_epoch_end(0, {'loss': 0.5})
+        self.toupee.end_member(best_epoch = 0)
+        assert [e for e, _ in self.events] == ['reset', 'member_start',
+            'epoch_start', 'epoch_end', 'member_end']
+        for _, context in self.events:
+            assert context['member'] == 3
+            assert context['member_elapsed'] >= 0.
+            assert 'peak_rss_bytes' in context
+        assert self.events[3][1]['logs'] == {'loss': 0.5}
+        assert self.events[4][1]['best_epoch'] == 0
+
+    def test_failing_hook_is_skipped(self):
+        def failing(event, context):
+            raise RuntimeError('broken')
+        toupee = common.Toupee()
+        toupee.add_hook('epoch_end', failing)
+        toupee.add_epoch_hook(self.toupee.hooks['epoch_end'][0])
+        toupee.fire('epoch_end', epoch = 1)
+        assert [e for e, _ in self.events] == ['epoch_end']
+
+    def test_install_hooks(self):
+        self.toupee.install_hooks({'batch_fetch': ['os.path:join']})
+        assert os.path.join in self.toupee.hooks['batch_fetch']
+        with pytest.raises(ValueError):
+            self.toupee.install_hooks({'epoch': ['os.path:join']})
@@ -0,0 +1,38 @@
+import numpy
+from toupee import common
+from toupee.data import StratifiedResampler, integer_labels
+
+class TestLabelIndex:
+
+    def setup_method(self, method):
+        self.y = numpy.asarray([2, 0, 2, 1, 2, 0])
+        self.data_file = {'y': numpy.eye(3)[self.y]}
+
+    def test_scan(self):
+        index = common.label_index(self.data_file)
+        assert index.class_ids.tolist() == self.y.tolist()
+        assert index.counts.tolist() == [2, 1, 3]
+        assert index.rows(2).tolist() == [0, 2, 4]
+
+    def test_save_and_load(self, tmpdir):
+        index = common.LabelIndex.scan(self.data_file)
+        filename = str(tmpdir.join('train.npz.labels.npz'))
+        index.save(filename, '1:2')
+        assert common.LabelIndex.load(filename, '1:3') is None
+        loaded = common.LabelIndex.load(filename, '1:2')
+        assert loaded.counts.tolist() == index.counts.tolist()
+        assert loaded.rows(0).tolist() == [1, 5]
+
+    def test_stratified_resampler(self):
+        r = StratifiedResampler(common.label_index(self.data_file))
+        sample, _ = r.make_new_train(12)
+        assert numpy.bincount(self.y[sample]).tolist() == [4, 2, 6]
+
+    def test_integer_labels(self):
+        y, n_classes = integer_labels(self.data_file['y'])
+        assert y.dtype == numpy.int32
+        assert (y.tolist(), n_classes) == (self.y.tolist(), 3)
+        #n_classes, if stored, covers classes without samples
+        index = common.label_index({'y': y, 'n_classes': 4})
+        assert index.class_ids.tolist() == self.y.tolist()
+        assert index.counts.tolist() == [2, 1, 3, 0]
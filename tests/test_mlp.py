@@ -0,0 +1,128 @@
+import os
+import keras
+import numpy
+import pytest
+from toupee import common, mlp
+from toupee.parameters import Parameters
+
+class TestTrainingModels:
+
+    def setup_method(self, method):
+        model = keras.models.Sequential()
+        model.add(keras.layers.Dense(3, activation = 'relu',
+                                     input_shape = (4,)))
+        model.add(keras.layers.Dense(2, activation = 'softmax'))
+        self.model_yaml = model.to_yaml()
+
+    def test_random_while_training(self):
+        assert not mlp.random_while_training(
+            common.model_config(self.model_yaml))
+        model = keras.models.Sequential()
+        model.add(keras.layers.Dense(3, input_shape = (4,)))
+        model.add(keras.layers.Dropout(0.5))
+        assert mlp.random_while_training(
+            common.model_config(model.to_yaml()))
+
+    def test_initial_weights_only_depend_on_the_seed(self):
+        first = mlp.initial_weights(self.model_yaml, 5)
+        #the session builds more random ops in between
+        common.build_model(self.model_yaml)
+        again = mlp.initial_weights(self.model_yaml, 5)
+        other = mlp.initial_weights(self.model_yaml, 6)
+        for a, b in zip(first, again):
+            assert numpy.array_equal(a, b)
+        assert not numpy.array_equal(first[0], other[0])
+
+    def test_reinitialize_model(self):
+        model = common.build_model(self.model_yaml)
+        model.compile(optimizer = 'adam', loss = 'categorical_crossentropy')
+        x = numpy.ones((8, 4), dtype = 'float32')
+        y = numpy.eye(2)[numpy.arange(8) % 2]
+        model.fit(x, y, epochs = 1, verbose = 0)
+        mlp.reinitialize_model(model, self.model_yaml, 5)
+        for a, b in zip(model.get_weights(),
+                        mlp.initial_weights(self.model_yaml, 5)):
+            assert numpy.array_equal(a, b)
+        assert keras.backend.get_value(model.optimizer.iterations) == 0
+
+class TestSnapshots:
+
+    def setup_method(self, method):
+        model = keras.models.Sequential()
+        model.add(keras.layers.Dense(2, activation = 'softmax',
+                                     input_shape = (4,)))
+        self.model_yaml = model.to_yaml()
+
+    def params(self, tmp_path, resume_snapshot):
+        return Parameters(checkpoint_dir = str(tmp_path),
+                          snapshot_prefix = 'experiment-seed1',
+                          resume_snapshot = resume_snapshot)
+
+    def test_resume_from_snapshot(self, tmp_path):
+        params = self.params(tmp_path, 0)
+        save_to = mlp.snapshot_file(params, 0)
+        assert save_to == str(tmp_path / 'experiment-seed1-member-0.best.npz')
+        model = common.build_model(self.model_yaml)
+        checkpointer = common.ModelCheckpointInMemory(monitor = 'val_acc',
+            mode = 'max', save_to = save_to)
+        checkpointer.set_model(model)
+        checkpointer.on_train_begin()
+        checkpointer.on_epoch_end(0, {'val_acc': 0.25})
+        checkpointer.on_epoch_end(1, {'val_acc': 0.75})
+        checkpointer.close()
+
+        resumed = common.build_model(self.model_yaml)
+        resumed_checkpointer = common.ModelCheckpointInMemory(
+            monitor = 'val_acc', mode = 'max')
+        assert mlp.resume_snapshot(resumed, self.params(tmp_path, None), 0,
+                                   resumed_checkpointer) == 0
+        assert mlp.resume_snapshot(resumed, params, 0,
+                                   resumed_checkpointer) == 2
+        for a, b in zip(resumed.get_weights(), model.get_weights()):
+            assert numpy.array_equal(a, b)
+        resumed_checkpointer.set_model(resumed)
+        resumed_checkpointer.on_train_begin()
+        assert resumed_checkpointer.best_epoch == 1
+        assert resumed_checkpointer.best == 0.75
+
+        checkpointer.remove_snapshot()
+        assert not os.path.exists(save_to)
+
+class TestPostTrainingEvaluation:
+
+    def params(self, post_training_evaluation):
+        return Parameters(classification = True,
+                          cost_function = 'categorical_crossentropy',
+                          post_training_evaluation = post_training_evaluation,
+                          random_seed = 0, batch_size = 4)
+
+    def test_evaluation_modes(self):
+        assert mlp.evaluation_modes(self.params({'train': 5})) == \
+            {'train': 5, 'valid': 'full', 'test': 'full'}
+        for mode in ('half', 0, True):
+            with pytest.raises(ValueError):
+                mlp.evaluation_modes(self.params({'train': mode}))
+
+    def test_subsampled_and_skipped_sets(self):
+        model = keras.models.Sequential()
+        model.add(keras.layers.Dense(2, activation = 'softmax',
+                                     input_shape = (4,)))
+        model.compile(optimizer = 'sgd', loss = 'categorical_crossentropy',
+                      metrics = ['accuracy'])
+        rng = numpy.random.RandomState(0)
+        files = [{'x': rng.randn(10, 4).astype('float32'),
+                  'y': numpy.eye(2)[numpy.arange(10) % 2]} for _ in range(3)]
+        params = self.params({'train': 5, 'test': 'skip'})
+        evaluations, metrics, stats = mlp.evaluate_sets(model, params, files)
+        assert len(evaluations['train'].indexes) == 5
+        assert evaluations['valid'].indexes is None
+        assert evaluations['test'] is None and metrics[2] is None
+        assert common.full_evaluation(evaluations, 'train') is None
+        assert common.full_evaluation(evaluations, 'valid') is \
+            evaluations['valid']
+        assert stats['train'].summary()['rows'] == 5
+        assert sorted(stats) == ['train', 'valid']
+        #the same subsample for the same seed
+        again, _, _ = mlp.evaluate_sets(model, params, files)
+        assert again['train'].indexes.tolist() == \
+            evaluations['train'].indexes.tolist()
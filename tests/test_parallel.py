@@ -0,0 +1,76 @@
+import copy
+import numpy
+import keras
+from toupee import config, parallel
+from toupee.ensemble_methods import Bagging
+from toupee.parameters import Parameters
+
+class TestParallelBagging:
+
+    def setup_method(self, method):
+        rng = numpy.random.RandomState(0)
+        self.x = rng.rand(40, 4).astype('float32')
+        self.y = numpy.eye(2)[rng.randint(0, 2, 40)].astype('float32')
+        model = keras.models.Sequential()
+        model.add(keras.layers.Dense(2, activation = 'softmax',
+                                     input_shape = (4,)))
+        self.model_yaml = model.to_yaml()
+
+    def params(self, tmp_path):
+        model_file = str(tmp_path / 'dnn.model')
+        with open(model_file, 'w') as f:
+            f.write(self.model_yaml)
+        entries = copy.deepcopy(config.defaults)
+        entries.update({'model_file': model_file,
+                        'optimizer': {'class_name': 'SGD',
+                                      'config': {'lr': 0.1}},
+                        'cost_function': 'categorical_crossentropy',
+                        'n_epochs': 2, 'batch_size': 8, 'verbose': 0,
+                        'resample_size': 40, 'ensemble_size': 2,
+                        'random_seed': 7, 'threads': 1})
+        return Parameters(**entries)
+
+    def train(self, tmp_path, processes):
+        files = []
+        for name in ('train', 'valid', 'test'):
+            file_name = str(tmp_path / (name + '.npz'))
+            numpy.savez(file_name, x = self.x, y = self.y)
+            files.append(parallel.open_data_file(file_name))
+        params = self.params(tmp_path)
+        method = Bagging()
+        method.processes = processes
+        method.threads_per_process = 1
+        params.method = method
+        method.prepare(params, len(self.x))
+        drawn = []
+        train_indexes = method.train_indexes
+        def recording_train_indexes(data_files):
+            indexes = train_indexes(data_files)
+            drawn.append(indexes)
+            return indexes
+        method.train_indexes = recording_train_indexes
+        members = list(method.create_members(files, 2))
+        for f in files:
+            f.close()
+        return drawn, members
+
+    def test_parallel_run_is_serial_run(self, tmp_path):
+        serial_drawn, serial_members = self.train(tmp_path, None)
+        parallel_drawn, parallel_members = self.train(tmp_path, 2)
+        assert len(serial_drawn) == len(parallel_drawn) == 2
+        for s, p in zip(serial_drawn, parallel_drawn):
+            if s[0] is None:
+                assert p[0] is None
+            else:
+                assert numpy.array_equal(s[0], p[0])
+        for s, p in zip(serial_members, parallel_members):
+            assert len(s[1]) == len(p[1])
+            for s_w, p_w in zip(s[1], p[1]):
+                assert numpy.array_equal(s_w, p_w)
+
+    def test_member_seeds_of_consecutive_runs_differ(self):
+        seeds = [parallel.member_seed(Parameters(random_seed = s), i)
+                 for s in (42, 43) for i in range(10)]
+        assert len(set(seeds)) == len(seeds)
+        assert parallel.member_seed(Parameters(random_seed = 42), 3) == \
+            parallel.member_seed(Parameters(random_seed = 42), 3)
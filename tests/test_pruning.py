@@ -0,0 +1,32 @@
+import numpy
+from toupee import pruning
+
+class TestPruning:
+
+    def setup_method(self, method):
+        # three members on four samples: member 0 is always right, member 1
+        # is always wrong and member 2 is right on half of the samples
+        self.y = numpy.asarray([0, 1, 0, 1])
+        right = numpy.eye(2)[self.y] * 0.8 + 0.1
+        wrong = 1. - right
+        half = numpy.concatenate([right[:2], wrong[2:]])
+        self.predictions = numpy.asarray([right, wrong, half])
+        self.weights = numpy.ones(3)
+
+    def test_forward_selection(self):
+        selected, history = pruning.forward_selection(self.predictions,
+                self.weights, self.y, target_accuracy = 1.)
+        assert selected == [0]
+        assert history == [1.]
+
+    def test_backward_elimination(self):
+        selected, history = pruning.backward_elimination(self.predictions,
+                self.weights, self.y)
+        assert selected == [0]
+        assert history == [0.75, 1.]
+
+    def test_cost_constrained(self):
+        costs = numpy.asarray([10., 1., 1.])
+        selected, _ = pruning.forward_selection(self.predictions,
+                self.weights, self.y, costs = costs, budget = 2.)
+        assert selected == [2]
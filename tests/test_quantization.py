@@ -0,0 +1,35 @@
+import numpy
+import pytest
+from toupee import common
+
+class TestQuantizedWeights:
+
+    def setup_method(self, method):
+        rng = numpy.random.RandomState(0)
+        self.weights = [rng.randn(20, 10).astype('float32'),
+                        numpy.full(10, 0.3, dtype = 'float32'),
+                        numpy.arange(4, dtype = 'int64')]
+
+    def test_int8(self):
+        quantized = common.QuantizedWeights(self.weights, 'int8')
+        kernel, constant, ints = common.dequantize_weights(quantized)
+        step = (self.weights[0].max() - self.weights[0].min()) / 255.
+        assert numpy.abs(kernel - self.weights[0]).max() <= step / 2. + 1e-6
+        assert kernel.dtype == numpy.float32
+        numpy.testing.assert_allclose(constant, self.weights[1])
+        assert ints.tolist() == [0, 1, 2, 3]
+        assert quantized.nbytes < sum(w.nbytes for w in self.weights) / 3
+
+    def test_float16(self):
+        quantized = common.QuantizedWeights(self.weights, 'float16')
+        kernel = common.dequantize_weights(quantized)[0]
+        numpy.testing.assert_allclose(kernel, self.weights[0], rtol = 1e-3)
+
+    def test_members(self):
+        members = [('model', self.weights)]
+        assert common.quantize_members(members, 'float32') is members
+        m_yaml, m_weights = common.quantize_members(members, 'int8')[0]
+        assert m_yaml == 'model'
+        assert m_weights.precision == 'int8'
+        with pytest.raises(ValueError):
+            common.QuantizedWeights(self.weights, 'int4')
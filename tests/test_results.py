@@ -0,0 +1,30 @@
+import json
+import sqlite3
+import numpy
+from toupee import results
+
+class TestResultsSink:
+
+    def test_jsonl_records(self, tmp_path):
+        path = str(tmp_path / 'results.jsonl')
+        sink = results.ResultsSink(results.JsonlBackend(path), 'run-1',
+                batch_size = 2)
+        for epoch in range(3):
+            sink.record('epoch', {'epoch': epoch,
+                                  'logs': {'acc': numpy.float32(0.5)}})
+        sink.close()
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        assert [r['epoch'] for r in records] == [0, 1, 2]
+        assert records[0]['run'] == 'run-1'
+        assert records[0]['kind'] == 'epoch'
+        assert records[0]['logs']['acc'] == 0.5
+
+    def test_sqlite_records(self, tmp_path):
+        path = str(tmp_path / 'results.sqlite')
+        sink = results.ResultsSink(results.SqliteBackend(path), 'run-1')
+        sink.record('member', {'member': 0})
+        sink.close()
+        rows = sqlite3.connect(path).execute(
+                'SELECT run, kind FROM records').fetchall()
+        assert rows == [('run-1', 'member')]
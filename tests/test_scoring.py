@@ -0,0 +1,70 @@
+import pickle
+import numpy
+from toupee import common, scoring
+from toupee.ensemble_methods import MajorityVotingRunner
+from toupee.parameters import Parameters
+
+class SummingEnsemble:
+
+    def accumulate(self, running, proba, index):
+        if running is None:
+            return numpy.array(proba, dtype='float64')
+        return running + proba
+
+class TestIntermediateScorer:
+
+    def setup_method(self, method):
+        self.y = numpy.asarray([0, 1, 0, 1])
+        self.files = [{'y': numpy.eye(2)[self.y]}] * 3
+        self.right = numpy.eye(2)[self.y] * 0.8 + 0.1
+        self.wrong = 1. - self.right
+
+    def scorer(self, **settings):
+        params = Parameters(intermediate_scoring = settings,
+                            ensemble_size = 3, random_seed = 1)
+        return scoring.IntermediateScorer(params, self.files)
+
+    def evaluations(self, proba, indexes = None):
+        return {'valid': common.Evaluation(proba, self.files[1],
+                                           labels = self.y, indexes = indexes)}
+
+    def test_cached_scores(self):
+        scorer = self.scorer(split = 'valid', every = 2,
+                             scorers = ['accuracy', 'error'])
+        ensemble = SummingEnsemble()
+        assert scorer.add_member(ensemble, self.evaluations(self.right),
+                                 self.files, 2) is None
+        assert scorer.needs_final_score()
+        score = scorer.add_member(ensemble, self.evaluations(self.right),
+                                  self.files, 2)
+        assert score == [1., 0.]
+        assert not scorer.needs_final_score()
+
+    def test_subsample(self):
+        scorer = self.scorer(split = 'valid', subsample = 2)
+        assert len(scorer.indexes) == 2
+        assert scorer.labels.tolist() == self.y[scorer.indexes].tolist()
+        score = scorer.add_member(SummingEnsemble(),
+                                  self.evaluations(self.wrong), self.files, 2)
+        assert score == [0.]
+        assert scorer.use_cached_outputs
+
+    def test_resumed_scorer(self, fixed_members):
+        outputs = [self.right, self.wrong, self.right]
+        members, X = fixed_members(outputs)
+        ensemble = MajorityVotingRunner(members,
+            Parameters(batch_size = 2, eval_batch_size = None))
+        files = [{'x': X, 'y': numpy.eye(2)[self.y]}] * 3
+        scorer = self.scorer(split = 'valid', scorers = ['nll'])
+        scores = []
+        for i in range(2):
+            scores.append(scorer.add_member(ensemble,
+                self.evaluations(outputs[i]), files, 2))
+        resumed = pickle.loads(pickle.dumps(scorer))
+        assert resumed.running_output is None
+        score = resumed.add_member(ensemble, self.evaluations(outputs[2]),
+                                   files, 2)
+        scorer.add_member(ensemble, self.evaluations(outputs[2]), files, 2)
+        numpy.testing.assert_allclose(resumed.running_output,
+                                      scorer.running_output)
+        assert score == scorer.score(ensemble, files, 2)
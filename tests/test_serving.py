@@ -0,0 +1,76 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import numpy
+import pytest
+from toupee import serving
+
+def double():
+    return lambda x: x * 2.
+
+class RejectNaN:
+    input_shape = (3,)
+
+    def __call__(self, x):
+        if numpy.isnan(x).any():
+            raise ValueError("NaN input")
+        return x * 2.
+
+class TestMicroBatcher:
+
+    def test_coalesces_requests(self):
+        batcher = serving.MicroBatcher(double, max_batch_size = 100,
+                                       max_latency = 0.2)
+        batcher.wait_ready()
+        requests = [batcher.submit(numpy.full((2, 3), i)) for i in range(4)]
+        outputs = [r.result(5.) for r in requests]
+        batcher.close()
+        for i, output in enumerate(outputs):
+            assert output.tolist() == numpy.full((2, 3), 2. * i).tolist()
+        stats = batcher.stats.summary()
+        assert stats['requests'] == 4
+        assert stats['rows'] == 8
+        assert stats['batches'] == 1
+        assert 'latency_p99_ms' in stats
+
+    def test_bad_requests(self):
+        batcher = serving.MicroBatcher(RejectNaN, max_batch_size = 100,
+                                       max_latency = 0.2)
+        batcher.wait_ready()
+        for x in ([1., 2., 3.], numpy.zeros((0, 3)), [[1., 2.]]):
+            with pytest.raises(ValueError):
+                batcher.submit(x)
+        good = batcher.submit(numpy.ones((2, 3)))
+        bad = batcher.submit([[1., numpy.nan, 3.]])
+        assert good.result(5.).tolist() == numpy.full((2, 3), 2.).tolist()
+        with pytest.raises(ValueError):
+            bad.result(5.)
+        batcher.close()
+        assert batcher.stats.summary()['errors'] == 1
+
+    def test_http(self):
+        batcher = serving.MicroBatcher(double)
+        batcher.wait_ready()
+        server = serving.http_server(batcher, port = 0)
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+        request = urllib.request.Request(url + '/predict',
+                data = json.dumps({'x': [[0.1, 0.4]]}).encode('utf-8'))
+        with urllib.request.urlopen(request) as response:
+            answer = json.loads(response.read().decode('utf-8'))
+        request = urllib.request.Request(url + '/predict',
+                data = json.dumps({'x': [0.1, 0.4]}).encode('utf-8'))
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        assert error.value.code == 400
+        with urllib.request.urlopen(url + '/stats') as response:
+            stats = json.loads(response.read().decode('utf-8'))
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+        assert numpy.allclose(answer['probabilities'], [[0.2, 0.8]])
+        assert answer['classes'] == [1]
+        assert stats['requests'] == 1
@@ -0,0 +1,44 @@
+import numpy
+from toupee import streaming
+
+class TestStreaming:
+
+    def setup_method(self, method):
+        self.x = numpy.arange(60, dtype='float32').reshape((20, 3))
+
+    def test_npz_chunks(self, tmp_path):
+        path = str(tmp_path / 'input.npz')
+        numpy.savez_compressed(path, x = self.x, y = self.x[:, 0])
+        input_set = streaming.open_input(path)
+        assert len(input_set) == 20
+        assert input_set.read(0, 7).tolist() == self.x[0:7].tolist()
+        assert input_set.read(12, 30).tolist() == self.x[12:].tolist()
+        #going back starts over
+        assert input_set.read(3, 5).tolist() == self.x[3:5].tolist()
+        input_set.close()
+
+    def test_resume_npy_output(self, tmp_path):
+        path = str(tmp_path / 'output.npy')
+        output = streaming.create_output(path, 'probabilities', (20, 3),
+                                         'float32')
+        output.write(0, self.x[:8])
+        output.commit(8)
+        output.write(8, numpy.zeros((4, 3)))
+        output.close()
+
+        output = streaming.resume_output(path, 'probabilities', 20)
+        assert output.rows_done == 8
+        output.write(8, self.x[8:])
+        output.commit(20)
+        output.close()
+        assert numpy.load(path).tolist() == self.x.tolist()
+
+    def test_resume_h5_output(self, tmp_path):
+        path = str(tmp_path / 'output.h5')
+        output = streaming.create_output(path, 'labels', (20,), 'int32')
+        output.write(0, numpy.ones(5))
+        output.commit(5)
+        output.close()
+        output = streaming.resume_output(path, 'labels', 20)
+        assert output.rows_done == 5
+        output.close()
@@ -0,0 +1,51 @@
+import argparse
+import os
+import numpy
+import pytest
+
+class TestSweep:
+
+    @pytest.fixture(autouse = True)
+    def load_sweep(self, bin_script, tmp_path):
+        self.sweep = bin_script('sweep')
+        self.dataset = tmp_path / 'dataset'
+        self.dataset.mkdir()
+        for name in ('train', 'valid', 'test'):
+            numpy.savez_compressed(str(self.dataset / (name + '.npz')),
+                x = numpy.ones((4, 2)), y = numpy.arange(4))
+        self.shm_dir = tmp_path / 'shm'
+        self.shm_dir.mkdir()
+        experiment = tmp_path / 'bagging.yaml'
+        experiment.write_text('dataset: {0}\n'.format(self.dataset))
+        script = tmp_path / 'ensemble.py'
+        script.write_text('import sys\nprint(sys.argv[1:])\n')
+        self.args = argparse.Namespace(experiments = [str(experiment)],
+            slots = 1, threads_per_slot = 1, output_dir = str(tmp_path),
+            shm_dir = str(self.shm_dir), keep_shared = False,
+            trainfile = 'train.npz', validfile = 'valid.npz',
+            testfile = 'test.npz', ensemble_script = str(script))
+
+    def test_shared_dataset(self):
+        set_files = ['train.npz', 'valid.npz', 'test.npz']
+        files, created_dir = self.sweep.shared_dataset(str(self.dataset),
+            set_files, str(self.shm_dir))
+        assert [os.path.dirname(f) for f in files] == [created_dir] * 3
+        assert all(f.endswith('.h5') for f in files)
+        #a later sweep reuses the copy without owning it
+        again, created_again = self.sweep.shared_dataset(str(self.dataset),
+            set_files, str(self.shm_dir))
+        assert (again, created_again) == (files, None)
+
+    def test_failed_copy_is_removed(self):
+        with pytest.raises(IOError):
+            self.sweep.shared_dataset(str(self.dataset),
+                ['train.npz', 'missing.npz'], str(self.shm_dir))
+        assert os.listdir(str(self.shm_dir)) == []
+
+    def test_copies_removed_after_the_sweep(self):
+        finished = self.sweep.run_sweep(self.args, [])
+        assert [job['returncode'] for job in finished] == [0]
+        assert os.listdir(str(self.shm_dir)) == []
+        self.args.keep_shared = True
+        self.sweep.run_sweep(self.args, [])
+        assert len(os.listdir(str(self.shm_dir))) == 1
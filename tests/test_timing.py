@@ -0,0 +1,35 @@
+import random
+from toupee import timing
+
+class TestTiming:
+
+    def test_phases_overall_and_per_member(self):
+        timer = timing.Timer()
+        timer.record('resample', 1., .5)
+        timer.set_member(0)
+        timer.record('training', 2., 1.5)
+        timer.record('training', 4., 3.)
+        with timer.phase('evaluation'):
+            pass
+        summary = timer.summary()
+        assert sorted(summary['phases']) == \
+            ['evaluation', 'resample', 'training']
+        training = summary['phases']['training']
+        assert training['count'] == 2
+        assert training['wall_total'] == 6.
+        assert training['cpu_total'] == 4.5
+        assert training['wall_mean'] == 3.
+        assert training['wall_max'] == 4.
+        #phases before the first member only count overall
+        assert sorted(summary['members']['0']) == ['evaluation', 'training']
+
+    def test_sample_is_bounded(self, monkeypatch):
+        monkeypatch.setattr(timing.PhaseStats, 'sample_size', 10)
+        stats = timing.PhaseStats(random.Random(0))
+        for i in range(100):
+            stats.add(float(i), 0.)
+        assert len(stats.samples) == 10
+        assert stats.count == 100
+        summary = stats.summary()
+        assert summary['wall_max'] == 99.
+        assert 0. <= summary['wall_p50'] <= 99.
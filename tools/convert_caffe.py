@@ -22,10 +22,12 @@ def load_file(filename):
         Y.append(label)
     return X,Y
 
-def save(where,set_x,set_y):
+def save(where,set_x,set_y,n_classes=None):
     set_x = numpy.asarray(set_x, dtype='float32')
     set_y = numpy.asarray(set_y, dtype='int32')
-    np.savez_compressed(where,x=set_x,y=set_y)
+    if n_classes is None:
+        n_classes = int(set_y.max()) + 1
+    np.savez_compressed(where,x=set_x,y=set_y,n_classes=n_classes)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert a Caffe/LMDB dataset')
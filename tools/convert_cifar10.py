@@ -22,6 +22,9 @@ if __name__ == '__main__':
     test_x = test['data']
     test_y = test['labels']
     print "... saving"
-    np.savez_compressed(fileName + 'train',x=merged_train_x,y=merged_train_y)
-    np.savez_compressed(fileName + 'valid',x=valid_x,y=valid_y)
-    np.savez_compressed(fileName + 'test',x=test_x,y=test_y)
+    np.savez_compressed(fileName + 'train',x=merged_train_x,
+            y=np.asarray(merged_train_y,dtype='int32'),n_classes=10)
+    np.savez_compressed(fileName + 'valid',x=valid_x,
+            y=np.asarray(valid_y,dtype='int32'),n_classes=10)
+    np.savez_compressed(fileName + 'test',x=test_x,
+            y=np.asarray(test_y,dtype='int32'),n_classes=10)
@@ -3,7 +3,7 @@
 import cPickle
 import numpy as np
 import argparse
-from toupee.data import one_hot
+from toupee.data import one_hot, integer_labels
 from matplotlib import pyplot
 
 def unpickle(file):
@@ -17,6 +17,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert a pylearn2 dataset')
     parser.add_argument('--dest', help='the destination for the dataset')
     parser.add_argument('--source', help='the source of the data')
+    parser.add_argument('--one-hot', action='store_true',
+            help='store y one-hot instead of as a vector of int32 classes')
     args = parser.parse_args()
 
     print "... saving"
@@ -38,9 +40,15 @@ if __name__ == '__main__':
         print "th to tf"
         x = np.transpose(x, (0, 2, 3, 1))
     y = unpickle(args.source + ".pkl")
-    y = one_hot(np.asarray(y.y))
+    if args.one_hot:
+        y = one_hot(np.asarray(y.y))
+    else:
+        y, n_classes = integer_labels(y.y)
     print x[0].shape
     pyplot.imshow(x[0])
     pyplot.show()
     exit(1)
-    np.savez_compressed(args.dest, x=x, y=y)
+    if args.one_hot:
+        np.savez_compressed(args.dest, x=x, y=y)
+    else:
+        np.savez_compressed(args.dest, x=x, y=y, n_classes=n_classes)
@@ -10,16 +10,18 @@ if __name__ == '__main__':
     if not os.path.exists(dest):
         os.mkdir(dest)
     shape = [int(x) for x in sys.argv[2].split(',')]
+    #pass "one-hot" as third argument to store the labels one-hot instead of
+    # as int32 classes
+    compact_labels = not (len(sys.argv) > 3 and sys.argv[3] == 'one-hot')
     dataset = data.load_data(location,
                              pickled = False,
-                             one_hot_y = True)
+                             one_hot_y = not compact_labels)
     print dataset[0][0].shape
-    np.savez_compressed(dest + 'train',
-            x=dataset[0][0].reshape([dataset[0][0].shape[0]] + shape),
-            y=dataset[0][1])
-    np.savez_compressed(dest + 'valid',
-            x=dataset[1][0].reshape([dataset[1][0].shape[0]] + shape),
-            y=dataset[1][1])
-    np.savez_compressed(dest + 'test',
-            x=dataset[2][0].reshape([dataset[2][0].shape[0]] + shape),
-            y=dataset[2][1])
+    for name, (set_x, set_y) in zip(['train', 'valid', 'test'], dataset):
+        set_x = set_x.reshape([set_x.shape[0]] + shape)
+        if compact_labels:
+            set_y, n_classes = data.integer_labels(set_y)
+            np.savez_compressed(dest + name, x=set_x, y=set_y,
+                    n_classes=n_classes)
+        else:
+            np.savez_compressed(dest + name, x=set_x, y=set_y)
@@ -3,7 +3,7 @@
 import cPickle
 import numpy as np
 import argparse
-from toupee.data import one_hot
+from toupee.data import one_hot, integer_labels
 from matplotlib import pyplot
 
 def unpickle(file):
@@ -22,6 +22,8 @@ if __name__ == '__main__':
             action='store_true')
     parser.add_argument('--th-to-tf', help='reorder dimensions from th to tf',
             action='store_true')
+    parser.add_argument('--one-hot', action='store_true',
+            help='store y one-hot instead of as a vector of int32 classes')
     args = parser.parse_args()
 
     print "... saving"
@@ -37,9 +39,15 @@ if __name__ == '__main__':
         print "th to tf"
         x = np.transpose(x, (0, 2, 3, 1))
     y = unpickle(args.source + ".pkl")
-    y = one_hot(np.asarray(y.y))
+    if args.one_hot:
+        y = one_hot(np.asarray(y.y))
+    else:
+        y, n_classes = integer_labels(y.y)
     print x[0].shape
     pyplot.imshow(x[20])
     pyplot.show()
     exit(1)
-    np.savez_compressed(args.dest, x=x, y=y)
+    if args.one_hot:
+        np.savez_compressed(args.dest, x=x, y=y)
+    else:
+        np.savez_compressed(args.dest, x=x, y=y, n_classes=n_classes)
@@ -108,9 +108,13 @@ if __name__ == "__main__":
         valid_y = Y[train_split:test_split]
         test_x = X[test_split:]
         test_y = Y[test_split:]
-    numpy.savez_compressed(args.dest + 'train',x=train_x,y=train_y)
-    numpy.savez_compressed(args.dest + 'valid',x=valid_x,y=valid_y)
-    numpy.savez_compressed(args.dest + 'test',x=test_x,y=test_y)
+    n_classes = int(max(max(train_y), max(valid_y), max(test_y))) + 1
+    numpy.savez_compressed(args.dest + 'train',x=train_x,
+            y=numpy.asarray(train_y,dtype='int32'),n_classes=n_classes)
+    numpy.savez_compressed(args.dest + 'valid',x=valid_x,
+            y=numpy.asarray(valid_y,dtype='int32'),n_classes=n_classes)
+    numpy.savez_compressed(args.dest + 'test',x=test_x,
+            y=numpy.asarray(test_y,dtype='int32'),n_classes=n_classes)
 
     print "{0} features, {1} classes, {2} training, {3} validation, {4} test".format(
         len(train_x[0]),
@@ -3,5 +3,6 @@ import toupee.ensemble_methods as ensemble_methods
 import toupee.mlp as mlp
 import toupee.parameters as parameters
 import toupee.config as config
+import toupee.pruning as pruning
 
 version = "0.1.0 alpha"
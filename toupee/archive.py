@@ -0,0 +1,333 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Ensembles stored as a directory, with members loaded on demand
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import collections.abc
+import json
+import os
+import shutil
+import tempfile
+
+import dill
+import numpy
+
+import toupee.common as common
+import toupee.parameters as parameters
+
+
+format_version = 1
+#the aggregators an archive can rebuild
+stored_aggregators = ('WeightedAveragingRunner', 'MajorityVotingRunner',
+                      'AveragingRunner')
+
+
+def _json_params(params):
+    """The entries of params that can be stored as json"""
+    entries = {}
+    for name, value in params.__dict__.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        entries[name] = value
+    return entries
+
+
+class ArchiveMembers(collections.abc.Sequence):
+    """The (yaml, weights) members of an archive, read when accessed"""
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    def __len__(self):
+        return len(self.archive.index['members'])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.archive.member(i)
+
+
+class EnsembleArchive:
+    """
+    An ensemble stored as a directory. index.json describes the aggregator
+    and each member: its architecture (member-<i>.yaml), its weights (.npy
+    files in member-<i>/, possibly quantized), its alpha and its training
+    metadata. The weights are memory-mapped when a member is loaded.
+    mode is 'r' to read, 'w' to start a new archive, or 'a' to add to an
+    existing one (e.g. when resuming a run).
+    """
+
+    def __init__(self, path, mode = 'r'):
+        self.path = path
+        index_file = os.path.join(path, 'index.json')
+        if mode == 'w' or (mode == 'a' and not os.path.exists(index_file)):
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.index = {'format_version': format_version,
+                          'aggregator': None,
+                          'members': []}
+            self.save_index()
+        else:
+            with open(index_file, 'r') as f:
+                self.index = json.load(f)
+            if self.index['format_version'] > format_version:
+                raise ValueError("{0} needs a newer version of toupee"
+                                 .format(path))
+
+    def save_index(self):
+        """Atomically replaces index.json"""
+        index_file = os.path.join(self.path, 'index.json')
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent = 2, default = str)
+        os.replace(index_file + '.tmp', index_file)
+
+    def write_member(self, number, m_yaml, m_weights, alpha = None,
+                     metadata = None):
+        """Stores a member (replacing any previous member number)"""
+        member_name = 'member-{0}'.format(number)
+        member_dir = os.path.join(self.path, member_name)
+        if not os.path.exists(member_dir):
+            os.makedirs(member_dir)
+        with open(os.path.join(self.path, member_name + '.yaml'), 'w') as f:
+            f.write(m_yaml)
+
+        if isinstance(m_weights, common.QuantizedWeights):
+            precision = m_weights.precision
+            tensors = m_weights.tensors
+        else:
+            precision = 'float32'
+            tensors = [(numpy.asarray(w), None, None, numpy.asarray(w).dtype.str)
+                       for w in m_weights]
+        weights = []
+        for j, (w, scale, offset, dtype) in enumerate(tensors):
+            weights_file = os.path.join(member_name, 'weight-{0}.npy'.format(j))
+            numpy.save(os.path.join(self.path, weights_file), w)
+            weights.append({'file': weights_file, 'scale': scale,
+                            'offset': offset, 'dtype': dtype})
+
+        entry = {'architecture': member_name + '.yaml',
+                 'precision': precision,
+                 'weights': weights,
+                 'alpha': alpha,
+                 'metadata': metadata or {}}
+        members = self.index['members']
+        if number < len(members):
+            members[number] = entry
+        elif number == len(members):
+            members.append(entry)
+        else:
+            raise ValueError("member {0} written before member {1}".format(
+                number, len(members)))
+        self.save_index()
+
+    def set_aggregator(self, ensemble, params):
+        """
+        Stores how the members are combined. A wrapper of the members'
+        outputs (e.g. the SAMME.R scores of real BRN) is dill-pickled to
+        wrapper.pkl.
+        """
+        if type(ensemble).__name__ not in stored_aggregators:
+            raise ValueError("can't store a {0} in an archive".format(
+                type(ensemble).__name__))
+        wrapper_file = None
+        if getattr(ensemble, 'wrapper', None) is not None:
+            wrapper_file = 'wrapper.pkl'
+            with open(os.path.join(self.path, wrapper_file), 'wb') as f:
+                dill.dump(ensemble.wrapper, f)
+        alphas = getattr(ensemble, 'weights', None)
+        if alphas is not None:
+            for entry, alpha in zip(self.index['members'], alphas):
+                entry['alpha'] = float(alpha)
+        self.index['aggregator'] = {
+            'class': type(ensemble).__name__,
+            'cascade': getattr(ensemble, 'cascade', False),
+            'voting': getattr(ensemble, 'voting', None),
+            'wrapper': wrapper_file,
+            'params': _json_params(params),
+        }
+        self.save_index()
+
+    def truncate(self, n_members):
+        """Removes the members after the first n_members"""
+        for entry in self.index['members'][n_members:]:
+            member_name = os.path.splitext(entry['architecture'])[0]
+            shutil.rmtree(os.path.join(self.path, member_name),
+                          ignore_errors = True)
+            architecture = os.path.join(self.path, entry['architecture'])
+            if os.path.exists(architecture):
+                os.remove(architecture)
+        del self.index['members'][n_members:]
+        self.save_index()
+
+    def member(self, i):
+        """The (yaml, weights) of member i, with memory-mapped weights"""
+        entry = self.index['members'][i]
+        with open(os.path.join(self.path, entry['architecture']), 'r') as f:
+            m_yaml = f.read()
+        arrays = [numpy.load(os.path.join(self.path, w['file']),
+                             mmap_mode = 'r')
+                  for w in entry['weights']]
+        if entry['precision'] == 'float32':
+            return (m_yaml, arrays)
+        return (m_yaml, common.QuantizedWeights.from_tensors(
+            [(a, w['scale'], w['offset'], w['dtype'])
+             for a, w in zip(arrays, entry['weights'])],
+            entry['precision']))
+
+    @property
+    def members(self):
+        return ArchiveMembers(self)
+
+    def alphas(self):
+        return [entry['alpha'] for entry in self.index['members']]
+
+    def aggregator(self, members = None):
+        """The aggregator of the archive, over members (by default, all)"""
+        import toupee.ensemble_methods as ensemble_methods
+        if members is None:
+            members = self.members
+        description = self.index['aggregator']
+        params = parameters.Parameters(**description['params'])
+        if description['class'] == 'WeightedAveragingRunner':
+            return ensemble_methods.WeightedAveragingRunner(members,
+                self.alphas()[:len(members)], params,
+                cascade = description['cascade'])
+        elif description['class'] == 'MajorityVotingRunner':
+            return ensemble_methods.MajorityVotingRunner(members, params)
+        elif description['class'] == 'AveragingRunner':
+            wrapper = None
+            if description.get('wrapper') is not None:
+                with open(os.path.join(self.path, description['wrapper']),
+                          'rb') as f:
+                    wrapper = dill.load(f)
+            return ensemble_methods.AveragingRunner(members, params, wrapper)
+        raise ValueError("can't store a {0} in an archive".format(
+            description['class']))
+
+
+def weights_nbytes(weights):
+    if isinstance(weights, common.QuantizedWeights):
+        return weights.nbytes
+    return sum(numpy.asarray(w).nbytes for w in weights)
+
+
+class MemberStore(collections.abc.Sequence):
+    """
+    The (yaml, weights) members of an ensemble being trained, keeping at
+    most memory_budget bytes of weights in memory. The oldest members are
+    spilled to an archive in spill_dir (by default a new temporary
+    directory, in tmp_dir if given) and read back memory-mapped when
+    accessed. The store owns spill_dir: anything already there is replaced,
+    and close() removes it.
+    If the members are written to an archive anyway (at full precision),
+    the store is given that archive instead: a member is then spilled by
+    dropping it from memory once it is in the archive (see spill()).
+    """
+
+    def __init__(self, memory_budget, spill_dir = None, tmp_dir = None,
+                 archive = None):
+        self.owns_archive = archive is None
+        if archive is not None:
+            spill_dir = archive.path
+        elif spill_dir is None:
+            spill_dir = tempfile.mkdtemp(prefix = 'toupee-members-',
+                                         dir = tmp_dir)
+        elif os.path.exists(spill_dir):
+            #left by a run that isn't being resumed
+            shutil.rmtree(spill_dir)
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        if archive is None:
+            archive = EnsembleArchive(spill_dir, 'w')
+        self.archive = archive
+        #None for the spilled members, which are always the oldest
+        self.resident = []
+        self.n_spilled = 0
+
+    def __len__(self):
+        return len(self.resident)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        member = self.resident[i]
+        if member is None:
+            return self.archive.member(i)
+        return member
+
+    def append(self, member):
+        self.resident.append(tuple(member))
+        self.spill()
+
+    def spill(self):
+        """
+        Spills the oldest members until the budget is met (with an archive
+        given, only those already written to it)
+        """
+        while self.resident_bytes > self.memory_budget and \
+                self.n_spilled < len(self.resident):
+            if self.owns_archive:
+                m_yaml, m_weights = self.resident[self.n_spilled]
+                self.archive.write_member(self.n_spilled, m_yaml, m_weights)
+            elif self.n_spilled >= len(self.archive.index['members']):
+                break
+            self.resident[self.n_spilled] = None
+            self.n_spilled += 1
+
+    @property
+    def resident_bytes(self):
+        return sum(weights_nbytes(m[1]) for m in self.resident
+                   if m is not None)
+
+    def __getstate__(self):
+        #the spilled members stay on disk
+        state = dict(self.__dict__)
+        del state['archive']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.archive = EnsembleArchive(self.spill_dir, 'a')
+
+    def close(self):
+        """Removes the spilled members (unless they are in a given archive)"""
+        if self.owns_archive:
+            shutil.rmtree(self.spill_dir, ignore_errors = True)
+
+
+def is_pickle(location):
+    return location[-4:] == '.pkl'
+
+
+def save_ensemble(location, members, ensemble, params):
+    """Stores a whole ensemble, as an archive or (for .pkl) a dill pickle"""
+    if is_pickle(location):
+        with open(location, "wb") as f:
+            dill.dump({'members': members, 'ensemble': ensemble}, f)
+        return
+    archive = EnsembleArchive(location, 'w')
+    for i, (m_yaml, m_weights) in enumerate(members):
+        archive.write_member(i, m_yaml, m_weights)
+    archive.set_aggregator(ensemble, params)
+
+
+def load_ensemble(location):
+    """
+    The members and the aggregator of a stored ensemble. The members of an
+    archive are only read when used.
+    """
+    if is_pickle(location):
+        with open(location, "rb") as f:
+            stored = dill.load(f)
+        return stored['members'], stored['ensemble']
+    archive = EnsembleArchive(location)
+    return archive.members, archive.aggregator()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Benchmarks of the model on the actual data, to pick the batch size for
+inference and the number of TensorFlow threads
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import copy
+import time
+import multiprocessing
+
+import keras
+from keras import backend as K
+
+import toupee.common as common
+import toupee.mlp as mlp
+
+
+def use_threads(threads):
+    """
+    Starts a new keras session with at most threads intra and inter-op
+    threads (TensorFlow's default for None). Every model built so far is
+    lost.
+    """
+    import tensorflow as tf
+    K.clear_session()
+    mlp.clear_model_cache()
+    if threads is None:
+        config = tf.ConfigProto()
+    else:
+        config = tf.ConfigProto(intra_op_parallelism_threads = threads,
+                                inter_op_parallelism_threads = threads)
+    K.set_session(tf.Session(graph = tf.get_default_graph(), config = config))
+
+
+def default_settings(params):
+    cores = multiprocessing.cpu_count()
+    return {
+        'eval_batch_sizes': [params.batch_size * i for i in (1, 2, 4, 8)],
+        'training_batch_sizes': None,
+        'threads': sorted(set(max(1, cores // i) for i in (4, 2, 1))),
+        'steps': 10,
+    }
+
+
+def _compiled_model(params):
+    model, _ = mlp.initialize_model(params, None, None, None, None, None)
+    optimizer_config = copy.deepcopy(params.optimizer)
+    lr = optimizer_config['config']['lr']
+    if isinstance(lr, dict):
+        optimizer_config['config']['lr'] = lr[0]
+    model.compile(optimizer = keras.optimizers.deserialize(optimizer_config),
+                  loss = params.cost_function)
+    return model
+
+
+def _samples_per_second(run_batch, holder, steps):
+    """Throughput over steps batches, after a warm-up batch"""
+    steps = min(steps, len(holder) - 1)
+    if steps < 1:
+        return None
+    run_batch(holder[0])
+    samples = 0
+    start_time = time.perf_counter()
+    for step in range(1, steps + 1):
+        batch = holder[step]
+        run_batch(batch)
+        samples += len(batch[0]) if isinstance(batch, tuple) else len(batch)
+    return samples / (time.perf_counter() - start_time)
+
+
+def autotune(params, data_files):
+    """
+    Measures the training and inference throughput of the model for each
+    thread count of params.autotune, and the inference throughput for each
+    of its eval batch sizes. The thread count that minimises the estimated
+    time of an epoch plus the evaluation of the three sets is kept, with
+    the fastest eval batch size for it. The training batch size only
+    changes if training_batch_sizes are given. Sets params.eval_batch_size,
+    params.batch_size, params.threads and params.autotune_report.
+    """
+    settings = default_settings(params)
+    settings.update(params.autotune)
+    trainfile = data_files[0]
+    set_sizes = [common.DataGenerator(f, params.batch_size, None,
+                                      hold_y = False).num_examples
+                 for f in data_files]
+    training_batch_sizes = settings['training_batch_sizes'] or \
+                           [params.batch_size]
+
+    samples = []
+    best = None
+    for threads in settings['threads']:
+        use_threads(threads)
+        model = _compiled_model(params)
+
+        train_rates = {}
+        for batch_size in training_batch_sizes:
+            holder = common.DataGenerator(trainfile, batch_size, None)
+            train_rates[batch_size] = _samples_per_second(
+                lambda batch: model.train_on_batch(*batch), holder,
+                settings['steps'])
+            samples.append({'threads': threads, 'mode': 'training',
+                'batch_size': batch_size,
+                'samples_per_second': train_rates[batch_size]})
+
+        eval_rates = {}
+        for batch_size in settings['eval_batch_sizes']:
+            holder = common.DataGenerator(trainfile, batch_size, None,
+                                          hold_y = False)
+            eval_rates[batch_size] = _samples_per_second(
+                model.predict_on_batch, holder, settings['steps'])
+            samples.append({'threads': threads, 'mode': 'inference',
+                'batch_size': batch_size,
+                'samples_per_second': eval_rates[batch_size]})
+
+        train_rates = dict((b, r) for b, r in train_rates.items() if r)
+        eval_rates = dict((b, r) for b, r in eval_rates.items() if r)
+        if not train_rates or not eval_rates:
+            continue
+        train_batch_size = max(train_rates, key = train_rates.get)
+        eval_batch_size = max(eval_rates, key = eval_rates.get)
+        estimated_time = (set_sizes[0] / train_rates[train_batch_size] +
+                          sum(set_sizes) / eval_rates[eval_batch_size])
+        print(("{0} threads: training {1:.0f} samples/s (batch {2}), "
+               "inference {3:.0f} samples/s (batch {4})".format(threads,
+                   train_rates[train_batch_size], train_batch_size,
+                   eval_rates[eval_batch_size], eval_batch_size)))
+        if best is None or estimated_time < best['estimated_time']:
+            best = {'threads': threads,
+                    'batch_size': train_batch_size,
+                    'eval_batch_size': eval_batch_size,
+                    'training_samples_per_second':
+                        train_rates[train_batch_size],
+                    'inference_samples_per_second':
+                        eval_rates[eval_batch_size],
+                    'estimated_time': estimated_time}
+
+    if best is None:
+        print("WARNING: the data set is too small to autotune, "
+              "keeping the default settings")
+        use_threads(None)
+        return
+
+    use_threads(best['threads'])
+    params.threads = best['threads']
+    params.batch_size = best['batch_size']
+    params.eval_batch_size = best['eval_batch_size']
+    params.autotune_report = {'chosen': best, 'samples': samples}
+    print(("\nAutotuned: {0} threads, batch size {1}, eval batch size {2}"
+           .format(best['threads'], best['batch_size'],
+                   best['eval_batch_size'])))
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Scheduling of the ensemble members within a wall-clock or CPU time budget
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import time
+
+from toupee.timing import timer
+
+
+class BudgetScheduler:
+    """
+    Chooses the number of epochs of each member, and when to stop adding
+    members, so that the ensemble is trained and stored within
+    params.budget. The cost of an epoch and the per-member overhead
+    (evaluation, scoring) are measured on the members trained so far.
+    The first member is always trained, stopped early if it would
+    overrun the budget (see common.DeadlineStopping).
+    """
+
+    def __init__(self, params):
+        budget = params.budget
+        self.wall_budget = None
+        self.cpu_budget = None
+        if budget.get('wall_hours') is not None:
+            self.wall_budget = budget['wall_hours'] * 3600.
+        if budget.get('cpu_hours') is not None:
+            self.cpu_budget = budget['cpu_hours'] * 3600.
+        if self.wall_budget is None and self.cpu_budget is None:
+            raise ValueError("the budget needs wall_hours or cpu_hours")
+        #kept for storing the ensemble at the end
+        self.reserve = budget.get('reserve', 0.05)
+        self.min_epochs = budget.get('min_epochs', 1)
+        self.n_epochs = params.n_epochs
+        self.ensemble_size = params.ensemble_size
+        self.wall_start = time.time()
+        self.cpu_start = time.process_time()
+        self.epoch_costs = []
+        self.overheads = []
+        self.decisions = []
+        self.stop_reason = None
+
+    def __getstate__(self):
+        #the clocks of another process (or boot) mean nothing: the time
+        # used so far is kept instead, without the time before a resume
+        state = dict(self.__dict__)
+        state['wall_used'] = time.time() - state.pop('wall_start')
+        state['cpu_used'] = time.process_time() - state.pop('cpu_start')
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        self.wall_start = time.time() - state.pop('wall_used')
+        self.cpu_start = time.process_time() - state.pop('cpu_used')
+        self.__dict__.update(state)
+
+    def remaining(self):
+        """The wall time left for training, in seconds"""
+        wall_used = time.time() - self.wall_start
+        remaining = []
+        if self.wall_budget is not None:
+            remaining.append(self.wall_budget * (1. - self.reserve) -
+                             wall_used)
+        if self.cpu_budget is not None:
+            #cpu time is spent at the rate observed so far
+            cpu_used = time.process_time() - self.cpu_start
+            cpu_rate = max(cpu_used / max(wall_used, 1e-9), 1e-9)
+            remaining.append((self.cpu_budget * (1. - self.reserve) -
+                              cpu_used) / cpu_rate)
+        return min(remaining)
+
+    def member_done(self, member_number, wall_time):
+        """Updates the cost estimates with a member's timings"""
+        stats = timer.summary()['members'].get(str(member_number), {})
+        if 'training' not in stats or 'epoch_validation' not in stats:
+            return
+        training_time = stats['training']['wall_total']
+        self.epoch_costs.append(training_time /
+                                stats['epoch_validation']['count'])
+        self.overheads.append(max(0., wall_time - training_time))
+
+    def next_member(self, params, member_number):
+        """
+        Sets params.n_epochs and params.training_deadline for the next
+        member. Returns False if there is no time for it.
+        """
+        remaining = self.remaining()
+        decision = {'member': member_number, 'remaining': remaining}
+        if member_number == 0 or not self.epoch_costs:
+            epochs = self.n_epochs
+        else:
+            epoch_cost = sum(self.epoch_costs) / len(self.epoch_costs)
+            overhead = sum(self.overheads) / len(self.overheads)
+            decision['epoch_cost'] = epoch_cost
+            decision['member_overhead'] = overhead
+            if overhead + self.min_epochs * epoch_cost > remaining:
+                self.stop_reason = 'no time for member {0}'.format(
+                    member_number)
+                decision['epochs'] = 0
+                self.decisions.append(decision)
+                print(("\nBudget: stopping, {0:.0f}s left and a member "
+                       "needs {1:.0f}s".format(remaining,
+                           overhead + self.min_epochs * epoch_cost)))
+                return False
+            #the time left is shared among the remaining members
+            members_left = self.ensemble_size - member_number
+            epochs = int((remaining / members_left - overhead) / epoch_cost)
+            epochs = max(self.min_epochs, min(self.n_epochs, epochs))
+        decision['epochs'] = epochs
+        self.decisions.append(decision)
+        print(("\nBudget: {0:.0f}s left, training member {1} for {2} "
+               "epochs".format(remaining, member_number, epochs)))
+        params.n_epochs = epochs
+        params.training_deadline = time.time() + remaining
+        return True
+
+    def finish(self, params, n_members):
+        """Restores params and stores the decisions in them"""
+        params.n_epochs = self.n_epochs
+        params.training_deadline = None
+        if self.stop_reason is None and n_members < self.ensemble_size:
+            self.stop_reason = 'stopped by the ensemble method'
+        params.budget_report = {
+            'wall_budget': self.wall_budget,
+            'cpu_budget': self.cpu_budget,
+            'wall_used': time.time() - self.wall_start,
+            'cpu_used': time.process_time() - self.cpu_start,
+            'members': n_members,
+            'stop_reason': self.stop_reason,
+            'decisions': self.decisions,
+        }
@@ -15,7 +15,18 @@ import collections
 import math
 import time
 import h5py
+import threading
+import bisect
+import warnings
+import importlib
+import resource
+import sys
+import copy
+import hashlib
+import keras
 
+from keras import backend as K
+import toupee.timing as timing
 from keras.callbacks import Callback
 from keras.utils import Sequence
 
@@ -25,6 +36,8 @@ numpy.set_printoptions(threshold=numpy.inf)
 #KERAS ADD-ON
 class ModelCheckpointInMemory(Callback):
     '''Save the model after every epoch in memory.
+    The best weights are copied, one weight tensor at a time, into buffers
+    that are allocated once and reused across epochs.
     # Arguments
         monitor: quantity to monitor.
         verbose: verbosity mode, 0 or 1.
@@ -36,15 +49,20 @@ class ModelCheckpointInMemory(Callback):
             this should be `max`, for `val_loss` this should
             be `min`, etc. In `auto` mode, the direction is
             automatically inferred from the name of the monitored quantity.
+        save_to: optional .npz file where the best weights are also 
+            written, by a background thread, every time they improve.
     '''
-    def __init__(self, monitor='val_loss', verbose=0, mode='auto'):
+    def __init__(self, monitor='val_loss', verbose=0, mode='auto',
+                 save_to=None):
         super(ModelCheckpointInMemory, self).__init__()
         self.monitor = monitor
         self.verbose = verbose
         
-        self.best_model = h5py.File("/dev/null", driver = 'core',
-                backing_store = False)
+        self.best_model = None
         self.best_epoch = None
+        self.save_to = save_to
+        self.writer = None
+        self.restored = None
 
         if mode not in ['auto', 'min', 'max']:
             warnings.warn('ModelCheckpoint mode %s is unknown, '
@@ -66,6 +84,22 @@ class ModelCheckpointInMemory(Callback):
                 self.monitor_op = numpy.less
                 self.best = numpy.Inf
 
+    def restore(self, weights, epoch, best):
+        '''Starts from a snapshot's best weights, epoch and monitored value'''
+        self.restored = (weights, epoch, best)
+
+    def on_train_begin(self, logs={}):
+        self.best_model = [numpy.empty(K.int_shape(w), dtype=K.dtype(w))
+                           for w in self.model.weights]
+        if self.restored is not None:
+            weights, self.best_epoch, best = self.restored
+            for buffer, w in zip(self.best_model, weights):
+                numpy.copyto(buffer, w)
+            if best is not None:
+                self.best = best
+        if self.save_to is not None:
+            self.writer = SnapshotWriter(self.save_to, self.best_model)
+
     def on_epoch_end(self, epoch, logs={}):
         current = logs.get(self.monitor)
         if current is None:
@@ -78,14 +112,186 @@ class ModelCheckpointInMemory(Callback):
                           ' saving model'
                           % (epoch, self.monitor, self.best, current))
                 self.best = current
-                self.best_model = self.model.get_weights()
                 self.best_epoch = epoch
+                if self.writer is not None:
+                    with self.writer.lock:
+                        self._copy_weights()
+                    self.writer.request(epoch, current)
+                else:
+                    self._copy_weights()
             else:
                 if self.verbose > 0:
                     print('Epoch %05d: %s did not improve' %
                           (epoch, self.monitor))
-                          
 
+    def on_train_end(self, logs={}):
+        if self.writer is not None:
+            #the writer finishes the last snapshot on its own
+            self.writer.stop()
+
+    def close(self):
+        '''Stops the snapshot writer, waiting for its last snapshot'''
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer.wait()
+            self.writer = None
+
+    def remove_snapshot(self):
+        '''Deletes the snapshot, once it won't be resumed'''
+        self.close()
+        if self.save_to is not None and os.path.exists(self.save_to):
+            os.remove(self.save_to)
+
+    def _copy_weights(self):
+        #one session run for all the weights (TensorFlow can't fetch into
+        # the buffers, so the values are still copied once)
+        values = K.batch_get_value(self.model.weights)
+        for buffer, value in zip(self.best_model, values):
+            numpy.copyto(buffer, value)
+
+
+class SnapshotWriter:
+    '''
+    Background thread that writes the latest requested snapshot of a list
+    of weight buffers to an .npz file. The buffers are only read while
+    holding `lock`, for the time of a memory copy; the file is written
+    from a private copy, to a temporary file that then replaces the old one.
+    '''
+
+    def __init__(self, filename, buffers):
+        self.filename = filename
+        self.buffers = buffers
+        self.lock = threading.Lock()
+        self.staging = [numpy.empty_like(b) for b in buffers]
+        self.pending = threading.Event()
+        self.epoch = None
+        self.best = None
+        self.written_epoch = None
+        self.stopped = False
+        self.thread = threading.Thread(target = self.run)
+        #an interrupted training must not hang on the writer
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, epoch, best = None):
+        with self.lock:
+            self.epoch = epoch
+            self.best = best
+        self.pending.set()
+
+    def stop(self):
+        self.stopped = True
+        self.pending.set()
+
+    def wait(self):
+        self.thread.join()
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            if self.epoch != self.written_epoch:
+                with self.lock:
+                    epoch = self.epoch
+                    best = self.best
+                    for staged, buffer in zip(self.staging, self.buffers):
+                        numpy.copyto(staged, buffer)
+                self.write(epoch, best)
+                self.written_epoch = epoch
+            if self.stopped and not self.pending.is_set():
+                return
+
+    def write(self, epoch, best = None):
+        tmp_filename = self.filename + '.tmp'
+        arrays = dict(('weight_{0}'.format(i), w)
+                      for i, w in enumerate(self.staging))
+        if best is not None:
+            arrays['best'] = best
+        try:
+            with open(tmp_filename, 'wb') as f:
+                numpy.savez(f, epoch = epoch, **arrays)
+            os.replace(tmp_filename, self.filename)
+        except (IOError, OSError) as e:
+            print(("WARNING: could not save the snapshot: {0}".format(e)))
+
+
+def load_snapshot(filename):
+    """
+    Returns the weights, epoch and monitored value (None if not saved) of a
+    snapshot saved by SnapshotWriter
+    """
+    with numpy.load(filename) as snapshot:
+        n_weights = len([k for k in snapshot.files if k.startswith('weight_')])
+        weights = [snapshot['weight_{0}'.format(i)] for i in range(n_weights)]
+        best = float(snapshot['best']) if 'best' in snapshot.files else None
+        return weights, int(snapshot['epoch']), best
+
+
+class DataGeneratorStats:
+    """
+    I/O counters of a DataGenerator: batches served, rows and bytes read,
+    storage reads (contiguous range reads and single-row reads) and a
+    histogram of the batch fetch latency. Updated from keras' data loading
+    thread.
+    """
+
+    #upper edges of the latency buckets, in seconds (the last is open)
+    latency_buckets = [0.0001 * 2 ** i for i in range(18)]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.batches = 0
+            self.rows = 0
+            self.bytes_read = 0
+            self.range_reads = 0
+            self.row_reads = 0
+            self.fetch_time = 0.
+            self.latency_counts = [0] * (len(self.latency_buckets) + 1)
+
+    def record_reads(self, range_reads, row_reads, bytes_read):
+        with self.lock:
+            self.range_reads += range_reads
+            self.row_reads += row_reads
+            self.bytes_read += bytes_read
+
+    def record_batch(self, rows, fetch_time):
+        with self.lock:
+            self.batches += 1
+            self.rows += rows
+            self.fetch_time += fetch_time
+            self.latency_counts[bisect.bisect_left(self.latency_buckets,
+                                                   fetch_time)] += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'rows': self.rows,
+                'bytes_read': self.bytes_read,
+                'storage_reads': self.range_reads + self.row_reads,
+                'range_reads': self.range_reads,
+                'row_reads': self.row_reads,
+                'fetch_time': self.fetch_time,
+                'latency_buckets': list(self.latency_buckets),
+                'latency_counts': list(self.latency_counts),
+            }
+
+    def print_summary(self, name):
+        summary = self.summary()
+        if summary['batches'] == 0:
+            return
+        print(("  {0}: {1} batches, {2} rows, {3:.1f}MB in {4} reads "
+               "({5} ranges, {6} single rows), {7:.2f}s fetching, "
+               "{8:.1f}MB/s".format(name, summary['batches'],
+                   summary['rows'], summary['bytes_read'] / 2. ** 20,
+                   summary['storage_reads'], summary['range_reads'],
+                   summary['row_reads'], summary['fetch_time'],
+                   summary['bytes_read'] / 2. ** 20 /
+                       max(summary['fetch_time'], 1e-9))))
 
 
 #Joao: I tried to prefetch the data from the disk in this generator, but it led 
@@ -98,7 +304,8 @@ class DataGenerator(Sequence):
             [requires __len__(self) and __getitem__(self, idx)]
     '''
     
-    def __init__(self, data_file, batch_size, sampled_indexes, hold_y = True):
+    def __init__(self, data_file, batch_size, sampled_indexes, hold_y = True,
+                 stats = None):
         
         #define x
         if 'x' in data_file:
@@ -107,6 +314,8 @@ class DataGenerator(Sequence):
             xlabel = 'X'
         
         self.data_x = data_file[xlabel]
+        #(a DataGeneratorStats can be shared with other generators)
+        self.stats = DataGeneratorStats() if stats is None else stats
         
 
         #auxiliary variables
@@ -123,12 +332,27 @@ class DataGenerator(Sequence):
         self.hold_y = hold_y
         if hold_y:
             #TODO: classification problem  -for now it assumes that 
-            #       y is a one-hot thing, which might not be always true!
-            self.n_classes = data_file['y'].shape[1]
-            assert self.n_classes > 1
+            #       y is either one-hot or a vector of integer labels
             self.data_y = data_file['y']
+            self.integer_labels = len(self.data_y.shape) == 1
+            if self.integer_labels:
+                #expanded to one-hot batch by batch
+                self.n_classes = label_index(data_file).n_classes
+            else:
+                self.n_classes = self.data_y.shape[1]
+            assert self.n_classes > 1
+
+        #x and y are read separately
+        self.datasets_read = 2 if hold_y else 1
+        self.row_bytes = self._row_bytes(self.data_x)
+        if hold_y:
+            self.row_bytes += self._row_bytes(self.data_y)
 
     
+    @staticmethod
+    def _row_bytes(dataset):
+        return int(numpy.prod(dataset.shape[1:])) * dataset.dtype.itemsize
+    
     def sequential_batch(self, step):
         #sequential iteration over the data
         
@@ -141,10 +365,12 @@ class DataGenerator(Sequence):
                 (step+1)*self.batch_size))
     
     
+        self.stats.record_reads(self.datasets_read, 0,
+            len(batch_indexes) * self.row_bytes)
         if self.hold_y:
             # Return the arrays in the shape that fit_gen uses (data, target)
             return (self.data_x[batch_indexes, ...],
-                    self.data_y[batch_indexes, ...])
+                    self.batch_y(self.data_y[batch_indexes, ...]))
         # else:
         # Return the arrays in the shape that predict_generator uses (data)
         return (self.data_x[batch_indexes, ...]) 
@@ -175,6 +401,8 @@ class DataGenerator(Sequence):
             for i in batch_indexes:
                 data_x.append(self.data_x[i, ...])  
             data_x = numpy.asarray(data_x)
+            self.stats.record_reads(0, len(batch_indexes) * self.datasets_read,
+                len(batch_indexes) * self.row_bytes)
             
             if self.hold_y:
                 data_y = []
@@ -188,6 +416,8 @@ class DataGenerator(Sequence):
             
             data_x = self.data_x[first_index:last_index+1, ...]
             data_x = data_x[batch_indexes, ...]
+            self.stats.record_reads(self.datasets_read, 0,
+                (last_index + 1 - first_index) * self.row_bytes)
             
             if self.hold_y:
                 data_y = self.data_y[first_index:last_index+1, ...]
@@ -195,44 +425,248 @@ class DataGenerator(Sequence):
                 
             
         if self.hold_y:    
-            return(data_x, data_y)
+            return(data_x, self.batch_y(data_y))
             
         # else:
         return(data_x)
     
     
+    def batch_y(self, data_y):
+        #integer labels are expanded to one-hot here. A new array is used
+        # for each batch, since keras queues several batches ahead
+        if not self.integer_labels:
+            return data_y
+        data_y = numpy.asarray(data_y)
+        one_hot_y = numpy.zeros((data_y.shape[0], self.n_classes),
+                                dtype='float32')
+        one_hot_y[numpy.arange(data_y.shape[0]), data_y] = 1.
+        return one_hot_y
+    
+    
     def __len__(self):
         #returns the dataset length
         return self.number_of_batches
     
     
     def __getitem__(self, step):
-        #gets a batch
+        #gets a batch (keras calls this from its own thread, hence the 
+        # thread cpu clock)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
         if self.sampled_indexes is None:
-            return self.sequential_batch(step)
+            batch = self.sequential_batch(step)
         else:
-            return self.sliced_batch(step)
+            batch = self.sliced_batch(step)
+        fetch_time = time.perf_counter() - wall_start
+        timing.timer.record('batch_fetch', fetch_time,
+                            time.thread_time() - cpu_start)
+        self.stats.record_batch(len(batch[0]) if self.hold_y else len(batch),
+                                fetch_time)
+        if toupee_global_instance.has_hooks('batch_fetch'):
+            toupee_global_instance.fire('batch_fetch', step = step,
+                fetch_time = fetch_time)
+        return batch
             
 
 
 
 
+class QuantizedWeights:
+    """
+    Reduced-precision copy of a member's list of weight arrays.
+    `precision` is either 'float16', or 'int8' with a per-tensor scale and
+    offset. Use dequantize_weights() to get the arrays back.
+    """
+
+    def __init__(self, weights, precision):
+        if precision not in ['float16', 'int8']:
+            raise ValueError("unknown weights precision {0}".format(precision))
+        self.precision = precision
+        self.tensors = []
+        for w in weights:
+            w = numpy.asarray(w)
+            if w.dtype.kind != 'f' or w.size == 0:
+                self.tensors.append((w, None, None, w.dtype.str))
+            elif precision == 'float16':
+                self.tensors.append((w.astype('float16'), None, None,
+                    w.dtype.str))
+            else:
+                offset = float(w.min())
+                scale = (float(w.max()) - offset) / 255.
+                if scale == 0.:
+                    scale = 1.
+                q = numpy.round((w - offset) / scale) - 128.
+                self.tensors.append((q.astype('int8'), scale, offset,
+                    w.dtype.str))
+
+    @classmethod
+    def from_tensors(cls, tensors, precision):
+        """Rebuilds stored weights from their (q, scale, offset, dtype)"""
+        quantized = cls([], precision)
+        quantized.tensors = list(tensors)
+        return quantized
+
+    def __len__(self):
+        return len(self.tensors)
+
+    @property
+    def nbytes(self):
+        return sum(q.nbytes for (q, _, _, _) in self.tensors)
+
+    def dequantize(self):
+        weights = []
+        for (q, scale, offset, dtype) in self.tensors:
+            if scale is None:
+                weights.append(q.astype(dtype))
+            else:
+                weights.append(((q.astype(dtype) + 128.) * scale + offset)
+                    .astype(dtype))
+        return weights
+
+
+def quantize_members(members, precision):
+    """
+    Returns a copy of an ensemble's (yaml, weights) members with the weights
+    stored at the given precision ('float32' leaves them untouched)
+    """
+    if precision in [None, 'float32']:
+        return members
+    return [(m_yaml, QuantizedWeights(m_weights, precision))
+                for (m_yaml, m_weights) in members]
+
+
+def dequantize_weights(weights):
+    """Full precision weights of a member, whether quantized or not"""
+    if isinstance(weights, QuantizedWeights):
+        return weights.dequantize()
+    return weights
+
+
+def memory_usage():
+    """Current and peak resident memory of the process, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024    #kilobytes on linux
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        rss = None
+    return {'rss_bytes': rss, 'peak_rss_bytes': peak}
+
+
+hook_events = ['reset', 'member_start', 'member_end', 'epoch_start',
+               'epoch_end', 'batch_fetch']
+
 class Toupee:
+    """
+    Hooks fired during training. Each hook is called as hook(event, context)
+    where context is a dict with the member number, the wall and cpu clocks,
+    the wall time elapsed since the member started and the memory usage,
+    plus the entries of the event (epoch and logs, batch step, metrics...).
+    batch_fetch hooks are called from keras' data loading thread.
+    """
     
     def __init__(self):
         self.reset()
 
     def reset(self):
-        self.epoch_hooks = []
-        self.reset_hooks = []
+        self.hooks = dict((event, []) for event in hook_events)
+        self.epoch_hooks = self.hooks['epoch_end']
+        self.reset_hooks = self.hooks['reset']
+        self.member = None
+        self.member_start_time = None
+
+    def add_hook(self,event,hook):
+        if event not in self.hooks:
+            raise ValueError("unknown hook event {0}".format(event))
+        if hook not in self.hooks[event]:
+            self.hooks[event].append(hook)
 
     def add_epoch_hook(self,hook):
-        if hook not in self.epoch_hooks:
-            self.epoch_hooks.append(hook)
+        self.add_hook('epoch_end', hook)
 
     def add_reset_hook(self,hook):
-        if hook not in self.reset_hooks:
-            self.reset_hooks.append(hook)
+        self.add_hook('reset', hook)
+
+    def install_hooks(self,hooks):
+        """
+        Adds the hooks of an experiment file: a dict of event to a list of
+        'package.module:function' names
+        """
+        if hooks is None:
+            return
+        for event, names in hooks.items():
+            for name in names:
+                module_name, _, function_name = name.partition(':')
+                module = importlib.import_module(module_name)
+                self.add_hook(event, getattr(module, function_name))
+
+    def has_hooks(self,event):
+        return len(self.hooks[event]) > 0
+
+    def fire(self,event,**context):
+        if not self.hooks[event]:
+            return
+        now = time.perf_counter()
+        context['event'] = event
+        context['member'] = self.member
+        context['wall_time'] = now
+        context['cpu_time'] = time.process_time()
+        if self.member_start_time is not None:
+            context['member_elapsed'] = now - self.member_start_time
+        context.update(memory_usage())
+        for hook in self.hooks[event]:
+            try:
+                hook(event, context)
+            except Exception as e:
+                print(("WARNING: {0} hook {1} failed: {2}".format(event,
+                    hook, e)))
+
+    def start_member(self,member_number):
+        self.member = member_number
+        self.member_start_time = time.perf_counter()
+        self.fire('reset')
+        self.fire('member_start')
+
+    def end_member(self,**context):
+        self.fire('member_end', **context)
+
+
+class DeadlineStopping(Callback):
+    """
+    Stops training at the end of an epoch if the next epoch would end after
+    deadline (a time.time() value)
+    """
+
+    def __init__(self, deadline):
+        super(DeadlineStopping, self).__init__()
+        self.deadline = deadline
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        now = time.time()
+        if now + (now - self.epoch_start) > self.deadline:
+            print(("\nStopping at epoch {0} to meet the time budget".format(
+                epoch + 1)))
+            self.model.stop_training = True
+
+
+class HooksCallback(Callback):
+    """Fires the epoch hooks of a Toupee instance from keras' training"""
+
+    def __init__(self, toupee):
+        super(HooksCallback, self).__init__()
+        self.toupee = toupee
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.toupee.fire('epoch_start', epoch = epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.toupee.fire('epoch_end', epoch = epoch, logs = dict(logs or {}))
+
 
 class Results:
 
@@ -242,6 +676,12 @@ class Results:
     def set_history(self,hist):
         self.history = hist.__dict__
 
+    def set_timings(self,timings):
+        self.timings = timings
+
+    def set_io_stats(self,io_stats):
+        self.io_stats = io_stats
+
     def set_final_observation(self,valid,test,epoch):
         self.best_valid = valid
         if test is not None:
@@ -269,6 +709,65 @@ def read_yaml_file(filename):
         model_yaml = yaml.load(f)
     return yaml.dump(model_yaml)
 
+
+#parsed model configs and inference models, by hash of the model yaml
+_model_files = {}
+_model_configs = {}
+_inference_models = {}
+
+def read_model_file(filename):
+    """The contents of a model file, read again only if it changes"""
+    fingerprint = data_file_fingerprint(filename)
+    if _model_files.get(filename, (None, None))[0] != fingerprint:
+        with open(filename, 'r') as f:
+            _model_files[filename] = (fingerprint, f.read())
+    return _model_files[filename][1]
+
+
+def model_hash(model_yaml):
+    return hashlib.sha1(model_yaml.encode('utf-8')).hexdigest()
+
+
+class ModelYamlLoader(yaml.SafeLoader):
+    """Safe loading of a model yaml, with the tuples keras writes"""
+
+ModelYamlLoader.add_constructor('tag:yaml.org,2002:python/tuple',
+    lambda loader, node: tuple(loader.construct_sequence(node)))
+
+
+def model_config(model_yaml):
+    """The parsed config of a model yaml (parsed once per architecture)"""
+    key = model_hash(model_yaml)
+    if key not in _model_configs:
+        _model_configs[key] = yaml.load(model_yaml, Loader = ModelYamlLoader)
+    return copy.deepcopy(_model_configs[key])
+
+
+def build_model(model_yaml):
+    """A new keras model from its yaml, as keras.models.model_from_yaml"""
+    return keras.models.model_from_config(model_config(model_yaml))
+
+
+def inference_model(model_yaml, weights):
+    """
+    A model for prediction with the given (possibly quantized) weights.
+    The model of each architecture is built once and its weights replaced,
+    so it is only valid until the next call for the same architecture.
+    """
+    key = model_hash(model_yaml)
+    if key not in _inference_models:
+        _inference_models[key] = build_model(model_yaml)
+    model = _inference_models[key]
+    model.set_weights(dequantize_weights(weights))
+    return model
+
+
+def clear_model_cache():
+    """Forgets the cached models, e.g. when the keras session is cleared"""
+    _model_configs.clear()
+    _inference_models.clear()
+    _metric_functions.clear()
+
 def serialize(o):
     if isinstance(o, numpy.float32):
         return float(o)
@@ -294,14 +793,148 @@ def serialize(o):
 if 'toupee_global_instance' not in locals():
     toupee_global_instance = Toupee()
 
+class LabelIndex:
+    """
+    Integer class of each sample of a set, with the number of
+    samples and the (sorted) rows of each class. It is built with a single
+    scan of `y` and saved next to the data file, where it is reused for as
+    long as the fingerprint of the data file matches.
+    """
+
+    def __init__(self, class_ids, counts, order, offsets):
+        self.class_ids = class_ids
+        self.counts = counts
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def from_class_ids(cls, class_ids, n_classes):
+        class_ids = numpy.asarray(class_ids, dtype='int32')
+        counts = numpy.bincount(class_ids, minlength = n_classes)
+        order = numpy.argsort(class_ids, kind = 'mergesort')
+        offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+        return cls(class_ids, counts, order, offsets)
+
+    @classmethod
+    def scan(cls, file_object):
+        """
+        Builds the index from the `y` of a data file, either one-hot or a
+        vector of integer labels (with an optional `n_classes` entry)
+        """
+        y_shape = file_object['y'].shape
+        n_samples = y_shape[0]
+        if len(y_shape) == 1:
+            class_ids = numpy.asarray(file_object['y'], dtype='int32')
+            if 'n_classes' in file_object:
+                n_classes = int(numpy.asarray(file_object['n_classes']))
+            else:
+                n_classes = int(class_ids.max()) + 1
+            return cls.from_class_ids(class_ids, n_classes)
+        n_classes = y_shape[1]
+        class_ids = numpy.empty(n_samples, dtype='int32')
+        
+        end = 0
+        while end < n_samples:
+            start = end
+            end += 131072  # magic number, power of 2 :D
+            if end > n_samples:
+                end = n_samples
+            class_ids[start:end] = numpy.asarray(
+                file_object['y'][start:end]).argmax(axis=-1)
+        
+        return cls.from_class_ids(class_ids, n_classes)
+
+    @property
+    def n_classes(self):
+        return len(self.counts)
+
+    def rows(self, class_id):
+        """The rows of the samples of a class"""
+        return self.order[self.offsets[class_id]:self.offsets[class_id + 1]]
+
+    def save(self, filename, fingerprint):
+        #written to a temporary file first, so that an index is either 
+        # complete or missing
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            numpy.savez(f, fingerprint = numpy.asarray(fingerprint),
+                        class_ids = self.class_ids, counts = self.counts,
+                        order = self.order, offsets = self.offsets)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, fingerprint):
+        """Loads a saved index, or returns None if it is missing or stale"""
+        if not os.path.isfile(filename):
+            return None
+        with numpy.load(filename) as saved:
+            if str(saved['fingerprint']) != fingerprint:
+                return None
+            return cls(saved['class_ids'], saved['counts'], saved['order'],
+                       saved['offsets'])
+
+
+def data_file_name(file_object):
+    """The path of an opened .npz or .h5 data file (None if unknown)"""
+    if isinstance(file_object, h5py.File):
+        return file_object.filename
+    #numpy's NpzFile
+    return getattr(getattr(file_object, 'zip', None), 'filename', None)
+
+
+def data_file_fingerprint(file_name):
+    stat = os.stat(file_name)
+    return '{0}:{1}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+_label_indexes = {}
+
+def label_index(file_object):
+    """
+    Returns the LabelIndex of a data file, loading it from (or saving it to)
+    `<data file>.labels.npz` when the data file is on disk
+    """
+    file_name = data_file_name(file_object)
+    if file_name is None:
+        return LabelIndex.scan(file_object)
+    
+    file_name = os.path.realpath(file_name)
+    fingerprint = data_file_fingerprint(file_name)
+    key = (file_name, fingerprint)
+    if key not in _label_indexes:
+        index_name = file_name + '.labels.npz'
+        index = LabelIndex.load(index_name, fingerprint)
+        if index is None:
+            print(("Building the label index of {0}".format(file_name)))
+            index = LabelIndex.scan(file_object)
+            try:
+                index.save(index_name, fingerprint)
+            except (IOError, OSError) as e:
+                print(("WARNING: could not save the label index: {0}"
+                    .format(e)))
+        _label_indexes[key] = index
+    return _label_indexes[key]
+
+
 #----------------------------------------------------------               
 #for classification problems: 
-def get_probabilities(classifier, file_object, batch_size):
+def inference_batch_size(params):
+    """The batch size for prediction and evaluation"""
+    #(parameters stored with older ensembles don't have it)
+    if params.__dict__.get('eval_batch_size') is not None:
+        return params.eval_batch_size
+    return params.batch_size
+
+
+def get_probabilities(classifier, file_object, batch_size,
+                      sampled_indexes = None, stats = None):
     """
-    Predicts the train set using the trained model
+    Predicts the train set using the trained model (counting the reads in
+    stats, if given)
     """
     
-    x_holder = DataGenerator(file_object, batch_size, None, hold_y = False)
+    x_holder = DataGenerator(file_object, batch_size, sampled_indexes,
+                             hold_y = False, stats = stats)
     
     #applies the correct method, depending on the classifier class
     if hasattr(classifier, 'predict_generator'):
@@ -319,33 +952,157 @@ def errors(classifier, file_object, batch_size):
     """
 
     class_proba = get_probabilities(classifier, file_object, batch_size)
-    n_samples = file_object['y'].shape[0]
 
     #converts to the predicted class (integer)
     if class_proba.shape[-1] > 1:
         classification = class_proba.argmax(axis=-1)
     else:
-        classification = (class_proba > 0.5).astype('int32')
+        classification = (class_proba[:, 0] > 0.5).astype('int32')
 
-    #gets the result (iterativelly, to avoid running out of memory)
-    end = 0
-    r = numpy.empty(n_samples)
-    while end < n_samples:
-        
-        start = end
-        end += 131072  # magic number, power of 2 :D
-        if end > n_samples:
-            end = n_samples
+    #checks if the most likely label is the true one, and converts that 
+    # result to 0/1
+    return (classification != labels(file_object)).astype('float64')
+    
+    
+#keras functions that compute a metric from labels and predictions, by name
+_metric_functions = {}
+
+def metric_value(name, y_true, y_pred):
+    """The mean of keras metric name over one-hot labels and predictions"""
+    if name not in _metric_functions:
+        true = K.placeholder(ndim = 2)
+        pred = K.placeholder(ndim = 2)
+        _metric_functions[name] = K.function([true, pred],
+            [K.mean(keras.metrics.get(name)(true, pred))])
+    return float(_metric_functions[name]([y_true, y_pred])[0])
+
+
+def has_activity_regularizers(model):
+    """Whether some penalties of a keras model depend on its inputs"""
+    for layer in model.layers:
+        if getattr(layer, 'activity_regularizer', None) is not None:
+            return True
+        if hasattr(layer, 'layers') and has_activity_regularizers(layer):
+            return True
+    return False
+
+
+def regularization_loss(classifier):
+    """
+    The penalties on its weights that keras adds to the loss of a model (0
+    for other classifiers)
+    """
+    losses = getattr(classifier, 'losses', None)
+    if not losses:
+        return 0.
+    return float(sum(K.batch_get_value(losses)))
 
-        #checks if the most likely label is the true one
-        data_y = numpy.asarray(file_object['y'][start:end]).argmax(axis=-1)
-        r[start:end] = (classification[start:end] - data_y).astype(bool)
-        #converts that result to 0/1
-        r[start:end] = r[start:end].astype('int32')
 
-    return r
+class Evaluation:
+    """
+    Everything that is measured on a set from a single prediction pass:
+    the probabilities, the loss, the accuracy, the per-sample binary error
+    status and the per-sample confidence for the true label. indexes are
+    the samples of the set that were predicted, None for the whole set.
+    penalty is added to the loss, as keras adds the regularization terms,
+    and the keras metrics named in extra_metrics are also measured.
+    """
     
+    def __init__(self, class_proba, file_object, loss_function = None,
+                 labels = None, indexes = None, penalty = 0.,
+                 extra_metrics = None):
+        self.probabilities = class_proba
+        self.indexes = indexes
+        n_samples = class_proba.shape[0]
+        if labels is None:
+            labels = label_index(file_object).class_ids
+            if indexes is not None:
+                labels = labels[indexes]
+        self.errors = numpy.empty(n_samples)
+        self.confidence = numpy.empty(n_samples)
+        sample_loss = numpy.empty(n_samples)
+        
+        end = 0
+        while end < n_samples:
+            start = end
+            end += 131072  # magic number, power of 2 :D
+            if end > n_samples:
+                end = n_samples
+            
+            data_y = numpy.asarray(labels[start:end])
+            chunk_proba = class_proba[start:end]
+            
+            if chunk_proba.shape[-1] > 1:
+                classification = chunk_proba.argmax(axis=-1)
+                true_proba = chunk_proba[numpy.arange(end - start), data_y]
+            else:
+                classification = (chunk_proba[:, 0] > 0.5).astype('int32')
+                true_proba = numpy.where(data_y == 1, chunk_proba[:, 0],
+                    1. - chunk_proba[:, 0])
+            self.errors[start:end] = (classification != data_y)
+            self.confidence[start:end] = true_proba
+            if loss_function == 'categorical_crossentropy':
+                #same as keras: normalised, clipped, -log(p_true)
+                p = true_proba / chunk_proba.sum(axis=-1)
+                sample_loss[start:end] = -numpy.log(
+                    numpy.clip(p, 1e-7, 1. - 1e-7))
+        
+        self.accuracy = 1.0 - (float(self.errors.sum()) / float(n_samples))
+        if loss_function == 'categorical_crossentropy':
+            self.loss = float(sample_loss.mean()) + penalty
+        else:
+            self.loss = None
+        self.extra_metrics = []
+        if extra_metrics:
+            labels = numpy.asarray(labels)
+            if class_proba.shape[-1] > 1:
+                y_true = numpy.zeros(class_proba.shape, dtype = 'float32')
+                y_true[numpy.arange(n_samples), labels] = 1.
+            else:
+                y_true = labels.astype('float32')[:, numpy.newaxis]
+            self.extra_metrics = [metric_value(name, y_true, class_proba)
+                                  for name in extra_metrics]
     
+    def metrics(self):
+        """
+        The [loss, accuracy, extra metrics...] list, as given by keras'
+        evaluate
+        """
+        return [self.loss, self.accuracy] + self.extra_metrics
+
+
+def evaluate(classifier, file_object, batch_size, loss_function = None,
+             labels = None, sampled_indexes = None, extra_metrics = None,
+             stats = None):
+    """
+    Predicts a set (or the sorted sampled_indexes of it) once and measures
+    everything needed on it (see Evaluation)
+    """
+    
+    class_proba = get_probabilities(classifier, file_object, batch_size,
+                                    sampled_indexes, stats)
+    return Evaluation(class_proba, file_object, loss_function, labels,
+                      sampled_indexes, regularization_loss(classifier),
+                      extra_metrics)
+
+
+def full_evaluation(evaluations, set_name):
+    """
+    The Evaluation of a whole set returned by sequential_model, or None if
+    that set was skipped, subsampled or evaluated with keras
+    """
+    if evaluations is None or evaluations.get(set_name) is None:
+        return None
+    if evaluations[set_name].indexes is not None:
+        return None
+    return evaluations[set_name]
+
+
+def labels(file_object):
+    """Returns the integer class of each sample of a set"""
+    return label_index(file_object).class_ids
+
+
 def accuracy(classifier, file_object, batch_size):
     
     e = errors(classifier, file_object, batch_size)
@@ -363,29 +1120,27 @@ def one_hot(data, n_classes):
     
 def count_classes(file_object):
     """Counts the number of entries on each class"""
-    n_samples, n_classes = file_object['y'].shape
-    sample_count = numpy.asarray([0]*n_classes)
-    
-    end = 0
-    while end < n_samples:
-        start = end
-        end += 131072  # magic number, power of 2 :D
-        if end > n_samples:
-            end = n_samples
-            
-        data_y = numpy.asarray(file_object['y'][start:end])
-        sample_count += numpy.sum(data_y, axis = 0)
-    
-    return sample_count
+    return label_index(file_object).counts
  
  
-def confidence(classifier, file_object, batch_size):
+def confidence(classifier, file_object, batch_size, labels = None):
     """
     Returns the model's confidence for the true label
+    (`labels` are the optional precomputed integer labels of file_object)
     """
     
     class_proba = get_probabilities(classifier, file_object, batch_size)
-    n_samples = file_object['y'].shape[0]
+    return true_class_proba(class_proba, file_object, labels)
+
+
+def true_class_proba(class_proba, file_object, labels = None):
+    """
+    Gathers the probability of the true class of each sample
+    """
+    
+    n_samples = class_proba.shape[0]
+    if labels is None:
+        labels = label_index(file_object).class_ids
     
     end = 0
     h = numpy.empty(n_samples)
@@ -394,11 +1149,9 @@ def confidence(classifier, file_object, batch_size):
         end += 131072  # magic number, power of 2 :D
         if end > n_samples:
             end = n_samples
-            
-        data_y = numpy.asarray(file_object['y'][start:end]).argmax(axis=-1)
         
-        for i in range(end - start):
-            h[start + i] = class_proba[start + i][data_y[i]]
+        data_y = numpy.asarray(labels[start:end])
+        h[start:end] = class_proba[numpy.arange(start, end), data_y]
     
     return h
     
@@ -41,6 +41,23 @@ defaults = { 'random_seed': None,
              'zca_whitening' : False,
              'test_at_each_epoch': True,
              'classification' : True,
+             'cascade_inference' : False,
+             'weights_precision' : 'float32',
+             'checkpoint_dir' : None,
+             'resume_snapshot' : None,
+             'snapshot_prefix' : None,
+             'hooks' : None,
+             'post_training_evaluation' : None,
+             'intermediate_scoring' : None,
+             'warm_start' : None,
+             'eval_batch_size' : None,
+             'autotune' : None,
+             'threads' : None,
+             'budget' : None,
+             'member_memory_budget' : None,
+             'results_sink' : None,
+             'member_spill_dir' : None,
+             'training_deadline' : None,
            }
 
 class Loader(yaml.Loader):
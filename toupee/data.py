@@ -259,6 +259,38 @@ class WeightedResampler(Resampler):
     def make_new_train(self,sample_size):
         return Resampler.make_new_train(self,sample_size,self.weights)
 
+class StratifiedResampler(Resampler):
+    """
+    Resample a dataset uniformly within each class, keeping the class
+    proportions of the original set (uses the set's common.LabelIndex)
+    """
+
+    def __init__(self, label_index, seed = 42):
+        Resampler.__init__(self, len(label_index.class_ids), seed = seed)
+        self.label_index = label_index
+
+    def make_new_train(self,sample_size):
+        counts = self.label_index.counts
+        
+        #number of samples per class, with the rounding remainder going to
+        # the classes with the largest fractional parts
+        exact_sizes = counts * sample_size / float(self.train_size)
+        class_sizes = np.floor(exact_sizes).astype('int64')
+        remainder = sample_size - class_sizes.sum()
+        largest = np.argsort(class_sizes - exact_sizes, kind = 'mergesort')
+        class_sizes[largest[:remainder]] += 1
+        
+        sample = []
+        for c in range(len(counts)):
+            if class_sizes[c] > 0:
+                rows = self.label_index.rows(c)
+                sample.append(rows[np.random.randint(low=0, high=len(rows),
+                                                     size=class_sizes[c])])
+        self.r_train = np.concatenate(sample)
+        
+        return self.r_train, None
+
+
 def transform_aux_map(tr,x):
     return tr.apply(x)
 
@@ -370,6 +402,17 @@ class Transformer:
     def get_data(self):
         return np.array(self.final_x)
 
+def integer_labels(y):
+    """
+    Compact form of a set's labels: the int32 class of each sample and the
+    number of classes, whether y is one-hot or already a vector of classes
+    """
+    y = np.asarray(y)
+    if len(y.shape) > 1:
+        return y.argmax(axis=-1).astype('int32'), y.shape[1]
+    y = y.astype('int32')
+    return y, int(y.max()) + 1
+
 def one_hot(dataset):
     b = np.zeros((dataset.size, dataset.max()+1),dtype='float32')
     b[np.arange(dataset.size), dataset] = 1.
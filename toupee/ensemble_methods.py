@@ -11,8 +11,10 @@ __docformat__ = 'restructedtext en'
 import numpy as np
 from numpy.core.umath_tests import inner1d
 import toupee.mlp as mlp
-from toupee.data import Resampler, WeightedResampler
+from toupee.data import Resampler, WeightedResampler, StratifiedResampler
 import toupee.common as common
+import toupee.timing as timing
+import toupee.parallel as parallel
 import math
 import keras
 from toupee.common import read_yaml_file
@@ -46,6 +48,13 @@ class Aggregator:
         m = np.argmax(a,axis=1)
         return np.eye(self.out_shape[1])[m]
 
+    def accumulate(self, running, proba, index):
+        """
+        Adds the output of member `index` (already predicted) to a running
+        combination, whose argmax is the ensemble's predicted class
+        """
+        raise NotImplementedException()
+
 
 class MajorityVotingRunner(Aggregator):
     """
@@ -59,11 +68,11 @@ class MajorityVotingRunner(Aggregator):
     def predict_proba(self,X):
         prob = []
         for (m_yaml, m_weights) in self.members:
-            m = keras.models.model_from_yaml(m_yaml)
-            m.set_weights(m_weights)
+            m = common.inference_model(m_yaml, m_weights)
             
             if isinstance(X, np.ndarray):   #To test the ensemble with ndarrays 
-                p = m.predict_proba(X, batch_size = self.params.batch_size)   
+                p = m.predict_proba(X,
+                    batch_size = common.inference_batch_size(self.params))   
             else:
                 p = m.predict_generator(X, max_queue_size=1000)
             
@@ -73,6 +82,12 @@ class MajorityVotingRunner(Aggregator):
         a = np.sum(prob_arr,axis=0) / float(len(self.members))
         m = np.argmax(a,axis=1)
         return np.eye(self.out_shape[1])[m]
+
+    def accumulate(self, running, proba, index):
+        #predict_proba votes with the summed probabilities
+        if running is None:
+            return np.array(proba, dtype='float64')
+        return running + proba
         
         
 class AveragingRunner(Aggregator):
@@ -88,11 +103,11 @@ class AveragingRunner(Aggregator):
     def predict_proba(self, X):
         prob = []
         for (m_yaml, m_weights) in self.members:
-            m = keras.models.model_from_yaml(m_yaml)
-            m.set_weights(m_weights)
+            m = common.inference_model(m_yaml, m_weights)
             
             if isinstance(X, np.ndarray):   #To test the ensemble with ndarrays
-                p = m.predict_proba(X, batch_size = self.params.batch_size)   
+                p = m.predict_proba(X,
+                    batch_size = common.inference_batch_size(self.params))   
             else:
                 p = m.predict_generator(X, max_queue_size=1000)
             
@@ -104,34 +119,142 @@ class AveragingRunner(Aggregator):
         a = np.sum(prob_arr,axis=0) / float(len(self.members))
         return a
 
+    def accumulate(self, running, proba, index):
+        if self.wrapper is not None:
+            proba = self.wrapper(proba)
+        if running is None:
+            return np.array(proba, dtype='float64')
+        return running + proba
+
+
+class SammeProba:
+    """
+    The SAMME.R scores of a member's probabilities, as used by real BRN.
+    A class (not a bound method of the ensemble method) so that it can be
+    stored with the aggregator.
+    """
+
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+
+    def __call__(self, proba):
+        proba[proba < np.finfo(proba.dtype).eps] = np.finfo(proba.dtype).eps
+        log_proba = np.log(proba)
+        return (self.n_classes - 1) * (log_proba - (1. / self.n_classes)
+                    * log_proba.sum(axis=1)[:, np.newaxis])
+
 
 class WeightedAveragingRunner(Aggregator):
     """
     Take an Ensemble and produce a weighted average, usually done in AdaBoost
+
+    With cascade=True the members are evaluated in descending weight order,
+    and each sample stops being evaluated as soon as its weighted margin can
+    no longer be overturned by the weight of the remaining members. The
+    predicted classes are the same as with the full average, but the
+    probabilities of the samples that exited early are the weighted average
+    of the members that were evaluated. The average number of members
+    evaluated per sample is stored in `mean_members_evaluated`.
     """
 
 
-    def __init__(self,members,weights,params):
+    def __init__(self,members,weights,params,cascade=False):
         self.params = params
         self.members = members
         self.weights = weights
+        self.cascade = cascade
+        self.mean_members_evaluated = None
 
     def predict_proba(self,X):
+        if self.cascade:
+            return self._cascade_predict_proba(X)
         prob = []
         for i in range(len(self.members)):
             m_yaml, m_weights = self.members[i]
-            m = keras.models.model_from_yaml(m_yaml)
-            m.set_weights(m_weights)
+            m = common.inference_model(m_yaml, m_weights)
             
             if isinstance(X, np.ndarray):   #To test the ensemble with ndarrays
-                p = m.predict_proba(X, batch_size = self.params.batch_size)   
+                p = m.predict_proba(X,
+                    batch_size = common.inference_batch_size(self.params))   
             else:
                 p = m.predict_generator(X, max_queue_size=1000)
 
             prob.append(p * self.weights[i])
+            self.out_shape = m.layers[-1].output_shape
         prob_arr = np.array(prob) / np.sum(self.weights)
         a = np.sum(prob_arr,axis=0)
+        self.mean_members_evaluated = float(len(self.members))
         return a
+
+    def accumulate(self, running, proba, index):
+        if running is None:
+            return self.weights[index] * np.asarray(proba, dtype='float64')
+        return running + self.weights[index] * proba
+
+    def _cascade_predict_proba(self, X):
+        weights = np.asarray(self.weights, dtype='float64')
+        #members with a null weight can never change the outcome
+        order = [i for i in np.argsort(-weights, kind='mergesort')
+                    if weights[i] > 0.]
+        remaining = weights[order].sum()
+        #slack for the different summation order of the full average
+        tolerance = 1e-6 * remaining
+
+        if isinstance(X, np.ndarray):
+            n_samples = X.shape[0]
+            batch_size = common.inference_batch_size(self.params)
+            n_batches = int(math.ceil(n_samples / float(batch_size)))
+        else:
+            n_samples = X.num_examples
+            batch_size = X.batch_size
+            n_batches = len(X)
+
+        scores = None
+        active = np.ones(n_samples, dtype=bool)
+        evaluated = np.zeros(n_samples, dtype='int32')
+        used_weight = np.zeros(n_samples)
+        for i in order:
+            if not active.any():
+                break
+            m_yaml, m_weights = self.members[i]
+            m = common.inference_model(m_yaml, m_weights)
+            self.out_shape = m.layers[-1].output_shape
+            remaining -= weights[i]
+
+            for step in range(n_batches):
+                start = step * batch_size
+                rows = np.flatnonzero(active[start:start + batch_size])
+                if rows.size == 0:
+                    continue
+                if isinstance(X, np.ndarray):
+                    x = X[start:start + batch_size]
+                else:
+                    x = X[step]
+                    if isinstance(x, tuple):
+                        x = x[0]
+                p = m.predict(x[rows], batch_size = batch_size)
+                if scores is None:
+                    scores = np.zeros((n_samples, p.shape[-1]))
+                rows = rows + start
+                scores[rows] += weights[i] * p
+                evaluated[rows] += 1
+                used_weight[rows] += weights[i]
+
+                #the remaining members can move at most `remaining` mass
+                # from the leading class to any other class
+                if scores.shape[-1] > 1:
+                    top = np.partition(scores[rows], -2, axis=-1)
+                    margin = top[:, -1] - top[:, -2]
+                    active[rows] = margin <= remaining + tolerance
+
+        if scores is None:
+            scores = np.zeros((n_samples, 1))
+        self.mean_members_evaluated = float(evaluated.mean())
+        print(("Cascade: {0:.2f} of {1} members evaluated per sample".format(
+            self.mean_members_evaluated, len(self.members))))
+        #each sample is averaged over the members that evaluated it
+        return scores / np.maximum(used_weight, np.finfo('float64').tiny)[
+            :, np.newaxis]
         
         
 # class WeightedAveragingRunner_Regression(Aggregator):
@@ -177,9 +300,61 @@ class EnsembleMethod(common.ConfiguredObject):
     def create_member(self):
         raise NotImplementedException()
 
+    def create_members(self, data_files, n_members, first_member = 0):
+        """
+        Trains the members one after the other, yielding each of them
+        (from first_member, when resuming a run). The random draws of each
+        member (its sample, its initial weights) only depend on its seed.
+        """
+        for i in range(first_member, n_members):
+            print(('\n\ntraining member {0}'.format(i)))
+            timing.timer.set_member(i)
+            parallel.seed_rngs(parallel.member_seed(self.params, i))
+            yield self.create_member(data_files)
+
     def prepare(self, params, dataset):
         raise NotImplementedException()
 
+    def warm_start(self):
+        """
+        The parameters and the initial weights (per layer, or a keras 
+        weights file) of the next member, following params.warm_start
+        """
+        policy = self.params.warm_start
+        if policy is None:
+            return self.params, None, None
+        source = policy.get('from', 'previous')
+        if source == 'previous':
+            #the first member is trained from scratch
+            if self.previous_weights is None:
+                return self.params, None, None
+            model_weights, model_weights_file = self.previous_weights, None
+        else:
+            model_weights, model_weights_file = None, source
+        params = copy.copy(self.params)
+        params.optimizer = copy.deepcopy(self.params.optimizer)
+        if 'n_epochs' in policy:
+            params.n_epochs = policy['n_epochs']
+        if 'lr' in policy:
+            params.optimizer['config']['lr'] = policy['lr']
+        return params, model_weights, model_weights_file
+
+    def train_member(self, dataset):
+        """Trains the next member, warm-started if required"""
+        params, model_weights, model_weights_file = self.warm_start()
+        #seeded as in a parallel worker, in the same session
+        parallel.seed_member(parallel.member_seed(self.params,
+                                                  self.member_number))
+        m, self.last_evaluations = mlp.sequential_model(dataset, params,
+                member_number = self.member_number,
+                model_weights = model_weights,
+                model_weights_file = model_weights_file,
+                return_evaluations = True)
+        if self.params.warm_start is not None and \
+                self.params.warm_start.get('from', 'previous') == 'previous':
+            self.previous_weights = [l.get_weights() for l in m.layers]
+        return m
+
     def load_weights(self,weights,x,y,index):
         self.members = []
         self.weights = []
@@ -204,14 +379,16 @@ class AdaBoost_M1(EnsembleMethod):
     yaml_tag = '!AdaBoostM1'
 
     def create_aggregator(self,params,members,train_set,valid_set):
-        return WeightedAveragingRunner(members,self.alphas,params)
+        return WeightedAveragingRunner(members,self.alphas,params,
+                cascade = params.cascade_inference)
 
     def create_member(self, data_files):
             
         #Gets the training indexes
         if self.member_number > 0:
-            train_indexes = \
-                self.resampler.make_new_train(self.params.resample_size)
+            with timing.timer.phase('resample'):
+                train_indexes = \
+                    self.resampler.make_new_train(self.params.resample_size)
         else:
             train_indexes = [None,None]
         
@@ -222,30 +399,35 @@ class AdaBoost_M1(EnsembleMethod):
         ]
         
         #Trains the model
-        m = mlp.sequential_model(dataset, self.params,
-                member_number = self.member_number)
+        m = self.train_member(dataset)
                 
         #Gets the errors for the train set and updates the weights
-        print('Getting the train errors and updating the weights')
-        errors = common.errors(m, data_files[0], self.params.batch_size)
+        with timing.timer.phase('boosting_update'):
+            print('Getting the train errors and updating the weights')
+            evaluation = common.full_evaluation(self.last_evaluations, 'train')
+            if evaluation is not None:
+                errors = evaluation.errors
+            else:
+                errors = common.errors(m, data_files[0],
+                    common.inference_batch_size(self.params))
         
-        e = np.sum((errors * self.D))
-        if e > 0:
-            n_classes = data_files[0]['y'].shape[1]
-            alpha = .5 * (math.log((1-e)/e) + math.log(n_classes-1))
-            if alpha <= 0.0:
-                #By setting to 0 (instead of crashing), we should avoid 
-                # cicleci problems
-                print("\nWARNING - NEGATIVE ALPHA (setting to 0.0)\n")
-                alpha = 0.0
-            w = np.where(errors == 1,
-                self.D * math.exp(alpha),
-                self.D * math.exp(-alpha))
-            self.D = w / w.sum()
-        else:
-            alpha = 1.0 / (self.member_number + 1)
-        self.resampler.update_weights(self.D)
-        self.alphas.append(alpha)
+            e = np.sum((errors * self.D))
+            if e > 0:
+                n_classes = common.label_index(data_files[0]).n_classes
+                alpha = .5 * (math.log((1-e)/e) + math.log(n_classes-1))
+                if alpha <= 0.0:
+                    #By setting to 0 (instead of crashing), we should avoid 
+                    # cicleci problems
+                    print("\nWARNING - NEGATIVE ALPHA (setting to 0.0)\n")
+                    alpha = 0.0
+                w = np.where(errors == 1,
+                    self.D * math.exp(alpha),
+                    self.D * math.exp(-alpha))
+                self.D = w / w.sum()
+            else:
+                alpha = 1.0 / (self.member_number + 1)
+            self.resampler.update_weights(self.D)
+            self.alphas.append(alpha)
         self.member_number += 1
         return (m.to_yaml(), m.get_weights())
 
@@ -257,6 +439,7 @@ class AdaBoost_M1(EnsembleMethod):
         self.D = self.resampler.weights
         self.alphas = []
         self.member_number = 0
+        self.previous_weights = None
 
     def serialize(self):
         return 'AdaBoostM1'
@@ -272,14 +455,16 @@ class AdaBoost_MA(EnsembleMethod):
     yaml_tag = '!AdaBoostMA'
     
     def create_aggregator(self,params,members,train_set,valid_set):
-        return WeightedAveragingRunner(members,self.alphas,params)
+        return WeightedAveragingRunner(members,self.alphas,params,
+                cascade = params.cascade_inference)
 
     def create_member(self, data_files):
             
         #Gets the training indexes and defines c, if needed
         if self.member_number > 0:
-            train_indexes = \
-                self.resampler.make_new_train(self.params.resample_size)
+            with timing.timer.phase('resample'):
+                train_indexes = \
+                    self.resampler.make_new_train(self.params.resample_size)
         else:
             train_indexes = [None,None]
             sample_counts = common.count_classes(data_files[0])
@@ -292,29 +477,34 @@ class AdaBoost_MA(EnsembleMethod):
         ]
         
         #Trains the model
-        m = mlp.sequential_model(dataset, self.params,
-                member_number = self.member_number)
+        m = self.train_member(dataset)
                 
         #Gets the errors for the train set and updates the weights
-        print('Getting the confidence and updating the weights')
-        h = common.confidence(m, data_files[0], self.params.batch_size)
+        with timing.timer.phase('boosting_update'):
+            print('Getting the confidence and updating the weights')
+            evaluation = common.full_evaluation(self.last_evaluations, 'train')
+            if evaluation is not None:
+                h = evaluation.confidence
+            else:
+                h = common.confidence(m, data_files[0],
+                    common.inference_batch_size(self.params))
         
-        r = np.sum((h * self.D))
-        if r > self.c:
-            alpha = math.log(((1-self.c)*r)/(self.c*(1-r)))
-            if alpha <= 0.0:
-                #By setting to 0 (instead of crashing), we should avoid 
-                # cicleci problems
-                print("\nWARNING - NEGATIVE ALPHA (setting to 0.0)\n")
+            r = np.sum((h * self.D))
+            if r > self.c:
+                alpha = math.log(((1-self.c)*r)/(self.c*(1-r)))
+                if alpha <= 0.0:
+                    #By setting to 0 (instead of crashing), we should avoid 
+                    # cicleci problems
+                    print("\nWARNING - NEGATIVE ALPHA (setting to 0.0)\n")
+                    alpha = 0.0
+                w = self.D * math.exp(-alpha * (h - self.c))
+                self.D = w / w.sum()
+            else:
+                #This model should be discarded, since it's worse than containing
+                # no additional information
                 alpha = 0.0
-            w = self.D * math.exp(-alpha * (h - self.c))
-            self.D = w / w.sum()
-        else:
-            #This model should be discarded, since it's worse than containing
-            # no additional information
-            alpha = 0.0
-        self.resampler.update_weights(self.D)
-        self.alphas.append(alpha)
+            self.resampler.update_weights(self.D)
+            self.alphas.append(alpha)
         self.member_number += 1
         return (m.to_yaml(), m.get_weights())
 
@@ -326,6 +516,7 @@ class AdaBoost_MA(EnsembleMethod):
         self.D = self.resampler.weights
         self.alphas = []
         self.member_number = 0
+        self.previous_weights = None
 
     def serialize(self):
         return 'AdaBoostMA'
@@ -348,13 +539,23 @@ class Bagging(EnsembleMethod):
         else:
             return AveragingRunner(members,params)
 
-    def create_member(self, data_files):
+    def train_indexes(self, data_files):
     
+        #the stratified resampler needs the labels of the train set
+        if 'stratified' in self.__dict__ and self.stratified and \
+                not isinstance(self.resampler, StratifiedResampler):
+            self.resampler = StratifiedResampler(
+                common.label_index(data_files[0]))
+        
         #gets the training indexes
         if self.member_number > 0:
-            train_indexes = self.resampler.make_new_train(self.params.resample_size)
-        else:
-            train_indexes = [None,None]
+            with timing.timer.phase('resample'):
+                return self.resampler.make_new_train(self.params.resample_size)
+        return [None,None]
+
+    def create_member(self, data_files):
+        
+        train_indexes = self.train_indexes(data_files)
         
         #packs the needed data
         dataset = [
@@ -363,17 +564,64 @@ class Bagging(EnsembleMethod):
         ]
         
         #trains the model
-        m = mlp.sequential_model(dataset, self.params,
-                member_number = self.member_number)
+        m = self.train_member(dataset)
     
         self.member_number += 1
         return (m.to_yaml(), m.get_weights())
 
+    def create_members(self, data_files, n_members, first_member = 0):
+        """
+        With processes set, the members are trained in that many worker
+        processes, and yielded in member order as they are ready
+        """
+        if 'processes' not in self.__dict__ or self.processes is None:
+            for m in EnsembleMethod.create_members(self, data_files,
+                                                   n_members, first_member):
+                yield m
+            return
+        
+        if self.params.warm_start is not None and \
+                self.params.warm_start.get('from', 'previous') == 'previous':
+            raise ValueError("parallel Bagging can't warm start from the "
+                             "previous member")
+        if self.params.budget is not None:
+            raise ValueError("parallel Bagging can't be trained on a budget")
+        if 'threads_per_process' in self.__dict__ and \
+                self.threads_per_process is not None:
+            threads = self.threads_per_process
+        else:
+            threads = parallel.threads_per_process(self.processes)
+        
+        #each sample is drawn from its member's seed, as in a serial run,
+        # and kept until its member is done (a resumed run has them already)
+        if 'drawn_indexes' not in self.__dict__:
+            self.drawn_indexes = {}
+        jobs = []
+        for i in range(first_member, n_members):
+            if i not in self.drawn_indexes:
+                parallel.seed_rngs(parallel.member_seed(self.params, i))
+                self.drawn_indexes[i] = self.train_indexes(data_files)
+                self.member_number += 1
+            params, _, model_weights_file = self.warm_start()
+            jobs.append(parallel.member_job(params, data_files,
+                self.drawn_indexes[i], i, threads, model_weights_file))
+        
+        print(('\n\ntraining {0} members in {1} processes of {2} threads'
+            .format(len(jobs), self.processes, threads)))
+        for i, (yaml, weights, evaluations) in enumerate(
+                parallel.train_members(jobs, self.processes), first_member):
+            print(('\n\ntrained member {0}'.format(i)))
+            timing.timer.set_member(i)
+            self.last_evaluations = evaluations
+            del self.drawn_indexes[i]
+            yield (yaml, weights)
+
     def prepare(self, params, train_size):
         self.params = params
         self.train_size = train_size
         self.resampler = Resampler(train_size)
         self.member_number = 0
+        self.previous_weights = None
 
     def serialize(self):
         return 'Bagging'
@@ -511,16 +759,11 @@ class BRN(EnsembleMethod):
 
     def create_aggregator(self,params,members,train_set,valid_set):
         if self.real:
-            return AveragingRunner(members, params, self._samme_proba)
+            return AveragingRunner(members, params,
+                                   SammeProba(self.n_classes))
         else:
             return WeightedAveragingRunner(members, self.alphas, params)
 
-    def _samme_proba(self, proba):
-        proba[proba < np.finfo(proba.dtype).eps] = np.finfo(proba.dtype).eps
-        log_proba = np.log(proba)
-        return (self.n_classes - 1) * (log_proba - (1. / self.n_classes)
-                    * log_proba.sum(axis=1)[:, np.newaxis])
-
     def _residual_block(self, injection_index, new_layers, m, member_number):
         #get output shape of last layer before injection from m
         if injection_index > 0:
@@ -28,6 +28,8 @@ from toupee.data import Resampler, Transformer
 import toupee.config as config
 import toupee.common as common
 import toupee.utils as utils
+import toupee.timing as timing
+import toupee.parallel as parallel
 
 import keras
 import keras.preprocessing.image
@@ -35,7 +37,7 @@ from keras import backend as K
 
 
 def initialize_model(params, sample_weight, model_config, model_yaml, 
-                        model_weights, frozen_layers):
+                        model_weights, frozen_layers, model_weights_file = None):
     
     print("loading model...")
     if sample_weight is not None:
@@ -44,9 +46,8 @@ def initialize_model(params, sample_weight, model_config, model_yaml,
         model = keras.models.Sequential.from_config(model_config)
     else:
         if model_yaml is None:
-            with open(params.model_file, 'r') as model_file:
-                model_yaml = model_file.read()
-        model = keras.models.model_from_yaml(model_yaml)
+            model_yaml = common.read_model_file(params.model_file)
+        model = common.build_model(model_yaml)
     total_weights = 0
 
     #TODO: this count is broken for Model layers
@@ -56,6 +57,9 @@ def initialize_model(params, sample_weight, model_config, model_yaml,
     if model_weights is not None:
         for i in range(len(model_weights)):
             model.layers[i].set_weights(model_weights[i])
+    elif model_weights_file is not None:
+        print(("loading weights from {0}".format(model_weights_file)))
+        model.load_weights(model_weights_file)
 
     print(("total weight count: {0}".format(total_weights)))
     
@@ -69,7 +73,43 @@ def initialize_model(params, sample_weight, model_config, model_yaml,
 
     
 
-def initialize_metrics(params):
+def snapshot_file(params, member_number):
+    """
+    Where the best weights of a member are saved: in checkpoint_dir, named
+    after snapshot_prefix (the experiment and seed of an ensemble run)
+    """
+    if params.checkpoint_dir is None:
+        return None
+    name = 'member-{0}.best.npz'.format(member_number or 0)
+    if params.snapshot_prefix is not None:
+        name = '{0}-{1}'.format(params.snapshot_prefix, name)
+    return os.path.join(params.checkpoint_dir, name)
+
+
+def resume_snapshot(model, params, member_number, checkpointer):
+    '''
+    Restores the snapshot of an interrupted member (params.resume_snapshot)
+    into the model and the checkpointer. Returns the epoch to continue from.
+    '''
+    if params.resume_snapshot is None or \
+            params.resume_snapshot != (member_number or 0):
+        return 0
+    filename = snapshot_file(params, member_number)
+    if filename is None or not os.path.exists(filename):
+        return 0
+    weights, epoch, best = common.load_snapshot(filename)
+    if [w.shape for w in weights] != [w.shape for w in model.get_weights()]:
+        print(("WARNING: {0} doesn't match the model, training the member "
+               "from scratch".format(filename)))
+        return 0
+    print(("resuming from {0}: the best weights of epoch {1}".format(
+        filename, epoch)))
+    model.set_weights(weights)
+    checkpointer.restore(weights, epoch, best)
+    return epoch + 1
+
+
+def initialize_metrics(params, member_number = None):
     
     if params.classification == True:   
         scorer_name = 'accuracy'
@@ -80,16 +120,78 @@ def initialize_metrics(params):
     
     metrics = [scorer_name]
     if 'additional_metrics' in params.__dict__:
-        metrics = metrics + additional_metrics
+        metrics = metrics + params.additional_metrics
+
+    #optionally keeps a copy of the best weights on disk, written in the 
+    # background, so that a crash doesn't lose the whole member
+    save_to = snapshot_file(params, member_number)
+    if save_to is not None and not os.path.exists(params.checkpoint_dir):
+        os.makedirs(params.checkpoint_dir)
 
     checkpointer = common.ModelCheckpointInMemory(verbose=1,
             monitor = monitor_type,
-            mode = 'max')
+            mode = 'max',
+            save_to = save_to)
             
     return(metrics, checkpointer)
 
     
     
+#compiled models, reused by the members with the same architecture and
+# training setup
+_training_models = {}
+
+#layers that draw random numbers while training: the random ops of a
+# reused model would carry on from the previous member, so models with
+# them are built again for each member
+_random_layers = ('Dropout', 'SpatialDropout1D', 'SpatialDropout2D',
+                  'SpatialDropout3D', 'GaussianNoise', 'GaussianDropout',
+                  'AlphaDropout')
+
+def training_model_key(params, model_yaml, metrics):
+    return (common.model_hash(model_yaml),
+            json.dumps(params.optimizer, sort_keys = True),
+            params.cost_function, tuple(metrics))
+
+
+def random_while_training(config):
+    """Whether a model config has layers that are random while training"""
+    if isinstance(config, dict):
+        if config.get('class_name') in _random_layers:
+            return True
+        if config.get('dropout') or config.get('recurrent_dropout'):
+            return True
+        return any(random_while_training(v) for v in config.values())
+    if isinstance(config, list):
+        return any(random_while_training(v) for v in config)
+    return False
+
+
+def initial_weights(model_yaml, seed):
+    """
+    The initial weights of a model of model_yaml seeded with seed. They are
+    drawn in a scratch graph, so they only depend on the seed.
+    """
+    import tensorflow as tf
+    with tf.Graph().as_default() as graph:
+        with tf.Session(graph = graph):
+            parallel.seed_member(seed)
+            return common.build_model(model_yaml).get_weights()
+
+
+def reinitialize_model(model, model_yaml, seed):
+    """Sets the initial weights of seed and resets the optimizer's state"""
+    model.set_weights(initial_weights(model_yaml, seed))
+    optimizer_weights = getattr(model.optimizer, 'weights', [])
+    if optimizer_weights:
+        K.get_session().run([v.initializer for v in optimizer_weights])
+
+
+def clear_model_cache():
+    _training_models.clear()
+    common.clear_model_cache()
+
+
 def callbacks_with_lr_scheduler(schedule, model, callbacks):
     def scheduler(epoch):
         if epoch in schedule:
@@ -101,6 +203,88 @@ def callbacks_with_lr_scheduler(schedule, model, callbacks):
     return callbacks + [keras.callbacks.LearningRateScheduler(scheduler)]   
     
 
+def single_pass_evaluation(params, model):
+    """
+    Whether common.evaluate can replace keras' evaluate_generator (the loss
+    is only computed for categorical crossentropy, with the penalties on
+    the weights but not those that depend on the inputs)
+    """
+    return (params.classification and
+            params.cost_function == 'categorical_crossentropy' and
+            not common.has_activity_regularizers(model))
+
+
+def evaluation_modes(params):
+    """
+    How each set is evaluated after training: 'full', 'skip' or the size of
+    a random subsample
+    """
+    modes = {'train': 'full', 'valid': 'full', 'test': 'full'}
+    if params.post_training_evaluation is not None:
+        modes.update(params.post_training_evaluation)
+    for set_name, mode in modes.items():
+        #yaml's true/false are ints too
+        if mode not in ('full', 'skip') and not (isinstance(mode, int) and
+                not isinstance(mode, bool) and mode > 0):
+            raise ValueError("invalid post_training_evaluation for the "
+                             "{0} set: {1}".format(set_name, mode))
+    return modes
+
+
+def evaluation_indexes(mode, file_object, rng):
+    """The sorted sample of a set to evaluate, None for the whole set"""
+    n_samples = len(common.labels(file_object))
+    if mode == 'full' or mode >= n_samples:
+        return None
+    return numpy.sort(rng.choice(n_samples, mode, replace = False))
+
+
+def evaluate_sets(model, params, files):
+    """
+    Evaluates the trained model on the train, valid and test sets, as set by
+    params.post_training_evaluation. Returns the common.Evaluation of each
+    set (None if keras had to be used, or for a skipped set), the metrics
+    of each set (None for a skipped set) and the DataGeneratorStats of the
+    reads of each set.
+    """
+    modes = evaluation_modes(params)
+    rng = numpy.random.RandomState(params.random_seed)
+    #a single prediction pass per set gives the metrics, and the 
+    # per-sample errors and confidences the ensemble methods need
+    single_pass = single_pass_evaluation(params, model)
+    evaluations = {} if single_pass else None
+    all_metrics = []
+    all_stats = {}
+    for set_name, set_file in zip(('train', 'valid', 'test'), files):
+        if modes[set_name] == 'skip':
+            print(('Skipping the {0} metrics'.format(set_name)))
+            if single_pass:
+                evaluations[set_name] = None
+            all_metrics.append(None)
+            continue
+        indexes = evaluation_indexes(modes[set_name], set_file, rng)
+        if indexes is None:
+            print(('Getting the {0} metrics...'.format(set_name)))
+        else:
+            print(('Getting the {0} metrics on {1} samples...'.format(
+                set_name, len(indexes))))
+        all_stats[set_name] = common.DataGeneratorStats()
+        if single_pass:
+            evaluations[set_name] = common.evaluate(model, set_file,
+                common.inference_batch_size(params),
+                loss_function = params.cost_function,
+                sampled_indexes = indexes,
+                extra_metrics = params.__dict__.get('additional_metrics'),
+                stats = all_stats[set_name])
+            all_metrics.append(evaluations[set_name].metrics())
+        else:
+            holder = common.DataGenerator(set_file,
+                common.inference_batch_size(params), indexes,
+                stats = all_stats[set_name])
+            all_metrics.append(model.evaluate_generator(holder))
+    return evaluations, all_metrics, all_stats
+
+
 def print_results(model, train_metrics, valid_metrics, test_metrics):
     
     for metrics_name,metrics in (
@@ -109,6 +293,9 @@ def print_results(model, train_metrics, valid_metrics, test_metrics):
             ('test', test_metrics)
         ):
         print(("{0}:".format(metrics_name)))
+        if metrics is None:
+            print("  skipped")
+            continue
         for i in range(len(metrics)):
             print(("  {0} = {1}".format(model.metrics_names[i], metrics[i])))
 
@@ -123,15 +310,47 @@ def sequential_model(dataset,
                      model_config = None,
                      frozen_layers = None,
                      sample_weight = None,
+                     return_evaluations = False,
+                     model_weights_file = None,
                      ):
     """
     Initialize the parameters and create the network.
     [GENERATOR DATA VERSION]
+    With return_evaluations, the common.Evaluation of the best model on
+    each set is also returned, as a dict keyed by 'train', 'valid' and
+    'test' (None if the model was evaluated with keras instead). Its
+    probabilities are the model's predictions, and can be reused instead
+    of predicting the set again (see common.full_evaluation).
     """
 
-    #_ was "total_weights" before
-    model, _ = initialize_model(params, sample_weight, model_config, 
-                                            model_yaml, model_weights, frozen_layers)
+    hooks = common.toupee_global_instance
+    hooks.install_hooks(params.hooks)
+    hooks.start_member(member_number)
+    
+    metrics, checkpointer = initialize_metrics(params, member_number)
+    
+    #a member that starts from scratch reuses the compiled model of an
+    # earlier one, with the initial weights of its seed (the learning rate
+    # schedule changes the optimizer, so those are always built again)
+    seed = parallel.member_seed(params, member_number)
+    model = None
+    model_key = None
+    if (model_config is None and model_weights is None and
+            model_weights_file is None and frozen_layers is None and
+            sample_weight is None and
+            not isinstance(params.optimizer['config']['lr'], dict)):
+        if model_yaml is None:
+            model_yaml = common.read_model_file(params.model_file)
+        if not random_while_training(common.model_config(model_yaml)):
+            model_key = training_model_key(params, model_yaml, metrics)
+            model = _training_models.get(model_key)
+    if model is not None:
+        print("reusing the compiled model...")
+    else:
+        #_ was "total_weights" before
+        model, _ = initialize_model(params, sample_weight, model_config, 
+                                                model_yaml, model_weights, frozen_layers,
+                                                model_weights_file)
 
     if return_results:
         results = common.Results(params)
@@ -143,34 +362,47 @@ def sequential_model(dataset,
     files = dataset[1]
     
     train_holder = common.DataGenerator(files[0], params.batch_size, sampled_indexes)
-    train_eval_holder = common.DataGenerator(files[0], params.batch_size, None)
-    valid_holder = common.DataGenerator(files[1], params.batch_size, None)
-    test_holder = common.DataGenerator(files[2], params.batch_size, None)
+    eval_batch_size = common.inference_batch_size(params)
+    valid_holder = common.DataGenerator(files[1], eval_batch_size, None)
     
-    start_time = time.clock()
+    start_time = time.perf_counter()
     
-    metrics, checkpointer = initialize_metrics(params)
-    callbacks = [checkpointer]
+    callbacks = [checkpointer, timing.TimingCallback(timing.timer),
+                 common.HooksCallback(hooks)]
 
     if params.early_stopping is not None:
         earlyStopping=keras.callbacks.EarlyStopping(monitor='val_loss',
             patience=params.early_stopping['patience'], verbose=0, mode='auto')
         callbacks.append(earlyStopping)
 
+    if params.training_deadline is not None:
+        callbacks.append(common.DeadlineStopping(params.training_deadline))
+
     lr_schedule = None
     if isinstance(params.optimizer['config']['lr'], dict):
         lr_schedule = params.optimizer['config']['lr']
         params.optimizer['config']['lr'] = lr_schedule[0]
-    optimizer = keras.optimizers.deserialize(params.optimizer)
-    
-    model.compile(optimizer = optimizer,
-                  loss = params.cost_function,
-                  metrics = metrics,
-                  
-                  #theano stuff:    #<--- old keras-fork version
-                  # update_inputs = params.update_inputs,
-                  # update_inputs_lr = params.update_inputs_lr
-    )
+    if model_key not in _training_models:
+        optimizer = keras.optimizers.deserialize(params.optimizer)
+        
+        model.compile(optimizer = optimizer,
+                      loss = params.cost_function,
+                      metrics = metrics,
+                      
+                      #theano stuff:    #<--- old keras-fork version
+                      # update_inputs = params.update_inputs,
+                      # update_inputs_lr = params.update_inputs_lr
+        )
+        if model_key is not None:
+            _training_models[model_key] = model
+    if model_key is not None:
+        reinitialize_model(model, model_yaml, seed)
+    #the draws of the training don't depend on whether the model was built
+    parallel.seed_rngs(seed)
+
+    #an interrupted member continues after the epoch of its best weights
+    initial_epoch = resume_snapshot(model, params, member_number,
+                                    checkpointer)
 
     #TODO - Joao: I think this if branch needs to be updated with the new data holder
     if params.online_transform is not None:
@@ -181,62 +413,97 @@ def sequential_model(dataset,
         print('Verbosity level:', params.verbose)
         if lr_schedule is not None:
             callbacks = callbacks_with_lr_scheduler(lr_schedule, model, callbacks)
-        if return_results:
-            hist = model.fit_generator(train_holder,
-                  epochs = params.n_epochs,
-                  validation_data = valid_holder,
-                  callbacks = callbacks,
-                  max_queue_size=1000,
-                  shuffle=False,
-                  verbose=params.verbose,
-                  use_multiprocessing=False)    #<------------ Don't use more than 1 worker! Will crash [Gen class must be upgraded]
-                  #the old keras-fork version had more parameters here
-        else:
-            print('Verbosity level:', params.verbose)
-            model.fit_generator(train_holder,
-                  epochs = params.n_epochs,
-                  validation_data = valid_holder,
-                  callbacks = callbacks,
-                  max_queue_size=1000,
-                  shuffle=False,
-                  verbose=params.verbose,
-                  use_multiprocessing=False)    #<------------ Don't use more than 1 worker! Will crash [Gen class must be upgraded]
-                  #the old keras-fork version had more parameters here
+        try:
+            if return_results:
+                hist = model.fit_generator(train_holder,
+                      epochs = params.n_epochs,
+                      initial_epoch = initial_epoch,
+                      validation_data = valid_holder,
+                      callbacks = callbacks,
+                      max_queue_size=1000,
+                      shuffle=False,
+                      verbose=params.verbose,
+                      use_multiprocessing=False)    #<------------ Don't use more than 1 worker! Will crash [Gen class must be upgraded]
+                      #the old keras-fork version had more parameters here
+            else:
+                print('Verbosity level:', params.verbose)
+                model.fit_generator(train_holder,
+                      epochs = params.n_epochs,
+                      initial_epoch = initial_epoch,
+                      validation_data = valid_holder,
+                      callbacks = callbacks,
+                      max_queue_size=1000,
+                      shuffle=False,
+                      verbose=params.verbose,
+                      use_multiprocessing=False)    #<------------ Don't use more than 1 worker! Will crash [Gen class must be upgraded]
+                      #the old keras-fork version had more parameters here
+        finally:
+            #keras doesn't end the callbacks when fit raises
+            checkpointer.close()
+    #the member is trained, its snapshot won't be resumed
+    checkpointer.remove_snapshot()
                   
-    model.set_weights(checkpointer.best_model)
+    if checkpointer.best_epoch is not None:
+        model.set_weights(checkpointer.best_model)
     
     #evals everything with a generator
-    print('\nGetting the train metrics...')
-    train_metrics = model.evaluate_generator(train_eval_holder)
-    print('Getting the validation metrics...')
-    valid_metrics = model.evaluate_generator(valid_holder)
-    print('Getting the test metrics...')
-    test_metrics = model.evaluate_generator(test_holder)
+    with timing.timer.phase('post_training_evaluation'):
+        evaluations, (train_metrics, valid_metrics, test_metrics), \
+            eval_stats = evaluate_sets(model, params, files)
             
     print_results(model, train_metrics, valid_metrics, test_metrics)
 
+    #the reads of the training, then of the post-training evaluation
+    io_stats = {}
+    print("Data loading:")
+    all_stats = [('train', train_holder.stats), ('valid', valid_holder.stats)]
+    all_stats += [(set_name + '_eval', eval_stats[set_name])
+                  for set_name in ('train', 'valid', 'test')
+                  if set_name in eval_stats]
+    for stats_name, stats in all_stats:
+        stats.print_summary(stats_name)
+        io_stats[stats_name] = stats.summary()
+
     if return_results:
         results.set_history(hist)
     
-    end_time = time.clock()
+    end_time = time.perf_counter()
     
-    print((('Optimization complete.\nBest valid: %f \n'
-        'Obtained at epoch: %i\nTest: %f ') %
-          (valid_metrics[1],
-              checkpointer.best_epoch + 1, test_metrics[1])))
+    best_valid = valid_metrics[1] if valid_metrics is not None else None
+    best_test = test_metrics[1] if test_metrics is not None else None
+    #no epoch improved on the monitored value (e.g. it was never logged)
+    best_epoch = None
+    if checkpointer.best_epoch is not None:
+        best_epoch = checkpointer.best_epoch + 1
+    print((('Optimization complete.\nBest valid: {0} \n'
+        'Obtained at epoch: {1}\nTest: {2} ').format(best_valid,
+              best_epoch, best_test)))
     print(('The code for ' + os.path.split(__file__)[1] +
                           ' ran for %.2fm' % ((end_time - start_time) / 60.)))
     
     if return_results:
-        results.set_final_observation(valid_metrics[1],
-            test_metrics[1],
-            checkpointer.best_epoch + 1)
+        results.set_timings(timing.timer.summary())
+        results.set_io_stats(io_stats)
+        results.set_final_observation(best_valid,
+            best_test,
+            best_epoch)
 
     if (member_number is not None) and (return_results):
         results.member_number = member_number
+    
+    hooks.end_member(train_metrics = train_metrics,
+                     valid_metrics = valid_metrics,
+                     test_metrics = test_metrics,
+                     best_epoch = checkpointer.best_epoch,
+                     io_stats = io_stats)
 
+    returned = [model]
     if return_results:
-        return model, results
+        returned.append(results)
+    if return_evaluations:
+        returned.append(evaluations)
+    if len(returned) > 1:
+        return tuple(returned)
     else:
         return model
 
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Training of independent ensemble members in a pool of worker processes
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import copy
+import hashlib
+import random
+import multiprocessing
+import concurrent.futures
+import numpy
+import h5py
+
+import toupee.common as common
+
+
+def open_data_file(file_name):
+    """Opens a data set read-only, as bin/ensemble.py does"""
+    if file_name.endswith('.h5'):
+        return h5py.File(file_name, 'r')
+    return numpy.load(file_name)
+
+
+def member_seed(params, member_number):
+    """
+    The seed of a member, the same whether it is trained serially, in a
+    worker or after resuming a run. It is a hash of the run's seed and the
+    member number, so that the members of runs with consecutive seeds don't
+    share their seeds.
+    """
+    key = '{0}:{1}'.format(params.random_seed, member_number or 0)
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:8], 16) % \
+        (2 ** 31)
+
+
+def seed_rngs(seed):
+    numpy.random.seed(seed)
+    random.seed(seed)
+
+
+def seed_member(seed):
+    """
+    Seeds python, numpy and the graph of the keras session. Keras draws the
+    seed of each random op from numpy, so the ops built afterwards give the
+    same values whatever the session ran before.
+    """
+    import tensorflow as tf
+    seed_rngs(seed)
+    tf.set_random_seed(seed)
+
+
+def member_job(params, data_files, train_indexes, member_number, threads,
+               model_weights_file = None):
+    """
+    Everything a worker needs to train a member. Each member gets its own
+    seed, so that it doesn't matter which worker trains it.
+    """
+    params = copy.copy(params)
+    #the ensemble method stays in the parent
+    params.method = None
+    seed = member_seed(params, member_number)
+    return {
+        'params': params,
+        'files': [common.data_file_name(f) for f in data_files],
+        'train_indexes': train_indexes,
+        'member_number': member_number,
+        'model_weights_file': model_weights_file,
+        'threads': threads,
+        'seed': seed,
+    }
+
+
+#the threads of the worker's session, once it has been configured
+_worker_threads = []
+
+def configure_session(threads, seed):
+    """
+    Seeds the worker's keras session for a member, limiting it to threads
+    threads the first time. The session is kept across the members, with
+    the models cached in it.
+    """
+    if _worker_threads != [threads]:
+        from toupee.autotune import use_threads
+        use_threads(threads)
+        _worker_threads[:] = [threads]
+    seed_member(seed)
+
+
+def train_member(job):
+    """Worker side: trains a member and returns its yaml, weights and
+    evaluations"""
+    import toupee.mlp as mlp
+    configure_session(job['threads'], job['seed'])
+    files = [open_data_file(f) for f in job['files']]
+    try:
+        m, evaluations = mlp.sequential_model([job['train_indexes'], files],
+                job['params'], member_number = job['member_number'],
+                model_weights_file = job['model_weights_file'],
+                return_evaluations = True)
+        return (m.to_yaml(), m.get_weights(), evaluations)
+    finally:
+        for f in files:
+            f.close()
+
+
+def train_members(jobs, processes):
+    """
+    Trains the members of jobs in a pool of processes, yielding them in
+    member order as they are ready
+    """
+    #keras and tensorflow don't survive a fork
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers = processes,
+                                                mp_context = context) as pool:
+        futures = [pool.submit(train_member, job) for job in jobs]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def threads_per_process(processes):
+    return max(1, multiprocessing.cpu_count() // processes)
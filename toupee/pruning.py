@@ -0,0 +1,157 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Ensemble pruning from cached member predictions
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import copy
+import time
+import numpy as np
+
+import toupee.common as common
+
+
+def member_predictions(members, file_object, batch_size):
+    """
+    Predicts a set once with every member. Returns the (members, samples,
+    classes) array of probabilities and the inference time of each member,
+    in seconds.
+    """
+    predictions = []
+    costs = []
+    for (m_yaml, m_weights) in members:
+        m = common.inference_model(m_yaml, m_weights)
+        x_holder = common.DataGenerator(file_object, batch_size, None,
+                hold_y = False)
+        start_time = time.time()
+        predictions.append(m.predict_generator(x_holder,
+                max_queue_size=1000))
+        costs.append(time.time() - start_time)
+    return np.asarray(predictions, dtype='float32'), np.asarray(costs)
+
+
+#every aggregator, majority voting included, predicts the class with the
+# highest weighted sum of the member probabilities
+
+def subset_accuracy(predictions, weights, y, subset):
+    """Accuracy of the weighted combination of the members in `subset`"""
+    if len(subset) == 0:
+        return 0.
+    combined = np.tensordot(np.asarray(weights)[subset], predictions[subset],
+            axes=1)
+    return float(np.mean(combined.argmax(axis=-1) == y))
+
+
+def forward_selection(predictions, weights, y, target_accuracy=None,
+                      max_members=None, costs=None, budget=None):
+    """
+    Greedily adds the member that most improves the accuracy of the
+    sub-ensemble. Stops when `target_accuracy` is reached, when `max_members`
+    have been selected or when no member can be added within the `budget`
+    (in the same units as `costs`). With a budget, members are ranked by
+    accuracy gain per unit of cost, and selection also stops when no
+    affordable member improves the accuracy.
+    Returns the selected indexes and the accuracy after each addition.
+    """
+    outputs = predictions
+    weights = np.asarray(weights, dtype='float64')
+    n_members = outputs.shape[0]
+    if max_members is None:
+        max_members = n_members
+    selected = []
+    history = []
+    spent = 0.
+    current = np.zeros(outputs.shape[1:])
+    accuracy = 0.
+    while len(selected) < max_members:
+        best = None
+        best_rank = None
+        for i in range(n_members):
+            if i in selected or weights[i] <= 0.:
+                continue
+            if budget is not None and spent + costs[i] > budget:
+                continue
+            candidate = current + weights[i] * outputs[i]
+            candidate_accuracy = np.mean(candidate.argmax(axis=-1) == y)
+            if budget is not None:
+                rank = (candidate_accuracy - accuracy) / max(costs[i], 1e-12)
+            else:
+                rank = candidate_accuracy
+            if best_rank is None or rank > best_rank:
+                best, best_rank = i, rank
+                best_accuracy = candidate_accuracy
+        if best is None or (budget is not None and best_rank <= 0.):
+            break
+        selected.append(best)
+        current += weights[best] * outputs[best]
+        accuracy = float(best_accuracy)
+        history.append(accuracy)
+        if budget is not None:
+            spent += costs[best]
+        if target_accuracy is not None and accuracy >= target_accuracy:
+            break
+    return selected, history
+
+
+def backward_elimination(predictions, weights, y, target_accuracy=None,
+                         max_members=None, costs=None, budget=None):
+    """
+    Greedily removes the member whose removal hurts the accuracy the least,
+    for as long as the sub-ensemble stays at or above `target_accuracy`
+    (defaults to the accuracy of the full ensemble). Removal continues
+    regardless of accuracy while there are more than `max_members` members
+    or while the cost of the sub-ensemble does not fit in the `budget`.
+    Returns the selected indexes and the accuracy after each removal.
+    """
+    outputs = predictions
+    weights = np.asarray(weights, dtype='float64')
+    selected = [i for i in range(outputs.shape[0]) if weights[i] > 0.]
+    current = np.tensordot(weights[selected], outputs[selected], axes=1)
+    if target_accuracy is None:
+        target_accuracy = np.mean(current.argmax(axis=-1) == y)
+    history = []
+    while len(selected) > 1:
+        over_budget = (budget is not None and
+                np.sum(np.asarray(costs)[selected]) > budget) or \
+                (max_members is not None and len(selected) > max_members)
+        best = None
+        best_accuracy = None
+        for i in selected:
+            candidate = current - weights[i] * outputs[i]
+            candidate_accuracy = np.mean(candidate.argmax(axis=-1) == y)
+            if best_accuracy is None or candidate_accuracy > best_accuracy:
+                best, best_accuracy = i, candidate_accuracy
+        if best_accuracy < target_accuracy and not over_budget:
+            break
+        selected.remove(best)
+        current -= weights[best] * outputs[best]
+        history.append(float(best_accuracy))
+    return selected, history
+
+
+def prune(ensemble, members, selected):
+    """
+    Returns the members and aggregator of the sub-ensemble made of the
+    `selected` members, with re-normalised weights if the aggregator has any.
+    """
+    selected = sorted(selected)
+    new_members = [members[i] for i in selected]
+    new_ensemble = copy.copy(ensemble)
+    new_ensemble.members = new_members
+    if getattr(ensemble, 'weights', None) is not None:
+        weights = np.asarray(ensemble.weights, dtype='float64')[selected]
+        new_ensemble.weights = (weights / weights.sum()).tolist()
+    return new_members, new_ensemble
+
+
+def ensemble_weights(ensemble, n_members):
+    """The combination weights used by an aggregator"""
+    if getattr(ensemble, 'weights', None) is not None:
+        return np.asarray(ensemble.weights, dtype='float64')
+    return np.ones(n_members)
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Per-epoch and per-member records of a run, written in the background
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import toupee.common as common
+
+
+def _plain(record):
+    """The record with json types only (numpy values become lists/floats)"""
+    return json.loads(json.dumps(record, default = common.serialize))
+
+
+class JsonlBackend:
+    """Appends the records to a file, one json object per line"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        pass
+
+
+class SqliteBackend:
+    """Appends the records to a records(run, kind, time, record) table"""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def write(self, records):
+        #sqlite connections belong to the thread that made them
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS records '
+                '(run TEXT, kind TEXT, time REAL, record TEXT)')
+        with self.connection:
+            self.connection.executemany('INSERT INTO records VALUES '
+                '(?, ?, ?, ?)', [(r['run'], r['kind'], r['time'],
+                                  json.dumps(r)) for r in records])
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class MongoBackend:
+    """Inserts the records into a MongoDB collection"""
+
+    def __init__(self, host, db, collection):
+        from pymongo import MongoClient
+        self.client = MongoClient(host = host)
+        self.collection = self.client[db][collection]
+
+    def write(self, records):
+        from bson import ObjectId
+        from pymongo.errors import BulkWriteError
+        #the ids are set once, so that the records of a batch that was
+        # partly inserted are not duplicated when it is retried
+        for record in records:
+            record.setdefault('_id', ObjectId())
+        try:
+            self.collection.insert_many(records, ordered = False)
+        except BulkWriteError as e:
+            duplicate_key = 11000
+            if any(error['code'] != duplicate_key
+                   for error in e.details['writeErrors']) or \
+                    e.details.get('writeConcernErrors'):
+                raise
+
+    def close(self):
+        self.client.close()
+
+
+class ResultsSink:
+    """
+    Queues records and writes them to a backend from a background thread,
+    in batches of batch_size or every flush_interval seconds. Each record
+    is tagged with the run and its kind ('epoch', 'member', 'run', ...).
+    A failed write is reported and retried with the next batch.
+    """
+
+    def __init__(self, backend, run, batch_size = 100, flush_interval = 5.):
+        self.backend = backend
+        self.run = run
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, kind, record):
+        record = _plain(record)
+        record.update({'run': self.run, 'kind': kind, 'time': time.time()})
+        self.queue.put(record)
+
+    def _write_loop(self):
+        batch = []
+        closing = False
+        last_write = time.time()
+        while not closing or batch:
+            timeout = max(0., self.flush_interval - (time.time() - last_write))
+            try:
+                record = self.queue.get(timeout = timeout)
+                if record is None:
+                    closing = True
+                else:
+                    batch.append(record)
+            except queue.Empty:
+                pass
+            if batch and (closing or len(batch) >= self.batch_size or
+                    time.time() - last_write >= self.flush_interval):
+                try:
+                    self.backend.write(batch)
+                    batch = []
+                except Exception as e:
+                    print(("WARNING: could not write {0} records: {1}".format(
+                        len(batch), e)))
+                    if closing:
+                        break
+                last_write = time.time()
+        self.backend.close()
+
+    def install_hooks(self, toupee):
+        """Records every epoch and member through the training hooks"""
+        toupee.add_hook('epoch_end', self._epoch_hook)
+        toupee.add_hook('member_end', self._member_hook)
+
+    def _epoch_hook(self, event, context):
+        self.record('epoch', context)
+
+    def _member_hook(self, event, context):
+        self.record('member', context)
+
+    def close(self):
+        """Writes the queued records and stops the writer"""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def results_sink(params):
+    """The sink described by params.results_sink, or None"""
+    settings = params.results_sink
+    if settings is None:
+        return None
+    backend_name = settings.get('backend', 'jsonl')
+    if backend_name == 'jsonl':
+        backend = JsonlBackend(settings.get('path', 'results.jsonl'))
+    elif backend_name == 'sqlite':
+        backend = SqliteBackend(settings.get('path', 'results.sqlite'))
+    elif backend_name == 'mongo':
+        host = params.results_host if 'results_host' in params.__dict__ \
+            else None
+        table = params.results_table if 'results_table' in params.__dict__ \
+            else 'results'
+        backend = MongoBackend(host, params.results_db, table + '_records')
+    else:
+        raise ValueError("unknown results backend {0}".format(backend_name))
+    return ResultsSink(backend, str(params.ensemble_id),
+                       batch_size = settings.get('batch_size', 100),
+                       flush_interval = settings.get('flush_interval', 5.))
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Scoring of the ensemble as members are added to it
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import numpy
+
+import toupee.common as common
+
+
+sets = ['train', 'valid', 'test']
+
+
+def _combined_accuracy(output, set_labels):
+    return float(numpy.mean(output.argmax(axis = -1) == set_labels))
+
+
+def _combined_error(output, set_labels):
+    return 1. - _combined_accuracy(output, set_labels)
+
+
+def _combined_nll(output, set_labels):
+    #the combinations (sums, votes) are normalised to probabilities
+    output = numpy.asarray(output, dtype = 'float64')
+    proba = output / numpy.maximum(output.sum(axis = -1, keepdims = True),
+                                   1e-12)
+    true_proba = proba[numpy.arange(len(set_labels)), set_labels]
+    return float(-numpy.mean(numpy.log(numpy.maximum(true_proba, 1e-12))))
+
+
+scorers = {'accuracy': _combined_accuracy,
+           'error': _combined_error,
+           'nll': _combined_nll}
+
+
+default_settings = {'split': 'train',
+                    'subsample': None,
+                    'every': 1,
+                    'scorers': ['accuracy']}
+
+
+class IntermediateScorer:
+    """
+    Scores the ensemble on one set (params.intermediate_scoring's split), or
+    on a fixed random subsample of it, every `every` members and after the
+    last one. The members' predictions of that set, when sequential_model
+    made them, are combined as the members are added, so that the ensemble
+    doesn't have to predict the set again.
+    """
+
+    def __init__(self, params, data_files):
+        settings = dict(default_settings)
+        settings.update(params.intermediate_scoring or {})
+        if settings['split'] not in sets:
+            raise ValueError("can't score the ensemble on {0}".format(
+                settings['split']))
+        unknown = [s for s in settings['scorers'] if s not in scorers]
+        if unknown:
+            raise ValueError("unknown scorers {0}".format(unknown))
+        self.split = settings['split']
+        self.set_index = sets.index(self.split)
+        self.every = max(1, int(settings['every']))
+        self.scorer_names = list(settings['scorers'])
+        self.ensemble_size = params.ensemble_size
+
+        set_labels = common.labels(data_files[self.set_index])
+        self.indexes = None
+        if settings['subsample'] is not None and \
+                settings['subsample'] < len(set_labels):
+            rng = numpy.random.RandomState(params.random_seed)
+            self.indexes = numpy.sort(rng.choice(len(set_labels),
+                settings['subsample'], replace = False))
+            set_labels = set_labels[self.indexes]
+        self.labels = set_labels
+
+        self.running_output = None
+        self.use_cached_outputs = True
+        self.n_members = 0
+        self.last_scored = 0
+
+    @property
+    def name(self):
+        if self.indexes is None:
+            return self.split
+        return '{0} ({1} samples)'.format(self.split, len(self.indexes))
+
+    def _cached_probabilities(self, evaluations):
+        """The last member's predictions of the scored samples, if made"""
+        if evaluations is None or evaluations.get(self.split) is None:
+            return None
+        evaluation = evaluations[self.split]
+        if evaluation.indexes is None:
+            if self.indexes is None:
+                return evaluation.probabilities
+            return evaluation.probabilities[self.indexes]
+        if self.indexes is not None and \
+                numpy.array_equal(evaluation.indexes, self.indexes):
+            return evaluation.probabilities
+        return None
+
+    def __getstate__(self):
+        #the combined output is as large as the scored set, so it isn't
+        # saved with the checkpoints: a resumed scorer predicts it again
+        state = dict(self.__dict__)
+        state['running_output'] = None
+        return state
+
+    def _restore_running_output(self, ensemble, data_files, batch_size):
+        """Combines the members' outputs again, after resuming"""
+        if not self.use_cached_outputs or self.running_output is not None:
+            return
+        for i in range(self.n_members):
+            m_yaml, m_weights = ensemble.members[i]
+            proba = common.get_probabilities(
+                common.inference_model(m_yaml, m_weights),
+                data_files[self.set_index], batch_size, self.indexes)
+            self.running_output = ensemble.accumulate(self.running_output,
+                                                      proba, i)
+
+    def add_member(self, ensemble, evaluations, data_files, batch_size):
+        """
+        Adds the last member of ensemble, and returns the scores of the
+        ensemble if they are due (None otherwise)
+        """
+        self._restore_running_output(ensemble, data_files, batch_size)
+        self.n_members += 1
+        proba = self._cached_probabilities(evaluations) \
+            if self.use_cached_outputs else None
+        if proba is not None:
+            self.running_output = ensemble.accumulate(self.running_output,
+                proba, self.n_members - 1)
+        else:
+            #one missing member is enough to need the ensemble predictions
+            self.use_cached_outputs = False
+            self.running_output = None
+        if self.n_members % self.every == 0 or \
+                self.n_members >= self.ensemble_size:
+            return self.score(ensemble, data_files, batch_size)
+        return None
+
+    def needs_final_score(self):
+        return self.last_scored != self.n_members
+
+    def score(self, ensemble, data_files, batch_size):
+        """The scores of the whole ensemble"""
+        if self.use_cached_outputs:
+            self._restore_running_output(ensemble, data_files, batch_size)
+            output = self.running_output
+        else:
+            output = common.get_probabilities(ensemble,
+                data_files[self.set_index], batch_size, self.indexes)
+        self.last_scored = self.n_members
+        return [scorers[name](output, self.labels)
+                for name in self.scorer_names]
@@ -0,0 +1,333 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Serving of a stored ensemble, with concurrent requests combined into
+micro-batches
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import collections
+import http.server
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+import numpy
+
+import toupee.common as common
+
+
+class EnsemblePredictor:
+    """
+    The combined probabilities of a stored ensemble (see
+    archive.load_ensemble). Each member's model is built once and kept,
+    instead of being rebuilt or having its weights swapped at every call.
+    """
+
+    def __init__(self, location, batch_size = None):
+        from toupee.archive import load_ensemble
+        members, self.ensemble = load_ensemble(location)
+        if batch_size is None:
+            batch_size = common.inference_batch_size(self.ensemble.params)
+        self.batch_size = batch_size
+        self.models = []
+        for m_yaml, m_weights in members:
+            model = common.build_model(m_yaml)
+            model.set_weights(common.dequantize_weights(m_weights))
+            self.models.append(model)
+        self.input_shape = tuple(self.models[0].input_shape[1:])
+        #the combinations are sums (of votes, or weighted probabilities)
+        weights = getattr(self.ensemble, 'weights', None)
+        if weights is None:
+            self.total_weight = float(len(self.models))
+        else:
+            self.total_weight = float(numpy.sum(weights))
+
+    def __call__(self, x):
+        running = None
+        for i, model in enumerate(self.models):
+            proba = model.predict(x, batch_size = self.batch_size)
+            running = self.ensemble.accumulate(running, proba, i)
+        return running / self.total_weight
+
+
+class PendingRequest:
+    """A request waiting for its micro-batch"""
+
+    def __init__(self, x):
+        self.x = x
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+    def result(self, timeout = None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("the request was not served in time")
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+
+class ServingStats:
+    """
+    Counts of the requests, rows and batches served, and the latencies of
+    the last `window` requests
+    """
+
+    def __init__(self, window = 10000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen = window)
+        self.batch_rows = collections.deque(maxlen = window)
+
+    def batch_done(self, requests, rows, errors = 0):
+        now = time.perf_counter()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.rows += rows
+            self.errors += errors
+            self.batch_rows.append(rows)
+            self.latencies.extend(now - r.arrival for r in requests)
+
+    def summary(self):
+        with self.lock:
+            latencies = numpy.asarray(self.latencies) * 1000.
+            batch_rows = numpy.asarray(self.batch_rows)
+            elapsed = time.time() - self.start_time
+            summary = {'requests': self.requests,
+                       'rows': self.rows,
+                       'batches': self.batches,
+                       'errors': self.errors,
+                       'uptime': elapsed,
+                       'rows_per_second': self.rows / max(elapsed, 1e-9),
+                       'requests_per_second':
+                           self.requests / max(elapsed, 1e-9)}
+        if len(latencies) > 0:
+            for p in (50, 90, 99):
+                summary['latency_p{0}_ms'.format(p)] = \
+                    float(numpy.percentile(latencies, p))
+            summary['latency_max_ms'] = float(latencies.max())
+            summary['mean_batch_rows'] = float(batch_rows.mean())
+        return summary
+
+
+class MicroBatcher:
+    """
+    Runs the requests through a predictor from a single worker thread (so
+    that the TensorFlow session is only used from there). The requests that
+    arrive while a batch is forming are combined, up to max_batch_size rows;
+    a batch is run at the latest max_latency seconds after its first
+    request arrived. load_predictor is called in the worker thread and
+    returns the function from inputs to outputs; if that has an
+    input_shape (the shape of a row, None for any size) the requests are
+    checked against it when they are submitted.
+    """
+
+    def __init__(self, load_predictor, max_batch_size = 256,
+                 max_latency = 0.01):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = ServingStats()
+        self.queue = queue.Queue()
+        self.ready = threading.Event()
+        self.load_error = None
+        self.input_shape = None
+        self.thread = threading.Thread(target = self._serve_loop,
+                                       args = (load_predictor,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait_ready(self, timeout = None):
+        """Waits for the predictor to be loaded, raising its error if any"""
+        self.ready.wait(timeout)
+        if self.load_error is not None:
+            raise self.load_error
+
+    def check_input(self, x):
+        """Raises a ValueError if x is not a non-empty set of valid rows"""
+        if x.ndim < 2 or len(x) == 0:
+            raise ValueError("expected a non-empty list of rows, got an "
+                             "array of shape {0}".format(x.shape))
+        if self.input_shape is None:
+            return
+        if len(x.shape[1:]) != len(self.input_shape) or any(
+                expected is not None and expected != size
+                for expected, size in zip(self.input_shape, x.shape[1:])):
+            raise ValueError("expected rows of shape {0}, got {1}".format(
+                self.input_shape, x.shape[1:]))
+
+    def submit(self, x):
+        request = PendingRequest(numpy.asarray(x, dtype = 'float32'))
+        self.check_input(request.x)
+        self.queue.put(request)
+        return request
+
+    def predict(self, x, timeout = None):
+        return self.submit(x).result(timeout)
+
+    def _next_batch(self):
+        """The next requests to run together, or None when closing"""
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        rows = len(first.x)
+        deadline = first.arrival + self.max_latency
+        while rows < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0.:
+                break
+            try:
+                request = self.queue.get(timeout = timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                #served after this batch
+                self.queue.put(None)
+                break
+            batch.append(request)
+            rows += len(request.x)
+        return batch
+
+    def _serve_loop(self, load_predictor):
+        try:
+            predictor = load_predictor()
+        except Exception as e:
+            self.load_error = e
+            self.ready.set()
+            return
+        input_shape = getattr(predictor, 'input_shape', None)
+        if input_shape is not None:
+            self.input_shape = tuple(input_shape)
+        self.ready.set()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            if not self._run(predictor, batch) and len(batch) > 1:
+                #one bad request must not fail those it was batched with
+                for r in batch:
+                    r.error = None
+                    self._run(predictor, [r])
+            self.stats.batch_done(batch, sum(len(r.x) for r in batch),
+                                  sum(r.error is not None for r in batch))
+            for r in batch:
+                r.done.set()
+
+    def _run(self, predictor, batch):
+        """
+        Runs the requests in batch together, setting their outputs, or their
+        error and returning False if that failed
+        """
+        try:
+            output = predictor(numpy.concatenate([r.x for r in batch]))
+        except Exception as e:
+            for r in batch:
+                r.error = e
+            return False
+        end = 0
+        for r in batch:
+            r.output = output[end:end + len(r.x)]
+            end += len(r.x)
+        return True
+
+    def close(self):
+        """Serves the queued requests and stops the worker"""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def make_handler(batcher, timeout = 60.):
+    """
+    The HTTP handler of a server: POST /predict with a json body {"x":
+    [rows]} answers {"probabilities": [...], "classes": [...]}, GET /stats
+    answers the ServingStats summary and GET /health answers once the
+    ensemble is loaded
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats.summary())
+            elif self.path == '/health':
+                if batcher.ready.is_set() and batcher.load_error is None:
+                    self._reply(200, {'status': 'ready'})
+                else:
+                    self._reply(503, {'status': 'loading'})
+            else:
+                self._reply(404, {'error': 'unknown path ' + self.path})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'unknown path ' + self.path})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                x = numpy.asarray(json.loads(self.rfile.read(length))['x'],
+                                  dtype = 'float32')
+                request = batcher.submit(x)
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': 'bad request: {0}'.format(e)})
+                return
+            try:
+                proba = request.result(timeout)
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+                return
+            self._reply(200, {'probabilities': proba.tolist(),
+                              'classes': proba.argmax(axis = -1).tolist()})
+
+        def address_string(self):
+            #unix socket clients have no address
+            if isinstance(self.client_address, tuple):
+                return self.client_address[0]
+            return 'unix'
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def http_server(batcher, host = '127.0.0.1', port = 8080):
+    """A server of batcher on host:port (port 0 picks a free one)"""
+    return ThreadingHTTPServer((host, port), make_handler(batcher))
+
+
+def unix_server(batcher, path):
+    """A server of batcher on the unix socket at path"""
+    if os.path.exists(path):
+        os.remove(path)
+    return ThreadingUnixHTTPServer(path, make_handler(batcher))
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Chunked reading of input sets and resumable writing of predictions, for
+sets that don't fit in memory
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import json
+import os
+import zipfile
+
+import h5py
+import numpy
+from numpy.lib import format as npy_format
+
+
+class ArrayInput:
+    """Rows of an array that is memory-mapped (.npy) or read lazily (.h5)"""
+
+    def __init__(self, array, closing = None):
+        self.array = array
+        self.closing = closing
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def read(self, start, stop):
+        return numpy.asarray(self.array[start:stop])
+
+    def close(self):
+        if self.closing is not None:
+            self.closing.close()
+
+
+class NpzInput:
+    """
+    Rows of an array in a (possibly compressed) .npz file, decompressed as
+    they are read. Reading goes forward; going back starts over.
+    """
+
+    def __init__(self, path, key):
+        self.zip = zipfile.ZipFile(path)
+        self.name = key + '.npy'
+        if self.name not in self.zip.namelist():
+            raise ValueError("{0} has no array {1}".format(path, key))
+        self._open()
+
+    def _open(self):
+        self.stream = self.zip.open(self.name)
+        version = npy_format.read_magic(self.stream)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                npy_format.read_array_header_1_0(self.stream)
+        else:
+            shape, fortran_order, dtype = \
+                npy_format.read_array_header_2_0(self.stream)
+        if dtype.hasobject:
+            raise ValueError("can't stream an array of objects")
+        if fortran_order and len(shape) > 1:
+            raise ValueError("can't stream a fortran-ordered array")
+        self.shape = shape
+        self.dtype = dtype
+        self.row_bytes = dtype.itemsize * int(numpy.prod(shape[1:]))
+        self.position = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_bytes(self, n_bytes):
+        chunks = []
+        while n_bytes > 0:
+            chunk = self.stream.read(min(n_bytes, 2**24))
+            if not chunk:
+                raise IOError("{0} is truncated".format(self.name))
+            chunks.append(chunk)
+            n_bytes -= len(chunk)
+        return b''.join(chunks)
+
+    def read(self, start, stop):
+        stop = min(stop, len(self))
+        if start < self.position:
+            self.stream.close()
+            self._open()
+        #skips to start, a bounded piece at a time
+        while self.position < start:
+            rows = min(start - self.position,
+                       max(1, 2**24 // max(self.row_bytes, 1)))
+            self._read_bytes(rows * self.row_bytes)
+            self.position += rows
+        data = self._read_bytes((stop - start) * self.row_bytes)
+        self.position = stop
+        return numpy.frombuffer(data, self.dtype).reshape(
+            (stop - start,) + tuple(self.shape[1:]))
+
+    def close(self):
+        self.stream.close()
+        self.zip.close()
+
+
+def open_input(path, key = 'x'):
+    """The rows of a .npy file, or of the `key` array of a .npz or .h5 file"""
+    if path[-4:] == '.npy':
+        return ArrayInput(numpy.load(path, mmap_mode = 'r'))
+    elif path[-4:] == '.npz':
+        return NpzInput(path, key)
+    elif path[-3:] == '.h5':
+        f = h5py.File(path, 'r')
+        return ArrayInput(f[key], f)
+    raise ValueError('.npy, .npz or .h5 files are required.')
+
+
+class NpyOutput:
+    """
+    Rows written to a memory-mapped .npy file. What it holds (name) and the
+    number of rows written are kept in <path>.progress, updated once the
+    rows are flushed to disk.
+    """
+
+    def __init__(self, path, name, shape = None, dtype = None):
+        self.path = path
+        self.name = name
+        self.progress_file = path + '.progress'
+        if shape is None:
+            with open(self.progress_file, 'r') as f:
+                progress = json.load(f)
+            if progress['name'] != name:
+                raise ValueError("{0} holds {1}, not {2}".format(path,
+                    progress['name'], name))
+            self.array = npy_format.open_memmap(path, mode = 'r+')
+            self.rows_done = progress['rows_done']
+        else:
+            self.array = npy_format.open_memmap(path, mode = 'w+',
+                dtype = dtype, shape = shape)
+            self.rows_done = 0
+            self.commit(0)
+
+    def write(self, start, values):
+        self.array[start:start + len(values)] = values
+
+    def commit(self, rows_done):
+        self.array.flush()
+        with open(self.progress_file + '.tmp', 'w') as f:
+            json.dump({'name': self.name, 'rows_done': rows_done}, f)
+        os.replace(self.progress_file + '.tmp', self.progress_file)
+        self.rows_done = rows_done
+
+    def close(self):
+        del self.array
+
+
+class H5Output:
+    """
+    Rows written to the `name` dataset of a .h5 file, whose rows_done
+    attribute counts the rows written so far
+    """
+
+    def __init__(self, path, name, shape = None, dtype = None):
+        if shape is None:
+            self.file = h5py.File(path, 'r+')
+            if name not in self.file:
+                self.file.close()
+                raise ValueError("{0} has no {1}".format(path, name))
+            self.array = self.file[name]
+        else:
+            self.file = h5py.File(path, 'w')
+            self.array = self.file.create_dataset(name, shape = shape,
+                dtype = dtype, chunks = True)
+            self.commit(0)
+        self.rows_done = int(self.array.attrs['rows_done'])
+
+    def write(self, start, values):
+        self.array[start:start + len(values)] = values
+
+    def commit(self, rows_done):
+        self.array.attrs['rows_done'] = rows_done
+        self.file.flush()
+        self.rows_done = rows_done
+
+    def close(self):
+        self.file.close()
+
+
+def is_h5(path):
+    return path[-3:] == '.h5'
+
+
+def create_output(path, name, shape, dtype):
+    """A new (.h5 or .npy) output of the given shape"""
+    if is_h5(path):
+        return H5Output(path, name, shape, dtype)
+    return NpyOutput(path, name, shape, dtype)
+
+
+def resume_output(path, name, n_rows):
+    """
+    The partially written output at path, or None if there is nothing to
+    resume
+    """
+    if not os.path.exists(path):
+        return None
+    if is_h5(path):
+        output = H5Output(path, name)
+    elif not os.path.exists(path + '.progress'):
+        raise ValueError("{0} was not written by a prediction run".format(
+            path))
+    else:
+        output = NpyOutput(path, name)
+    if output.array.shape[0] != n_rows:
+        output.close()
+        raise ValueError("{0} has {1} rows, the input has {2}".format(path,
+            output.array.shape[0], n_rows))
+    return output
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+"""
+Alan Mosca
+Department of Computer Science and Information Systems
+Birkbeck, University of London
+
+Per-phase timing of experiments
+
+All code released under Apachev2.0 licensing.
+"""
+__docformat__ = 'restructedtext en'
+
+import time
+import random
+import threading
+import contextlib
+import numpy
+
+from keras.callbacks import Callback
+
+
+class PhaseStats:
+    """
+    Wall and CPU time totals of a phase, with a bounded random sample of
+    the wall times for the percentiles
+    """
+
+    sample_size = 10000
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.count = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.wall_max = 0.
+        self.samples = []
+
+    def add(self, wall, cpu):
+        self.count += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.wall_max = max(self.wall_max, wall)
+        if len(self.samples) < self.sample_size:
+            self.samples.append(wall)
+        else:
+            #reservoir sampling
+            i = self.rng.randint(0, self.count - 1)
+            if i < self.sample_size:
+                self.samples[i] = wall
+
+    def summary(self):
+        p50, p90, p99 = numpy.percentile(self.samples, [50, 90, 99])
+        return {
+            'count': self.count,
+            'wall_total': self.wall,
+            'cpu_total': self.cpu,
+            'wall_mean': self.wall / self.count,
+            'wall_p50': float(p50),
+            'wall_p90': float(p90),
+            'wall_p99': float(p99),
+            'wall_max': self.wall_max,
+        }
+
+
+class Timer:
+    """
+    Collects the wall (perf_counter) and CPU (process_time) times spent in
+    named phases, overall and for each ensemble member
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        #its own generator, so that timing never changes the experiment
+        self.rng = random.Random(0)
+        self.member = None
+        self.phases = {}
+        self.member_phases = {}
+
+    def set_member(self, member_number):
+        self.member = member_number
+
+    def record(self, phase, wall, cpu):
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = PhaseStats(self.rng)
+            self.phases[phase].add(wall, cpu)
+            if self.member is not None:
+                member_phases = self.member_phases.setdefault(self.member, {})
+                if phase not in member_phases:
+                    member_phases[phase] = PhaseStats(self.rng)
+                member_phases[phase].add(wall, cpu)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall_start,
+                        time.process_time() - cpu_start)
+
+    def summary(self):
+        """Totals and percentiles of each phase, overall and per member"""
+        with self.lock:
+            return {
+                'phases': dict((name, stats.summary())
+                               for name, stats in self.phases.items()),
+                'members': dict((str(member), dict(
+                                    (name, stats.summary())
+                                    for name, stats in phases.items()))
+                                for member, phases in
+                                    self.member_phases.items()),
+            }
+
+    def print_summary(self):
+        for name, stats in sorted(self.summary()['phases'].items()):
+            print(("  {0}: {1:.2f}s wall, {2:.2f}s cpu over {3} calls "
+                   "(p50 {4:.4f}s, p99 {5:.4f}s)".format(name,
+                       stats['wall_total'], stats['cpu_total'],
+                       stats['count'], stats['wall_p50'],
+                       stats['wall_p99'])))
+
+
+class TimingCallback(Callback):
+    """
+    Times a whole keras training run, its training steps and its
+    end-of-epoch validation (which runs between the last batch of an epoch
+    and on_epoch_end)
+    """
+
+    def __init__(self, timer):
+        super(TimingCallback, self).__init__()
+        self.timer = timer
+
+    def on_train_begin(self, logs=None):
+        self.train_wall_start = time.perf_counter()
+        self.train_cpu_start = time.process_time()
+
+    def on_train_end(self, logs=None):
+        self.timer.record('training',
+                          time.perf_counter() - self.train_wall_start,
+                          time.process_time() - self.train_cpu_start)
+
+    def _start(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def _record(self, phase):
+        self.timer.record(phase, time.perf_counter() - self.wall_start,
+                          time.process_time() - self.cpu_start)
+
+    def on_batch_begin(self, batch, logs=None):
+        self._start()
+
+    def on_batch_end(self, batch, logs=None):
+        self._record('train_step')
+        self._start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._record('epoch_validation')
+
+
+if 'timer' not in locals():
+    timer = Timer()